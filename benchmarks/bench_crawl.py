@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# 离线end-to-end benchmark: spider 'motion' -> pipelines，下载由benchmarks.replay.ReplayDownloadHandler代替，
+# MysqlPipeline/MongodbPipeline原样运行，数据库由benchmarks.standins代替(adbapi + sqlite3、in-process的MongoClient)
+# 报告 pages/sec、items/sec、parse latency p50/p99、peak RSS、pipeline flush latency
+# 用法: python -m benchmarks.bench_crawl [--subjects 2000] [--concurrency 32] [--set ITEM_FAST_PATH=True ...]
+
+from __future__ import print_function
+
+import argparse
+import inspect
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.project import get_project_settings
+from twisted.enterprise import adbapi
+from benchmarks.standins import FakeMongoClient
+from doubanmovie.pipelines import MongodbPipeline, MysqlPipeline
+from doubanmovie.spiders.spider_movie import DoubanMovieSpider
+
+# 由BenchSpider和Bench*Pipeline记录(ms)
+latencies = {'parse': [], 'flush': []}
+
+
+class BenchSpider(DoubanMovieSpider):
+    """记录每次parse(extraction + item构造)的latency"""
+    def parse(self, response):
+        start = time.time()
+        result = super(BenchSpider, self).parse(response)
+        if inspect.iscoroutine(result):                                         # PARSE_POOL_SIZE > 0时为coroutine
+            return self._timed_parse(result, start)
+        result = list(result)
+        latencies['parse'].append((time.time() - start) * 1000)
+        return result
+
+    async def _timed_parse(self, coroutine, start):
+        """等待process pool的extraction完成后再记录latency"""
+        result = await coroutine
+        latencies['parse'].append((time.time() - start) * 1000)
+        return result
+
+
+def _timed(d):
+    """记录batch write(flush)由开始到完成的latency"""
+    start = time.time()
+    d.addBoth(lambda result: latencies['flush'].append((time.time() - start) * 1000) or result)
+    return d
+
+
+class BenchMysqlPipeline(MysqlPipeline):
+    """MysqlPipeline，ConnectionPool为benchmarks.standins(sqlite3)；legacy table在open_spider时创建"""
+    def _connect(self):
+        self.db_dir = tempfile.mkdtemp()
+        dbpool = adbapi.ConnectionPool('benchmarks.standins', os.path.join(self.db_dir, 'bench.db'),
+                                       cp_min=1, cp_max=1)
+        dbpool.runOperation("CREATE TABLE douban_movie_scrapy (id INTEGER PRIMARY KEY, %s, UNIQUE (url))" %
+                            ', '.join(self.legacy_columns))
+        return dbpool
+
+    def _write_batch(self, rows):
+        return _timed(super(BenchMysqlPipeline, self)._write_batch(rows))
+
+    def close_spider(self, spider):
+        d = super(BenchMysqlPipeline, self).close_spider(spider)
+        d.addBoth(lambda _: shutil.rmtree(self.db_dir))
+        return d
+
+
+class BenchMongodbPipeline(MongodbPipeline):
+    """MongodbPipeline，MongoClient为benchmarks.standins.FakeMongoClient"""
+    def _connect(self):
+        return FakeMongoClient()
+
+    def _write_batch(self, docs):
+        return _timed(super(BenchMongodbPipeline, self)._write_batch(docs))
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def run_crawl(overrides, extra_settings=()):
+    """
+    以replay站点运行spider 'motion'；overrides为dict，extra_settings为 'NAME=VALUE' 形式的list；
+    返回(stats, elapsed)
+    """
+    settings = get_project_settings()
+    settings.setdict(dict({
+        'DOWNLOAD_HANDLERS': {'http': 'benchmarks.replay.ReplayDownloadHandler',
+                              'https': 'benchmarks.replay.ReplayDownloadHandler'},
+        'DOWNLOAD_DELAY': 0,
+        'ADAPTIVE_THROTTLE_ENABLED': False,
+        'ITEM_PIPELINES': {
+            'doubanmovie.pipelines.DropEmptyItemPipeline': 300,
+            'doubanmovie.pipelines.FilterDuplicatePipeline': 400,
+            BenchMysqlPipeline: 500,                                            # class(非import path): 以python -m运行时
+            BenchMongodbPipeline: 501,                                          # 与__main__共用latencies
+        },
+        'MYSQL_BATCH_SIZE': 100,
+        'MONGODB_BATCH_SIZE': 100,
+        'LOG_LEVEL': 'WARNING',
+        'TELNETCONSOLE_ENABLED': False,
+    }, **overrides), priority='cmdline')
+    for override in extra_settings:
+        name, value = override.split('=', 1)
+        settings.set(name, value, priority='cmdline')
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(BenchSpider)
+    process.crawl(crawler)
+    start = time.time()
+    process.start()
+    return crawler.stats.get_stats(), time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--subjects', type=int, default=2000, help='replay站点中的电影数')
+    parser.add_argument('--concurrency', type=int, default=32, help='CONCURRENT_REQUESTS')
+    parser.add_argument('--latency', type=float, default=0, help='模拟的下载延迟(秒)')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='覆盖其他settings')
+    args = parser.parse_args()
+
+    stats, elapsed = run_crawl({
+        'REPLAY_SUBJECTS': args.subjects,
+        'REPLAY_LATENCY': args.latency,
+        'CONCURRENT_REQUESTS': args.concurrency,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': args.concurrency,
+    }, args.set)
+
+    pages = stats.get('response_received_count', 0)
+    items = stats.get('item_scraped_count', 0)
+    print('elapsed:             %.2f s' % elapsed)
+    print('pages:               %d (%.1f pages/sec)' % (pages, pages / elapsed))
+    print('items:               %d (%.1f items/sec)' % (items, items / elapsed))
+    print('parse latency:       p50 %.2f ms, p99 %.2f ms' % (percentile(latencies['parse'], 50),
+                                                               percentile(latencies['parse'], 99)))
+    print('flush latency:       p50 %.2f ms, p99 %.2f ms (%d flushes)' % (percentile(latencies['flush'], 50),
+                                                                           percentile(latencies['flush'], 99),
+                                                                           len(latencies['flush'])))
+    print('peak RSS:            %.1f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# micro-benchmark: 原先的10次ItemLoader.add_xpath vs. extractors.extract_movie_page(single pass)
+# vs. extract_movie_page + items.build_movie_record(不经过ItemLoader)
+# 对benchmarks/fixtures中保存的电影页面，测量单核 pages/sec，并检查两者load_item()的结果一致
+# 用法: python -m benchmarks.bench_extractor [--seconds 3]
+
+from __future__ import print_function
+
+import argparse
+import glob
+import os
+import time
+
+from scrapy.http import HtmlResponse
+from scrapy.loader import ItemLoader
+from doubanmovie.items import DoubanmovieItem, build_movie_record
+from doubanmovie.extractors import extract_movie_page
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def parse_legacy(response):
+    """原先spider.parse中的extraction(before)"""
+    next_page_urls = response.xpath(
+        "//*[@id='recommendations']/div[@class='recommendations-bd']/dl/dd/a/@href").extract()
+    l = ItemLoader(item=DoubanmovieItem(), response=response)
+    l.add_xpath('title', "//div[@id='content']/h1/span[@property='v:itemreviewed']/text()")
+    l.add_xpath('year', "//div[@id='content']/h1/span[@class='year']/text()")
+    l.add_xpath('country', u"//*[@id='info']/span[@class='pl' and text()='制片国家/地区:']/following::text()[1]")
+    l.add_xpath('genre', "//*[@id='info']//span[@property='v:genre']/text()")
+    l.add_xpath('language', u"//*[@id='info']/span[@class='pl' and text()='语言:']/following::text()[1]")
+    l.add_xpath('length', "//*[@id='info']/span[@property='v:runtime']/text()")
+    l.add_xpath('director', "//*[@id='info']/span[1]/span[@class='attrs']//a/text()")
+    l.add_xpath('actors', "//*[@id='info']/span[@class='actor']/span[@class='attrs']/a/text()")
+    l.add_xpath('score', "//*[@id='interest_sectl']//strong[@property='v:average']/text()")
+    l.add_xpath('image_url', "//*[@id='mainpic']/a/img/@src")
+    l.add_xpath('director_ids', "//*[@id='info']/span[1]/span[@class='attrs']//a/@href")
+    l.add_xpath('actor_ids', "//*[@id='info']/span[@class='actor']/span[@class='attrs']/a/@href")
+    l.add_value('url', response.url)
+    return l.load_item(), next_page_urls
+
+
+def parse_single_pass(response):
+    """extractors.extract_movie_page(after)"""
+    fields, next_page_urls = extract_movie_page(response.selector.root)
+    l = ItemLoader(item=DoubanmovieItem(), response=response)
+    for field, values in fields.items():
+        l.add_value(field, values)
+    l.add_value('url', response.url)
+    return l.load_item(), next_page_urls
+
+
+def parse_fast_path(response):
+    """extract_movie_page + build_movie_record(ITEM_FAST_PATH)"""
+    fields, next_page_urls = extract_movie_page(response.selector.root)
+    return build_movie_record(fields, response.url), next_page_urls
+
+
+def load_fixtures():
+    """fixtures/subject_<id>.html -> HtmlResponse的构造参数"""
+    pages = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, 'subject_*.html'))):
+        subject_id = os.path.basename(path)[len('subject_'):-len('.html')]
+        with open(path, 'rb') as f:
+            pages.append(('https://movie.douban.com/subject/%s/' % subject_id, f.read()))
+    return pages
+
+
+def bench(parse, pages, seconds):
+    """每次都构造新的HtmlResponse，使document parsing也计入"""
+    count = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        for url, body in pages:
+            parse(HtmlResponse(url, body=body, encoding='utf-8'))
+            count += 1
+    return count / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=3.0, help='每种实现的运行时间')
+    args = parser.parse_args()
+
+    pages = load_fixtures()
+    for url, body in pages:
+        response = HtmlResponse(url, body=body, encoding='utf-8')
+        assert parse_legacy(response) == parse_single_pass(response), 'output mismatch: %s' % url
+        item, next_page_urls = parse_fast_path(response)
+        assert (dict(item), next_page_urls) == parse_single_pass(response), 'output mismatch: %s' % url
+
+    before = bench(parse_legacy, pages, args.seconds)
+    after = bench(parse_single_pass, pages, args.seconds)
+    fast_path = bench(parse_fast_path, pages, args.seconds)
+    print('fixtures:            %d pages' % len(pages))
+    print('add_xpath (before):  %.1f pages/sec' % before)
+    print('single pass (after): %.1f pages/sec' % after)
+    print('MovieRecord:         %.1f pages/sec' % fast_path)
+    print('speedup:             %.2fx (single pass), %.2fx (MovieRecord)' % (after / before, fast_path / before))
+
+
+if __name__ == '__main__':
+    main()
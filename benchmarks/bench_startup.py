@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# startup benchmark: 与 scrapy crawl motion 相同的启动过程(project settings、spider loader、middlewares、pipelines、
+# extensions)，测量从启动python process到第一个request到达downloader的时间(time-to-first-request)；
+# 每次在新的python process中运行(module imports不被cache)，报告imports完成 和 第一个request的时间(min/median)；
+# MysqlPipeline/MongodbPipeline默认以benchmarks.standins连接(与bench_crawl相同，只替换_connect)，
+# --real-db时连接settings中的MySQL/MongoDB servers，--no-db时不启用
+# 用法: python -m benchmarks.bench_startup [--runs 5] [--no-db | --real-db] [--set NAME=VALUE ...]
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+class FirstRequestHandler(object):
+    """download handler: 第一个request到达时输出时间并结束process(不需要网络，也不等待spider关闭)"""
+    lazy = False
+
+    def __init__(self, settings, crawler=None):
+        pass
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings, crawler)
+
+    def download_request(self, request, spider=None):
+        print('first_request %.6f' % time.time())
+        sys.stdout.flush()
+        os._exit(0)                                                             # 不关闭DB connections等，只测量启动
+
+    def close(self):
+        pass
+
+
+def child(db, extra_settings):
+    """在child process中运行: 相当于 scrapy crawl motion"""
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+    settings = get_project_settings()
+    settings.set('DOWNLOAD_HANDLERS', {'http': 'benchmarks.bench_startup.FirstRequestHandler',
+                                       'https': 'benchmarks.bench_startup.FirstRequestHandler'}, priority='cmdline')
+    settings.set('LOG_LEVEL', 'WARNING', priority='cmdline')
+    if db != 'real':
+        pipelines = dict(settings.getdict('ITEM_PIPELINES'))
+        mysql = pipelines.pop('doubanmovie.pipelines.MysqlPipeline', None)
+        mongodb = pipelines.pop('doubanmovie.pipelines.MongodbPipeline', None)
+        if db == 'standin':
+            pipelines.update({'benchmarks.bench_crawl.BenchMysqlPipeline': mysql,
+                              'benchmarks.bench_crawl.BenchMongodbPipeline': mongodb})
+        settings.set('ITEM_PIPELINES', pipelines, priority='cmdline')
+    for override in extra_settings:
+        name, value = override.split('=', 1)
+        settings.set(name, value, priority='cmdline')
+
+    process = CrawlerProcess(settings)
+    print('imports %.6f' % time.time())
+    sys.stdout.flush()
+    process.crawl('motion')
+    process.start()
+
+
+def run_once(args):
+    """启动一个child process；返回{'imports': 秒, 'first_request': 秒}(由启动child process开始计算)"""
+    command = [sys.executable, '-m', 'benchmarks.bench_startup', '--child', '--db', args.db]
+    for override in args.set:
+        command += ['--set', override]
+    start = time.time()
+    child_process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = child_process.communicate()
+    times = {}
+    for line in output.decode('utf-8').splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[0] in ('imports', 'first_request'):
+            times[parts[0]] = float(parts[1]) - start
+    if 'first_request' not in times:                                            # e.g. DB server连接失败，spider已关闭
+        lines = errors.decode('utf-8', 'replace').strip().splitlines()
+        print('run did not reach the first request: %s' % (lines[-1] if lines else 'exit code %d' %
+                                                          child_process.returncode))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5, help='运行次数')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--no-db', dest='db', action='store_const', const='none',
+                       help='不启用MysqlPipeline/MongodbPipeline')
+    group.add_argument('--real-db', dest='db', action='store_const', const='real',
+                       help='MysqlPipeline/MongodbPipeline连接settings中的servers')
+    group.add_argument('--db', choices=('standin', 'none', 'real'), help=argparse.SUPPRESS)
+    parser.set_defaults(db='standin')                                           # DB pipelines以standins连接
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='覆盖其他settings')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.db, args.set)
+        return
+
+    runs = [run_once(args) for _ in range(args.runs)]
+    for phase in ('imports', 'first_request'):
+        values = sorted(run[phase] * 1000 for run in runs if phase in run)
+        if not values:
+            print('%-20s n/a' % (phase + ':'))
+            continue
+        print('%-20s min %.0f ms, median %.0f ms (%d runs)' % (phase + ':', values[0], values[len(values) // 2],
+                                                               len(values)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# BrowserPoolMiddleware的检查: 以StubBrowser(BROWSER_STUB_FILE)代替PhantomJS渲染render_js requests，
+# 确认browsers在每次渲染(包括出错)后放回pool，渲染BROWSER_MAX_PAGES个页面后 及 出错后重建
+# 用法: python -m benchmarks.check_browser_pool
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+from scrapy.http import Request
+from scrapy.settings import Settings
+from scrapy.statscollectors import MemoryStatsCollector
+from twisted.internet import defer, task
+
+from doubanmovie.middlewares import BrowserPoolMiddleware
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'front_page.html')
+POOL_SIZE = 2
+MAX_PAGES = 3
+
+
+class _Crawler(object):
+    """MemoryStatsCollector所需的crawler(只用到settings)"""
+    def __init__(self, settings):
+        self.settings = settings
+
+
+@defer.inlineCallbacks
+def render(middleware, count):
+    """同时提交count个render_js requests；返回responses"""
+    requests = [Request('https://movie.douban.com/?page=%d' % i, meta={'render_js': True}) for i in range(count)]
+    responses = yield defer.gatherResults([middleware.process_request(request, None) for request in requests])
+    return responses
+
+
+@defer.inlineCallbacks
+def check(reactor):
+    tmp_dir = tempfile.mkdtemp()
+    stub_file = os.path.join(tmp_dir, 'page.html')
+    shutil.copy(FIXTURE, stub_file)
+    settings = Settings({'BROWSER_STUB_FILE': stub_file, 'BROWSER_POOL_SIZE': POOL_SIZE,
+                         'BROWSER_MAX_PAGES': MAX_PAGES})
+    stats = MemoryStatsCollector(_Crawler(settings))
+    middleware = BrowserPoolMiddleware(settings, stats)
+    try:
+        # 非render_js的request不经过browsers
+        assert middleware.process_request(Request('https://movie.douban.com/'), None) is None
+        assert middleware.browsers is None
+
+        # pool中的browsers各渲染MAX_PAGES个页面，均不重建
+        responses = yield render(middleware, POOL_SIZE * MAX_PAGES)
+        with open(FIXTURE, 'rb') as f:
+            expected = f.read()
+        assert all(response.body == expected for response in responses)
+        assert stats.get_value('browser_pool/started') == POOL_SIZE, stats.get_stats()
+        assert stats.get_value('browser_pool/recycled') is None, stats.get_stats()
+        assert middleware.browsers.qsize() == POOL_SIZE                     # browsers都已放回pool
+
+        # 下一轮: 每个browser都已达到MAX_PAGES，使用前重建
+        yield render(middleware, POOL_SIZE)
+        assert stats.get_value('browser_pool/recycled') == POOL_SIZE, stats.get_stats()
+        assert stats.get_value('browser_pool/started') == 2 * POOL_SIZE, stats.get_stats()
+
+        # 渲染出错(stub文件不存在): error传给engine，browser仍放回pool，下次使用前重建
+        os.remove(stub_file)
+        try:
+            yield middleware.process_request(Request('https://movie.douban.com/error',
+                                                     meta={'render_js': True}), None)
+            raise AssertionError('render error was not raised')
+        except (IOError, OSError):
+            pass
+        assert middleware.browsers.qsize() == POOL_SIZE
+        shutil.copy(FIXTURE, stub_file)
+        # 两个browsers都被取出: 只有出错的browser重建
+        yield render(middleware, POOL_SIZE)
+        assert stats.get_value('browser_pool/recycled') == POOL_SIZE + 1, stats.get_stats()
+        assert stats.get_value('browser_pool/rendered') == POOL_SIZE * MAX_PAGES + 2 * POOL_SIZE, stats.get_stats()
+        assert middleware.browsers.qsize() == POOL_SIZE
+    finally:
+        middleware.spider_closed(None)
+        shutil.rmtree(tmp_dir)
+    print('browser pool: ok (%s)' % ', '.join('%s=%s' % item for item in sorted(stats.get_stats().items())))
+
+
+if __name__ == '__main__':
+    task.react(check)
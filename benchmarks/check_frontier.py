@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# RedisScheduler的检查: 同一process中的两个crawlers(nodes)以FakeRedis(FRONTIER_REDIS_URL = 'fake://...')共享frontier，
+# 下载由benchmarks.replay.ReplayDownloadHandler代替；确认两个nodes都有抓取、每个页面只被抓取一次、
+# 所有claim的requests都已ack(queue和processing lists为空)
+# 用法: python -m benchmarks.check_frontier [--subjects 300]
+
+from __future__ import print_function
+
+import argparse
+from collections import Counter
+
+from scrapy import signals
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.project import get_project_settings
+
+from doubanmovie.frontier import FakeRedis
+from doubanmovie.spiders.spider_movie import DoubanMovieSpider
+
+REDIS_URL = 'fake://check_frontier'
+NODES = ('node-a', 'node-b')
+
+
+def crawler_settings(num_subjects):
+    settings = get_project_settings()
+    downloader_middlewares = dict(settings.getdict('DOWNLOADER_MIDDLEWARES'))
+    downloader_middlewares['doubanmovie.frontier.FrontierAckMiddleware'] = 960
+    spider_middlewares = dict(settings.getdict('SPIDER_MIDDLEWARES'))
+    spider_middlewares['doubanmovie.frontier.FrontierAckMiddleware'] = 10
+    settings.setdict({
+        'SCHEDULER': 'doubanmovie.frontier.RedisScheduler',
+        'DOWNLOADER_MIDDLEWARES': downloader_middlewares,
+        'SPIDER_MIDDLEWARES': spider_middlewares,
+        'FRONTIER_REDIS_URL': REDIS_URL,
+        'FRONTIER_HEARTBEAT_INTERVAL': 1,
+        'DOWNLOAD_HANDLERS': {'http': 'benchmarks.replay.ReplayDownloadHandler',
+                              'https': 'benchmarks.replay.ReplayDownloadHandler'},
+        'REPLAY_SUBJECTS': num_subjects,
+        'REPLAY_LATENCY': 0.005,
+        'DOWNLOAD_DELAY': 0,
+        'ADAPTIVE_THROTTLE_ENABLED': False,
+        'CONCURRENT_REQUESTS': 8,
+        'ITEM_PIPELINES': {'doubanmovie.pipelines.DropEmptyItemPipeline': 300},
+        'LOG_LEVEL': 'WARNING',
+        'TELNETCONSOLE_ENABLED': False,
+    }, priority='cmdline')
+    return settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--subjects', type=int, default=300, help='replay站点中的电影数')
+    args = parser.parse_args()
+
+    process = CrawlerProcess(crawler_settings(args.subjects))
+    crawlers, urls = [], Counter()
+
+    def response_received(request):
+        urls[request.url] += 1
+
+    for node_id in NODES:
+        crawler = process.create_crawler(DoubanMovieSpider)
+        crawler.settings.set('FRONTIER_NODE_ID', node_id, priority='cmdline')     # crawl开始前仍可修改
+        crawler.signals.connect(response_received, signal=signals.response_received)
+        crawlers.append(crawler)
+        process.crawl(crawler)
+    process.start()
+
+    server = FakeRedis.from_url(REDIS_URL)
+    stats = [crawler.stats.get_stats() for crawler in crawlers]
+    for node_id, node_stats in zip(NODES, stats):
+        print('%s: %d responses, %d items, claimed %d, acked %d' % (
+            node_id, node_stats.get('response_received_count', 0), node_stats.get('item_scraped_count', 0),
+            node_stats.get('frontier/claimed', 0), node_stats.get('frontier/acked', 0)))
+
+    duplicates = [url for url, count in urls.items() if count > 1]
+    assert not duplicates, 'pages crawled more than once: %s' % duplicates[:5]
+    assert all(node_stats.get('response_received_count', 0) > 0 for node_stats in stats), 'a node did no work'
+    subjects = [url for url in urls if '/subject/' in url]
+    assert len(subjects) == args.subjects, (len(subjects), args.subjects)
+    assert server.llen('motion:queue') == 0
+    for node_id in NODES:
+        assert server.llen('motion:processing:%s' % node_id) == 0, 'unacked requests on %s' % node_id
+    claimed = sum(node_stats.get('frontier/claimed', 0) for node_stats in stats)
+    acked = sum(node_stats.get('frontier/acked', 0) for node_stats in stats)
+    assert claimed == acked == len(urls), (claimed, acked, len(urls))
+    print('frontier: ok (%d pages, %d subjects, no duplicates, all requests acked)' % (len(urls), len(subjects)))
+
+
+if __name__ == '__main__':
+    main()
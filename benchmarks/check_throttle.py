@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# AdaptiveThrottle的检查: 以benchmarks.sim_throttle模拟限流的站点(REPLAY_RATE_LIMIT，超过的返回429)，
+# 确认AdaptiveThrottle在被限流后backoff，并收敛到接近站点限制的速率(429比例低)
+# 用法: python -m benchmarks.check_throttle [--rate-limit 4] [--pages 200]
+
+from __future__ import print_function
+
+import argparse
+
+from benchmarks.sim_throttle import simulate
+
+MIN_RATE_FRACTION = 0.6         # 有效速率至少为站点限制的60%
+MAX_THROTTLED_FRACTION = 0.1    # 429 responses最多10%
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rate-limit', type=float, default=4, help='模拟站点每秒最多接受的requests')
+    parser.add_argument('--pages', type=int, default=200, help='下载的页面数')
+    args = parser.parse_args()
+
+    result = simulate('adaptive', rate_limit=args.rate_limit, pages=args.pages)
+    pages = result['accepted'] + result['throttled']
+    print('adaptive: %.2f accepted pages/sec (site limit %.2f), %d/%d throttled, %d backoff events, %.1f s' % (
+        result['rate'], args.rate_limit, result['throttled'], pages, result['backoff_events'], result['elapsed']))
+
+    assert result['accepted'] >= args.pages * 0.9, result['accepted']
+    # start delay(0.1s)超过站点限制: 必须被限流并backoff
+    assert result['throttled'] > 0 and result['backoff_events'] > 0, result
+    assert result['throttled'] <= MAX_THROTTLED_FRACTION * pages, (result['throttled'], pages)
+    assert result['rate'] >= MIN_RATE_FRACTION * args.rate_limit, result['rate']
+    assert result['rate'] <= args.rate_limit * 1.05, result['rate']
+    print('throttle: ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# 离线replay: 以benchmarks/fixtures中保存的页面代替movie.douban.com，不需要网络
+# 用法: settings中 DOWNLOAD_HANDLERS = {'https': 'benchmarks.replay.ReplayDownloadHandler', ...}
+
+import glob
+import os
+import re
+import time
+
+from scrapy.http import HtmlResponse
+from twisted.internet import defer, reactor
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+BASE_SUBJECT_ID = 1000000
+_subject_link = re.compile(br'(movie\.douban\.com/subject/)(\d+)')
+
+
+class ReplayCorpus(object):
+    """
+    由fixtures构造一个包含num_subjects部电影的站点：
+    subject页面轮流使用fixtures/subject_*.html，页面中的subject links被改写为站点内的id，
+    使recommendations形成一个固定的(可重复的)graph；top250 index页面和首页同理
+    """
+    def __init__(self, fixtures_dir=FIXTURES_DIR, num_subjects=2000):
+        self.num_subjects = num_subjects
+        self.subject_pages = []
+        for path in sorted(glob.glob(os.path.join(fixtures_dir, 'subject_*.html'))):
+            self.subject_pages.append(self._read(path))
+        self.front_page = self._read(os.path.join(fixtures_dir, 'front_page.html'))
+        self.top250_page = self._read(os.path.join(fixtures_dir, 'top250.html'))
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _rewrite(self, body, link_to_index):
+        """将body中第k个subject link改写为 BASE_SUBJECT_ID + link_to_index(k)"""
+        counter = [0]
+
+        def replace(match):
+            index = link_to_index(counter[0]) % self.num_subjects
+            counter[0] += 1
+            return match.group(1) + str(BASE_SUBJECT_ID + index).encode('ascii')
+        return _subject_link.sub(replace, body)
+
+    def get(self, url):
+        """返回url对应的页面body；不在站点中的url返回None"""
+        match = re.match(r'https?://movie\.douban\.com/subject/(\d+)', url)
+        if match:
+            index = int(match.group(1)) - BASE_SUBJECT_ID
+            if not 0 <= index < self.num_subjects:
+                return None
+            template = self.subject_pages[index % len(self.subject_pages)]
+            return self._rewrite(template, lambda k: index * 7919 + k * 104729 + 1)
+        match = re.match(r'https?://movie\.douban\.com/top250\?start=(\d+)', url)
+        if match:
+            start = int(match.group(1))
+            return self._rewrite(self.top250_page, lambda k: start + k // 2)      # 每部影片有pic和title两个link
+        if re.match(r'https?://movie\.douban\.com/?$', url):
+            return self._rewrite(self.front_page, lambda k: 250 + (k // 2) * 13)
+        return None
+
+
+class ReplayDownloadHandler(object):
+    """
+    scrapy download handler: 由ReplayCorpus返回response；
+    REPLAY_SUBJECTS: 站点中的电影数；REPLAY_LATENCY: 模拟的下载延迟(秒)；
+    REPLAY_RATE_LIMIT: 模拟站点的限流(每个来源IP每秒最多n个requests，超过的返回429)；
+    来源IP即request.meta['proxy'](模拟的proxy，不实际连接)，因此也作为IdentityPoolMiddleware的本地proxy stand-in
+    """
+    lazy = False
+
+    def __init__(self, settings, crawler=None):
+        self.corpus = ReplayCorpus(settings.get('REPLAY_FIXTURES_DIR', FIXTURES_DIR),
+                                   settings.getint('REPLAY_SUBJECTS', 2000))
+        self.latency = settings.getfloat('REPLAY_LATENCY', 0)
+        self.rate_limit = settings.getfloat('REPLAY_RATE_LIMIT', 0)
+        self.buckets = {}                                                       # proxy -> [tokens, last_refill]
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings, crawler)
+
+    def _throttled(self, source):
+        """每个source一个token bucket(容量为1秒的requests)"""
+        if not self.rate_limit:
+            return False
+        now = time.time()
+        bucket = self.buckets.setdefault(source, [self.rate_limit, now])
+        bucket[0] = min(self.rate_limit, bucket[0] + (now - bucket[1]) * self.rate_limit)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return True
+        bucket[0] -= 1
+        return False
+
+    def download_request(self, request, spider):
+        body = self.corpus.get(request.url)
+        if self._throttled(request.meta.get('proxy')):
+            response = HtmlResponse(request.url, status=429, body=b'', encoding='utf-8', request=request)
+        elif body is None:
+            response = HtmlResponse(request.url, status=404, body=b'', encoding='utf-8', request=request)
+        else:
+            response = HtmlResponse(request.url, body=body, encoding='utf-8', request=request)
+        # 与scrapy的HTTP download handler相同，设置download_latency(AutoThrottle/AdaptiveThrottle使用)
+        request.meta['download_latency'] = self.latency
+        if not self.latency:
+            return defer.succeed(response)
+        d = defer.Deferred()
+        reactor.callLater(self.latency, d.callback, response)
+        return d
+
+    def close(self):
+        pass
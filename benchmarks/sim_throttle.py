@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# AdaptiveThrottle的模拟: replay站点按REPLAY_RATE_LIMIT限流(超过的返回429)，在固定的request数内
+# 比较 --mode adaptive(AdaptiveThrottle) 与 --mode fixed(固定DOWNLOAD_DELAY) 的有效速率、429比例和backoff次数
+# --proxies n: 启用IdentityPoolMiddleware，使用n个模拟的proxy(replay站点对每个proxy分别限流)
+# 用法: python -m benchmarks.sim_throttle --mode adaptive [--rate-limit 4] [--pages 300] [--proxies 4]
+
+from __future__ import print_function
+
+import argparse
+
+from benchmarks.bench_crawl import run_crawl
+
+
+def simulate(mode='adaptive', rate_limit=4, latency=0.05, pages=300, fixed_delay=0.1, proxies=0, extra_settings=()):
+    """运行一次模拟；返回结果dict(elapsed、accepted、throttled、rate、backoff_events、stats)"""
+    overrides = {
+        'REPLAY_RATE_LIMIT': rate_limit,
+        'REPLAY_LATENCY': latency,
+        'CLOSESPIDER_PAGECOUNT': pages,
+        'RETRY_HTTP_CODES': [500, 502, 503, 504, 408, 429],
+    }
+    if mode == 'adaptive':
+        overrides.update({'ADAPTIVE_THROTTLE_ENABLED': True, 'ADAPTIVE_THROTTLE_START_DELAY': fixed_delay,
+                          'ADAPTIVE_THROTTLE_MIN_DELAY': 0.05})
+    else:
+        overrides['DOWNLOAD_DELAY'] = fixed_delay
+    if proxies:
+        overrides['IDENTITY_PROXIES'] = ['http://fake-proxy-%d:3128' % i for i in range(proxies)]
+        overrides['IDENTITY_QUARANTINE_SECS'] = 2
+    stats, elapsed = run_crawl(overrides, extra_settings)
+
+    # 429 response由RetryMiddleware重试，不计入response_received_count
+    accepted = stats.get('downloader/response_status_count/200', 0)
+    throttled = stats.get('downloader/response_status_count/429', 0)
+    return {
+        'elapsed': elapsed,
+        'accepted': accepted,
+        'throttled': throttled,
+        'rate': accepted / elapsed,
+        'backoff_events': stats.get('throttle/backoff_events', 0),
+        'stats': stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--mode', choices=('adaptive', 'fixed'), default='adaptive')
+    parser.add_argument('--rate-limit', type=float, default=4, help='模拟站点每秒最多接受的requests')
+    parser.add_argument('--latency', type=float, default=0.05, help='模拟的下载延迟(秒)')
+    parser.add_argument('--pages', type=int, default=300, help='下载的页面数(CLOSESPIDER_PAGECOUNT)')
+    parser.add_argument('--fixed-delay', type=float, default=0.1, help='--mode fixed时的DOWNLOAD_DELAY')
+    parser.add_argument('--proxies', type=int, default=0, help='IdentityPoolMiddleware使用的模拟proxy数')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='覆盖其他settings')
+    args = parser.parse_args()
+
+    result = simulate(args.mode, args.rate_limit, args.latency, args.pages, args.fixed_delay, args.proxies, args.set)
+    stats = result['stats']
+    pages = result['accepted'] + result['throttled']
+    print('mode:                %s' % args.mode)
+    print('elapsed:             %.2f s' % result['elapsed'])
+    print('pages:               %d (%d accepted, %d throttled = %.1f%%)' % (
+        pages, result['accepted'], result['throttled'], 100.0 * result['throttled'] / max(pages, 1)))
+    print('effective rate:      %.2f accepted pages/sec (site limit %.2f per source)' % (
+        result['rate'], args.rate_limit))
+    print('backoff events:      %d' % result['backoff_events'])
+    for key in sorted(stats):
+        if key.startswith('identity/') or \
+                key.startswith('throttle/') and key.endswith(('/delay_ms', '/rate_per_min')):
+            print('%-20s %s' % (key.split('/', 1)[1] + ':', stats[key]))
+
+
+if __name__ == '__main__':
+    main()
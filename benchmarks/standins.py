@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# benchmarks用的数据库stand-ins(不需要MySQL/MongoDB server)，由MysqlPipeline/MongodbPipeline原样使用:
+# 本module即adbapi.ConnectionPool('benchmarks.standins', path)的DB-API module: sqlite3 + pymysql SQL的翻译
+# (%s placeholders、INSERT ... ON DUPLICATE KEY UPDATE)；只支持legacy table(douban_movie_scrapy)所用的SQL；
+# FakeMongoClient: in-process的MongoClient stand-in，只实现MongodbPipeline所用的collection methods
+
+import re
+import sqlite3
+import threading
+
+apilevel = '2.0'
+threadsafety = 1
+paramstyle = 'format'
+
+_on_duplicate = re.compile(r'ON DUPLICATE KEY UPDATE (.*)$', re.S)
+_values_ref = re.compile(r'VALUES\((\w+)\)')
+
+
+def translate(query):
+    """pymysql(MySQL)的SQL -> sqlite3: %s -> ?；ON DUPLICATE KEY UPDATE -> ON CONFLICT(url) DO UPDATE"""
+    query = _on_duplicate.sub(
+        lambda m: 'ON CONFLICT(url) DO UPDATE SET ' + _values_ref.sub(r'excluded.\1', m.group(1)), query)
+    return query.replace('%s', '?')
+
+
+class Cursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, args=()):
+        return self.cursor.execute(translate(query), tuple(args or ()))
+
+    def executemany(self, query, args):
+        return self.cursor.executemany(translate(query), [tuple(row) for row in args])
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class Connection(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def cursor(self):
+        return Cursor(self.connection.cursor())
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+def connect(path, **kwargs):
+    kwargs.setdefault('check_same_thread', False)                              # adbapi在thread pool中使用connections
+    kwargs.setdefault('timeout', 30)
+    return Connection(sqlite3.connect(path, **kwargs))
+
+
+Error = sqlite3.Error
+Warning = sqlite3.Warning
+DatabaseError = sqlite3.DatabaseError
+OperationalError = sqlite3.OperationalError
+IntegrityError = sqlite3.IntegrityError
+
+
+class FakeBulkWriteResult(object):
+    def __init__(self, upserted_count, modified_count):
+        self.upserted_count = upserted_count
+        self.modified_count = modified_count
+
+
+class FakeCollection(object):
+    """documents以list保存；filters只支持等值 和 {'$exists': bool}"""
+    def __init__(self):
+        self.docs = []
+        self.indexes = []
+        self.lock = threading.Lock()                                            # bulk_write在worker thread中执行
+
+    @staticmethod
+    def _matches(doc, query):
+        for field, condition in query.items():
+            if isinstance(condition, dict) and '$exists' in condition:
+                if (field in doc) != condition['$exists']:
+                    return False
+            elif doc.get(field) != condition:
+                return False
+        return True
+
+    def create_index(self, keys, **kwargs):
+        self.indexes.append((keys, kwargs))
+        return keys
+
+    def find(self, query=None, projection=None):
+        with self.lock:
+            return [dict(doc) for doc in self.docs if self._matches(doc, query or {})]
+
+    def find_one(self, query):
+        found = self.find(query)
+        return found[0] if found else None
+
+    def distinct(self, field, query=None):
+        return list(set(doc[field] for doc in self.find(query) if field in doc))
+
+    def insert_one(self, doc):
+        with self.lock:
+            doc = dict(doc)
+            doc.setdefault('_id', len(self.docs) + 1)
+            self.docs.append(doc)
+
+    def update_one(self, query, update, upsert=False):
+        """返回(upserted, modified)"""
+        with self.lock:
+            for doc in self.docs:
+                if self._matches(doc, query):
+                    changed = any(doc.get(key) != value for key, value in update['$set'].items())
+                    doc.update(update['$set'])
+                    return 0, int(changed)
+            if not upsert:
+                return 0, 0
+            doc = dict(query, _id=len(self.docs) + 1)
+            doc.update(update['$set'])
+            self.docs.append(doc)
+            return 1, 0
+
+    def bulk_write(self, requests, ordered=True):
+        """requests为pymongo.UpdateOne"""
+        upserted = modified = 0
+        for request in requests:
+            result = self.update_one(request._filter, request._doc, upsert=bool(request._upsert))
+            upserted += result[0]
+            modified += result[1]
+        return FakeBulkWriteResult(upserted, modified)
+
+
+class FakeDatabase(object):
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection())
+
+
+class FakeMongoClient(object):
+    def __init__(self):
+        self.databases = {}
+
+    def __getitem__(self, name):
+        return self.databases.setdefault(name, FakeDatabase())
+
+    def close(self):
+        pass
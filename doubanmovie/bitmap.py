@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# 以subject id(int)为下标的bitmap；豆瓣subject id约为8位数，全部id只需几MB内存
+# path不为None时以memory-mapped file存储，可跨crawl session保存
+
+import mmap
+import os
+import struct
+
+
+class SubjectIdBitmap(object):
+    """
+    memory-mapped bitmap: 第n个bit表示subject id n是否已出现；
+    容量不够时自动扩展(按2倍增长)
+    """
+    def __init__(self, path=None, initial_size=1 << 22):
+        self.path = path
+        self.file = None
+        if path is not None:
+            self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+            size = os.path.getsize(path)
+            if size < initial_size:
+                self.file.truncate(initial_size)                       # 新文件以\x00填充
+                size = initial_size
+            self.mm = mmap.mmap(self.file.fileno(), size)
+        else:
+            self.mm = mmap.mmap(-1, initial_size)                      # anonymous mmap(不持久化)
+        self.size = len(self.mm)
+
+    def __contains__(self, n):
+        byte_index = n >> 3
+        if byte_index >= self.size:
+            return False
+        return bool(struct.unpack('B', self.mm[byte_index:byte_index + 1])[0] & (1 << (n & 7)))
+
+    def add(self, n):
+        """设置第n个bit；返回n之前是否已存在"""
+        byte_index = n >> 3
+        if byte_index >= self.size:
+            self._grow(byte_index + 1)
+        byte = struct.unpack('B', self.mm[byte_index:byte_index + 1])[0]
+        mask = 1 << (n & 7)
+        if byte & mask:
+            return True
+        self.mm[byte_index:byte_index + 1] = struct.pack('B', byte | mask)
+        return False
+
+    def update(self, ids):
+        for n in ids:
+            self.add(n)
+
+    def __iter__(self):
+        """按从小到大的顺序返回所有已设置的subject id"""
+        chunk_size = 1 << 16
+        for offset in range(0, self.size, chunk_size):
+            chunk = bytearray(self.mm[offset:offset + chunk_size])
+            for i, byte in enumerate(chunk):
+                if byte:
+                    for bit in range(8):
+                        if byte & (1 << bit):
+                            yield ((offset + i) << 3) | bit
+
+    def _grow(self, min_size):
+        new_size = self.size
+        while new_size < min_size:
+            new_size *= 2
+        if self.file is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.file.truncate(new_size)
+            self.mm = mmap.mmap(self.file.fileno(), new_size)
+        else:
+            new_mm = mmap.mmap(-1, new_size)
+            new_mm[:self.size] = self.mm[:]
+            self.mm.close()
+            self.mm = new_mm
+        self.size = new_size
+
+    def to_bytes(self):
+        """bitmap的内容(checkpoint用)"""
+        return self.mm[:]
+
+    def load_bytes(self, data):
+        """以to_bytes()的结果覆盖bitmap的内容(容量不够时扩展)"""
+        if len(data) > self.size:
+            self._grow(len(data))
+        self.mm[:len(data)] = data
+
+    def flush(self):
+        if self.file is not None:
+            self.mm.flush()
+
+    def close(self):
+        self.flush()
+        self.mm.close()
+        if self.file is not None:
+            self.file.close()
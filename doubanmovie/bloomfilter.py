@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Scalable Bloom filter(Almeida et al., 2007): 当前filter满载后追加一个容量更大、误判率更低的filter，
+# 总误判率收敛于 error_rate / (1 - tightening_ratio)；内存只随元素数缓慢增长
+
+import hashlib
+import io
+import math
+import struct
+
+
+class BloomFilter(object):
+    """
+    固定容量的Bloom filter；使用double hashing(h1 + i * h2)模拟k个hash functions
+    """
+    def __init__(self, capacity, error_rate, bits=None, count=0, bits_set=0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # m = -n * ln(p) / (ln2)^2, k = m / n * ln2
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / float(capacity) * math.log(2))))
+        self.bits = bits if bits is not None else bytearray((self.num_bits + 7) // 8)
+        self.count = count                                             # 已加入的元素数
+        self.bits_set = bits_set                                       # 值为1的bit数(用于fill ratio)
+
+    def _indexes(self, key):
+        digest = hashlib.md5(str(key).encode('utf-8')).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        for index in self._indexes(key):
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        """返回key之前是否(可能)已存在"""
+        bits = self.bits
+        seen = True
+        for index in self._indexes(key):
+            mask = 1 << (index & 7)
+            if not bits[index >> 3] & mask:
+                bits[index >> 3] |= mask
+                self.bits_set += 1
+                seen = False
+        if not seen:
+            self.count += 1
+        return seen
+
+    @property
+    def fill_ratio(self):
+        return self.bits_set / float(self.num_bits)
+
+
+class ScalableBloomFilter(object):
+    """
+    可无限扩展的Bloom filter；每个新filter的容量为前一个的growth倍，误判率为前一个的tightening_ratio倍；
+    snapshot(path)/load(path)将所有filter以二进制形式保存/载入
+    """
+    header_format = '<QdQQ'                                            # capacity, error_rate, count, bits_set
+
+    def __init__(self, initial_capacity=100000, error_rate=0.001, growth=2, tightening_ratio=0.5):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening_ratio = tightening_ratio
+        self.filters = []
+
+    def __contains__(self, key):
+        for f in reversed(self.filters):
+            if key in f:
+                return True
+        return False
+
+    def add(self, key):
+        """返回key之前是否(可能)已存在"""
+        if key in self:
+            return True
+        if not self.filters or self.filters[-1].count >= self.filters[-1].capacity:
+            self._add_filter()
+        self.filters[-1].add(key)
+        return False
+
+    def _add_filter(self):
+        n = len(self.filters)
+        capacity = self.initial_capacity * (self.growth ** n)
+        error_rate = self.error_rate * (1 - self.tightening_ratio) * (self.tightening_ratio ** n)
+        self.filters.append(BloomFilter(capacity, error_rate))
+
+    def __len__(self):
+        return sum(f.count for f in self.filters)
+
+    @property
+    def num_bytes(self):
+        return sum(len(f.bits) for f in self.filters)
+
+    @property
+    def fill_ratio(self):
+        """所有filter的整体bit占用率"""
+        total_bits = sum(f.num_bits for f in self.filters)
+        if not total_bits:
+            return 0.0
+        return sum(f.bits_set for f in self.filters) / float(total_bits)
+
+    def snapshot(self, path):
+        with open(path, 'wb') as f:
+            self._write(f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls._read(f)
+
+    def to_bytes(self):
+        """与snapshot相同的二进制形式(checkpoint用)"""
+        f = io.BytesIO()
+        self._write(f)
+        return f.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls._read(io.BytesIO(data))
+
+    def _write(self, f):
+        f.write(struct.pack('<QdQd', self.initial_capacity, self.error_rate, self.growth, self.tightening_ratio))
+        f.write(struct.pack('<Q', len(self.filters)))
+        for bf in self.filters:
+            f.write(struct.pack(self.header_format, bf.capacity, bf.error_rate, bf.count, bf.bits_set))
+            f.write(bf.bits)
+
+    @classmethod
+    def _read(cls, f):
+        initial_capacity, error_rate, growth, tightening_ratio = struct.unpack('<QdQd', f.read(32))
+        sbf = cls(initial_capacity, error_rate, growth, tightening_ratio)
+        num_filters, = struct.unpack('<Q', f.read(8))
+        header_size = struct.calcsize(cls.header_format)
+        for _ in range(num_filters):
+            capacity, bf_error_rate, count, bits_set = struct.unpack(cls.header_format, f.read(header_size))
+            bf = BloomFilter(capacity, bf_error_rate, count=count, bits_set=bits_set)
+            bf.bits = bytearray(f.read(len(bf.bits)))
+            sbf.filters.append(bf)
+        return sbf
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# crawl checkpoint: 每隔CHECKPOINT_INTERVAL秒将 未完成的requests(frontier)、dupefilter的seen subject ids、
+# pipelines的dedupe状态 及 尚未持久化的items 写入CHECKPOINT_DIR/checkpoint；重启后从checkpoint继续
+#
+# 与JOBDIR不同，不pickle Request objects: subject页面只保存subject id和priority(array)，
+# 其余页面(首页、top250 index页面)保存(url, callback名称, priority, source)；整个checkpoint以zlib压缩，
+# 先写入临时文件、fsync后rename，crash时总是保留上一个完整的checkpoint
+
+import array
+import logging
+import os
+import pickle
+import time
+import zlib
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Request
+from twisted.internet import task, threads
+from doubanmovie.utils import get_subject_id
+
+CHECKPOINT_FILE = 'checkpoint'
+CHECKPOINT_VERSION = 1
+
+_loaded = {}                                                                # path -> (mtime, state)
+
+
+def checkpoint_path(settings):
+    checkpoint_dir = settings.get('CHECKPOINT_DIR')
+    return os.path.join(checkpoint_dir, CHECKPOINT_FILE) if checkpoint_dir else None
+
+
+def load_checkpoint(settings):
+    """
+    返回最近一次checkpoint的state(dict)；没有checkpoint 或 CHECKPOINT_RESUME为False时返回None；
+    spider、dupefilter和pipelines各自取用其中的部分，同一个文件只读取一次
+    """
+    path = checkpoint_path(settings)
+    if not path or not settings.getbool('CHECKPOINT_RESUME', True) or not os.path.exists(path):
+        return None
+    mtime = os.path.getmtime(path)
+    if path not in _loaded or _loaded[path][0] != mtime:
+        start = time.time()
+        with open(path, 'rb') as f:
+            state = pickle.loads(zlib.decompress(f.read()))
+        if state.get('version') != CHECKPOINT_VERSION:
+            logging.warning('Ignoring checkpoint %s with unknown version %s' % (path, state.get('version')))
+            state = None
+        else:
+            logging.info('Checkpoint loaded from %s in %.2fs' % (path, time.time() - start))
+        _loaded[path] = (mtime, state)
+    return _loaded[path][1]
+
+
+def _array_to_bytes(a):
+    return a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+
+
+def _array_from_bytes(typecode, data):
+    a = array.array(typecode)
+    if hasattr(a, 'frombytes'):
+        a.frombytes(data)
+    else:
+        a.fromstring(data)
+    return a
+
+
+def write_checkpoint(path, state):
+    """state(pickled bytes)以zlib压缩后原子写入: 临时文件 -> fsync -> rename；返回写入的bytes数"""
+    data = zlib.compress(state, 1)                                          # level 1已足够(bitmap大部分为0)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    if os.name == 'nt' and os.path.exists(path):                          # Windows上rename不能覆盖已有文件
+        os.remove(path)
+    os.rename(tmp_path, path)
+    return len(data)
+
+
+def restore_requests(spider, state):
+    """
+    由checkpoint中的frontier重建requests(dont_filter: 这些subject ids已在restore后的dupefilter中)，
+    再重新抓取checkpoint时尚未持久化的items的页面(state['replay']，不在frontier中的)
+    """
+    frontier = state['frontier']
+    subject_ids = _array_from_bytes('i', frontier['subject_ids'])
+    priorities = _array_from_bytes('i', frontier['priorities'])
+    for subject_id, priority in zip(subject_ids, priorities):
+        yield Request('https://movie.douban.com/subject/%d/' % subject_id, callback=spider.parse, priority=priority,
+                      dont_filter=True, meta={'source': 'checkpoint'})
+    for url, callback, priority, source in frontier['other']:
+        yield Request(url, callback=getattr(spider, callback) if callback else None, priority=priority,
+                      dont_filter=True, meta={'source': source})
+    restored = set(subject_ids)
+    for url in sorted(set(state['replay'])):                                  # 多个pipelines可能报告同一个url
+        if get_subject_id(url) in restored:
+            continue
+        yield Request(url, callback=spider.parse, dont_filter=True, meta={'source': 'checkpoint'})
+
+
+class CrawlCheckpoint(object):
+    """
+    定期写入checkpoint的extension(CHECKPOINT_DIR为None时不启用)：
+    - frontier: 已schedule但还没有收到response的requests(request_scheduled/request_dropped/response_received signals)，
+      加上engine正在处理的requests；只保存重建request所需的最少信息
+    - dupefilter、pipelines: 提供checkpoint_state()的components各自返回可pickle的state
+    - 尚未持久化的items: 提供checkpoint_pending_urls()的pipelines返回仍在buffer中(或正在写入)的item urls；
+      resume时这些页面重新抓取，FilterDuplicatePipeline放行它们各一次
+    spider正常结束(reason为'finished')时删除checkpoint；其他原因关闭时写入最后一个checkpoint
+    """
+    def __init__(self, crawler):
+        self.path = checkpoint_path(crawler.settings)
+        if not self.path:
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.interval = crawler.settings.getfloat('CHECKPOINT_INTERVAL', 60)
+        self.pending = {}                                                       # key -> [entry, count]
+        self.loop = None
+        self.writing = None
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(self.request_scheduled, signal=signals.request_scheduled)
+        crawler.signals.connect(self.request_done, signal=signals.request_dropped)
+        crawler.signals.connect(self.response_received, signal=signals.response_received)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        checkpoint_dir = os.path.dirname(self.path)
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        self.loop = task.LoopingCall(self.checkpoint, spider)
+        self.loop.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        state = None if reason == 'finished' else self._snapshot(spider)
+        if self.writing is not None:                                            # 等待写入中的checkpoint，避免其覆盖最后的结果
+            d, self.writing = self.writing, None
+            d.addBoth(lambda _: self._close(state))
+            return d
+        self._close(state)
+
+    def _close(self, state):
+        """spider正常结束时删除checkpoint，否则同步写入最后一个checkpoint"""
+        if state is None:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        else:
+            write_checkpoint(self.path, state)
+
+    def _key(self, request):
+        subject_id = get_subject_id(request.url)
+        return subject_id if subject_id is not None else request.url
+
+    def _entry(self, request, spider):
+        callback = request.callback
+        name = callback.__name__ if callback is not None and getattr(callback, '__self__', None) is spider else None
+        return request.url, name, request.priority, request.meta.get('source')
+
+    def request_scheduled(self, request, spider):
+        # 同一subject的重复request会被dupefilter drop掉(request_dropped)，以计数避免提前删除
+        key = self._key(request)
+        if key in self.pending:
+            self.pending[key][1] += 1
+        else:
+            self.pending[key] = [self._entry(request, spider), 1]
+
+    def request_done(self, request, spider):
+        key = self._key(request)
+        if key in self.pending:
+            self.pending[key][1] -= 1
+            if self.pending[key][1] <= 0:
+                del self.pending[key]
+
+    def response_received(self, response, request, spider):
+        self.request_done(request, spider)
+
+    def checkpoint(self, spider):
+        """在reactor thread中取得一致的snapshot，压缩和写入在thread pool中执行"""
+        if self.writing is not None:                                            # 上一个checkpoint还在写入
+            return
+        start = time.time()
+        self.writing = threads.deferToThread(write_checkpoint, self.path, self._snapshot(spider))
+        self.writing.addCallback(self._written, start)
+        self.writing.addErrback(self._failed)
+
+    def _written(self, size, start):
+        self.writing = None
+        self.stats.inc_value('checkpoint/writes')
+        self.stats.set_value('checkpoint/bytes', size)
+        self.stats.set_value('checkpoint/duration_ms', int((time.time() - start) * 1000))
+
+    def _failed(self, failure):
+        self.writing = None
+        logging.error('*** Checkpoint write failed: %s ***' % failure.getErrorMessage())
+
+    def _snapshot(self, spider):
+        engine = self.crawler.engine
+        entries = dict((key, value[0]) for key, value in self.pending.items())
+        slot = getattr(engine, 'slot', None) or getattr(engine, '_slot', None)
+        for request in getattr(slot, 'inprogress', ()):                        # 已取出、正在下载或parse的requests
+            entries.setdefault(self._key(request), self._entry(request, spider))
+
+        subject_ids, priorities, other = array.array('i'), array.array('i'), []      # subject id < 2^31
+        for key, (url, callback, priority, source) in entries.items():
+            if isinstance(key, int) and callback == 'parse':
+                subject_ids.append(key)
+                priorities.append(priority)
+            else:
+                other.append((url, callback, priority, source))
+
+        state = {
+            'version': CHECKPOINT_VERSION,
+            'created': time.time(),
+            'frontier': {'subject_ids': _array_to_bytes(subject_ids), 'priorities': _array_to_bytes(priorities),
+                         'other': other},
+            'pipelines': {},
+            'replay': [],
+        }
+        dupefilter = getattr(getattr(slot, 'scheduler', None), 'df', None)
+        if hasattr(dupefilter, 'checkpoint_state'):
+            state['dupefilter'] = dupefilter.checkpoint_state()
+        for pipeline in engine.scraper.itemproc.middlewares:
+            if hasattr(pipeline, 'checkpoint_state'):
+                state['pipelines'][type(pipeline).__name__] = pipeline.checkpoint_state()
+            if hasattr(pipeline, 'checkpoint_pending_urls'):
+                state['replay'].extend(pipeline.checkpoint_pending_urls())
+        self.stats.set_value('checkpoint/frontier', len(entries))
+        self.stats.set_value('checkpoint/replay', len(state['replay']))
+        return pickle.dumps(state, 2)                                           # 只有plain types和bytes
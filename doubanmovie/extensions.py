@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+# 自定义的scrapy extensions
+
+import bisect
+import inspect
+import logging
+import re
+import time
+import types
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import defer, reactor, task
+from doubanmovie.utils import is_banned_response
+
+
+class AdaptiveThrottle(object):
+    """
+    代替固定的DOWNLOAD_DELAY(及AutoThrottle)，按每个downloader slot的情况调整delay:
+    - 被ban(403/429，或302跳转至验证码页面): delay乘以ADAPTIVE_THROTTLE_BACKOFF(backoff event)；
+      被ban时的delay(加20%)成为该slot的delay下限(floor)
+    - 正常的200 response: delay向 max(latency / ADAPTIVE_THROTTLE_TARGET_CONCURRENCY, floor) 靠近；
+      连续ADAPTIVE_THROTTLE_PROBE_AFTER个正常response后floor乘以ADAPTIVE_THROTTLE_DECAY(试探更高的速率)
+    只调整delay: delay > 0(不低于ADAPTIVE_THROTTLE_MIN_DELAY)时downloader每个delay只发送一个request，
+    slot.concurrency不影响速率，因此不调整；
+    slot的key为request.meta['download_slot'](默认为domain；使用identity pool时每个identity一个slot)；
+    stats: throttle/<slot>/delay_ms、throttle/<slot>/rate_per_min、
+    throttle/backoff_events、throttle/bans/<identity>(identity为meta['identity_id'] 或 proxy 或 'direct')
+    """
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_THROTTLE_ENABLED'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.start_delay = settings.getfloat('ADAPTIVE_THROTTLE_START_DELAY', 3.0)
+        self.min_delay = settings.getfloat('ADAPTIVE_THROTTLE_MIN_DELAY', 0.5)
+        self.max_delay = settings.getfloat('ADAPTIVE_THROTTLE_MAX_DELAY', 60.0)
+        self.target_concurrency = settings.getfloat('ADAPTIVE_THROTTLE_TARGET_CONCURRENCY', 1.0)
+        self.backoff = settings.getfloat('ADAPTIVE_THROTTLE_BACKOFF', 2.0)
+        self.decay = settings.getfloat('ADAPTIVE_THROTTLE_DECAY', 0.9)
+        self.probe_after = settings.getint('ADAPTIVE_THROTTLE_PROBE_AFTER', 20)
+        self.ban_codes = set(settings.getlist('ADAPTIVE_THROTTLE_BAN_CODES') or [403, 429])
+        self.captcha_markers = settings.getlist('ADAPTIVE_THROTTLE_CAPTCHA_MARKERS') or \
+            ['sec.douban.com', 'captcha', '/misc/sorry']
+        self.debug = settings.getbool('ADAPTIVE_THROTTLE_DEBUG')
+        self.successes = {}                                                     # slot key -> 连续正常response数
+        self.floors = {}                                                        # slot key -> delay下限
+        crawler.signals.connect(self.response_downloaded, signal=signals.response_downloaded)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def response_downloaded(self, response, request, spider):
+        key = request.meta.get('download_slot')
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return
+        if key not in self.successes:                                           # 新的slot
+            self.successes[key] = 0
+            self.floors[key] = self.min_delay
+            slot.delay = max(slot.delay, self.start_delay)
+
+        if is_banned_response(response, self.ban_codes, self.captcha_markers):
+            self._backoff(key, slot, request)
+        elif response.status == 200:
+            latency = request.meta.get('download_latency')
+            if latency is not None:
+                self._adjust(key, slot, latency)
+
+        self.stats.set_value('throttle/%s/delay_ms' % key, int(slot.delay * 1000))
+        # delay > 0 时downloader每个delay只发送一个request
+        self.stats.set_value('throttle/%s/rate_per_min' % key, int(60 / max(slot.delay, 0.001)))
+
+    def _backoff(self, key, slot, request):
+        self.successes[key] = 0
+        self.floors[key] = min(self.max_delay, max(slot.delay * 1.2, self.floors[key]))
+        slot.delay = min(self.max_delay, max(slot.delay, self.min_delay) * self.backoff)
+        identity = request.meta.get('identity_id') or request.meta.get('proxy') or 'direct'
+        self.stats.inc_value('throttle/backoff_events')
+        self.stats.inc_value('throttle/bans/%s' % identity)
+        logging.info('*** Backoff on slot %s: delay %.2fs ***' % (key, slot.delay))
+
+    def _adjust(self, key, slot, latency):
+        """与AutoThrottle相同: delay向target delay靠近(但不低于floor)；另外周期性地试探更高的速率"""
+        self.successes[key] += 1
+        if self.successes[key] >= self.probe_after:
+            self.successes[key] = 0
+            self.floors[key] = max(self.min_delay, self.floors[key] * self.decay)
+        target_delay = max(latency / self.target_concurrency, self.floors[key])
+        new_delay = max(target_delay, (slot.delay + target_delay) / 2.0)
+        slot.delay = min(max(self.min_delay, new_delay), self.max_delay)
+        if self.debug:
+            logging.info('slot: %s | delay: %5d ms | latency: %5d ms' % (key, slot.delay * 1000, latency * 1000))
+
+
+class Histogram(object):
+    """latency histogram(秒)；buckets为各bucket的上限，最后一个bucket为+Inf"""
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """p(0-100)所在bucket的上限(不超过max)"""
+        rank = self.count * p / 100.0
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if count and cumulative >= rank:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return 0.0
+
+
+def _metrics_site(instrumentation):
+    """/metrics的twisted.web Site；twisted.web只在INSTRUMENTATION_PORT不为0时import"""
+    from twisted.web import resource, server
+
+    class MetricsResource(resource.Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+            return instrumentation.render_metrics().encode('utf-8')
+    return server.Site(MetricsResource())
+
+
+class Instrumentation(object):
+    """
+    hot path的instrumentation(throughput下降时区分是download delay、parse还是pipelines/数据库跟不上):
+    - INSTRUMENTATION_CALLBACKS中各spider callback的latency histogram(generator callback计入每次next()的时间，
+      返回coroutine的callback(PARSE_POOL_SIZE > 0时的parse)计入至coroutine完成的时间，返回deferred时同上)
+    - 各pipeline的process_item的latency histogram(返回deferred时计入至deferred fire的时间)
+    - 每INSTRUMENTATION_INTERVAL秒采样: scheduler、downloader(active/queued)、scraper的queue depth，
+      adbapi(MysqlPipeline.dbpool)和reactor thread pool的pending interactions；
+      queue/*/max为各次采样中的最大值(比interval短的峰值可能漏掉)
+    - item_dropped的原因(DropItem message中 'from url'/'with url' 之前的部分)
+    INSTRUMENTATION_PORT不为0时在 http://INSTRUMENTATION_HOST:INSTRUMENTATION_PORT/metrics 提供Prometheus text format；
+    spider关闭时摘要写入stats(instrumentation/...)
+    """
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('INSTRUMENTATION_ENABLED'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.callback_names = settings.getlist('INSTRUMENTATION_CALLBACKS') or \
+            ['parse', 'parse_front_page', 'parse_top250_index_page']
+        self.interval = settings.getfloat('INSTRUMENTATION_INTERVAL', 0.5)
+        self.host = settings.get('INSTRUMENTATION_HOST', '127.0.0.1')
+        self.port = settings.getint('INSTRUMENTATION_PORT', 9410)
+        self.callbacks = {}                                                     # callback name -> Histogram
+        self.pipelines = {}                                                     # pipeline class name -> Histogram
+        self.queues = {}                                                        # queue name -> 最近一次采样值
+        self.queues_max = {}
+        self.dropped = {}                                                       # drop reason -> count
+        self.sampler = None
+        self.listener = None
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(self.item_dropped, signal=signals.item_dropped)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        for name in self.callback_names:
+            if hasattr(spider, name):
+                self._instrument_callback(spider, name)
+        self._instrument_pipelines()
+        self.sampler = task.LoopingCall(self.sample)
+        self.sampler.start(self.interval, now=True)
+        if self.port:
+            self.listener = reactor.listenTCP(self.port, _metrics_site(self), interface=self.host)
+            logging.info('Instrumentation metrics on http://%s:%d/metrics' % (self.host, self.port))
+
+    def spider_closed(self, spider):
+        if self.sampler is not None and self.sampler.running:
+            self.sampler.stop()
+        if self.listener is not None:
+            self.listener.stopListening()
+        for kind, histograms in (('callback', self.callbacks), ('pipeline', self.pipelines)):
+            for name, histogram in histograms.items():
+                prefix = 'instrumentation/%s/%s/' % (kind, name)
+                self.stats.set_value(prefix + 'count', histogram.count)
+                self.stats.set_value(prefix + 'p50_ms', round(histogram.percentile(50) * 1000, 2))
+                self.stats.set_value(prefix + 'p99_ms', round(histogram.percentile(99) * 1000, 2))
+                self.stats.set_value(prefix + 'max_ms', round(histogram.max * 1000, 2))
+        for name, depth in self.queues_max.items():
+            self.stats.set_value('instrumentation/queue/%s/max' % name, depth)
+        for reason, count in self.dropped.items():
+            self.stats.set_value('instrumentation/dropped/%s' % reason, count)
+
+    def _instrument_callback(self, spider, name):
+        """以同名的bound method代替spider的callback(request serialization仍可按名称找回该method)"""
+        original = getattr(spider, name)
+        histogram = self.callbacks[name] = Histogram()
+        timed_iter, timed_coroutine = self._timed_iter, self._timed_coroutine
+
+        def timed(self, *args, **kwargs):
+            start = time.time()
+            result = original(*args, **kwargs)
+            if isinstance(result, defer.Deferred):
+                result.addBoth(_observe_deferred, histogram, start)
+            elif inspect.isgenerator(result):
+                return timed_iter(result, histogram, time.time() - start)
+            elif inspect.iscoroutine(result):
+                return timed_coroutine(result, histogram, start)
+            else:
+                histogram.observe(time.time() - start)
+            return result
+        timed.__name__ = name
+        setattr(spider, name, types.MethodType(timed, spider))
+
+    @staticmethod
+    def _timed_iter(iterator, histogram, elapsed):
+        """只计入generator中执行的时间(不包括engine处理yield出的requests/items的时间)"""
+        try:
+            while True:
+                start = time.time()
+                try:
+                    value = next(iterator)
+                finally:
+                    elapsed += time.time() - start
+                yield value
+        except StopIteration:
+            pass
+        finally:
+            histogram.observe(elapsed)
+
+    @staticmethod
+    async def _timed_coroutine(coroutine, histogram, start):
+        """计入至coroutine完成的时间(包括等待process pool的时间)"""
+        try:
+            return await coroutine
+        finally:
+            histogram.observe(time.time() - start)
+
+    def _instrument_pipelines(self):
+        """替换ItemPipelineManager中各pipeline的process_item(manager按list调用，不经过pipeline的attribute)"""
+        itemproc = self.crawler.engine.scraper.itemproc
+        methods = itemproc.methods['process_item']
+        for i, method in enumerate(list(methods)):
+            name = type(method.__self__).__name__
+            methods[i] = self._timed_process_item(method, self.pipelines.setdefault(name, Histogram()))
+
+    def _timed_process_item(self, method, histogram):
+        crawler = self.crawler
+
+        def process_item(item, spider=None):
+            start = time.time()
+            try:
+                result = method(item, spider or crawler.spider)
+            except Exception:
+                histogram.observe(time.time() - start)                          # DropItem等
+                raise
+            if isinstance(result, defer.Deferred):
+                result.addBoth(_observe_deferred, histogram, start)
+            else:
+                histogram.observe(time.time() - start)
+            return result
+        return process_item
+
+    def item_dropped(self, item, response, exception, spider):
+        message = re.split(r' (?:from|with) url', str(exception), 1)[0].strip()
+        reason = re.sub(r'[^0-9A-Za-z]+', '_', message).strip('_').lower() or 'unknown'
+        self.dropped[reason] = self.dropped.get(reason, 0) + 1
+
+    def sample(self):
+        """采样各queue depth(取不到的queue忽略)"""
+        engine = self.crawler.engine
+        slot = getattr(engine, 'slot', None) or getattr(engine, '_slot', None)
+        depths = {}
+        if slot is not None and slot.scheduler is not None:
+            depths['scheduler'] = len(slot.scheduler)
+        downloader = engine.downloader
+        depths['downloader_active'] = len(downloader.active)
+        depths['downloader_queued'] = sum(len(s.queue) for s in downloader.slots.values())
+        scraper_slot = engine.scraper.slot
+        if scraper_slot is not None:
+            depths['scraper'] = len(scraper_slot.queue) + len(scraper_slot.active)
+        for pipeline in engine.scraper.itemproc.middlewares:
+            dbpool = getattr(pipeline, 'dbpool', None)
+            if dbpool is not None and dbpool.threadpool is not None:
+                depths['adbapi'] = _threadpool_pending(dbpool.threadpool)
+        depths['reactor_threadpool'] = _threadpool_pending(reactor.getThreadPool())
+        for name, depth in depths.items():
+            self.queues[name] = depth
+            self.queues_max[name] = max(depth, self.queues_max.get(name, 0))
+
+    def render_metrics(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for metric, label, histograms in (('doubanmovie_callback_seconds', 'callback', self.callbacks),
+                                          ('doubanmovie_pipeline_seconds', 'pipeline', self.pipelines)):
+            lines.append('# TYPE %s histogram' % metric)
+            for name, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{%s="%s",le="%s"} %d' % (metric, label, name, bound, cumulative))
+                lines.append('%s_sum{%s="%s"} %f' % (metric, label, name, histogram.sum))
+                lines.append('%s_count{%s="%s"} %d' % (metric, label, name, histogram.count))
+        lines.append('# TYPE doubanmovie_queue_depth gauge')
+        for name, depth in sorted(self.queues.items()):
+            lines.append('doubanmovie_queue_depth{queue="%s"} %d' % (name, depth))
+        lines.append('# TYPE doubanmovie_items_dropped_total counter')
+        for reason, count in sorted(self.dropped.items()):
+            lines.append('doubanmovie_items_dropped_total{reason="%s"} %d' % (reason, count))
+        lines.append('# TYPE doubanmovie_stat gauge')
+        for key, value in sorted(self.stats.get_stats().items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append('doubanmovie_stat{key="%s"} %s' % (key.replace('"', "'"), value))
+        return '\n'.join(lines) + '\n'
+
+
+def _observe_deferred(result, histogram, start):
+    histogram.observe(time.time() - start)
+    return result
+
+
+def _threadpool_pending(threadpool):
+    """twisted ThreadPool中正在执行和排队中的任务数"""
+    queue = getattr(threadpool, '_queue', None) or getattr(threadpool, 'q', None)
+    return len(threadpool.working) + (queue.qsize() if queue is not None else 0)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# 豆瓣电影页面的single-pass extractor:
+# 先遍历一次document取得所需的几个id节点(#content, #info, #interest_sectl, #mainpic, #recommendations)，
+# 再在这些较小的subtree上执行预编译的lxml.etree.XPath；避免每个field都从document root开始 '//*[@id=...]' 扫描
+# 取得的values与原先ItemLoader.add_xpath(...)取得的list相同，仍交由DoubanmovieItem的processors处理
+
+from lxml import etree, html
+
+_ids = ('content', 'info', 'interest_sectl', 'mainpic', 'recommendations')
+_fields = ('title', 'year', 'country', 'genre', 'language', 'length', 'director', 'actors', 'score', 'image_url',
+           'director_ids', 'actor_ids')
+
+# smart_strings=False: 返回普通string，不保留对整个tree的引用
+_title = etree.XPath("h1/span[@property='v:itemreviewed']/text()", smart_strings=False)
+_year = etree.XPath("h1/span[@class='year']/text()", smart_strings=False)
+# 'following-sibling::text()[1]' 取得位于span之后的（同缩进的）单独一行string，比'following::text()[1]'开销小
+_info_line = etree.XPath("span[@class='pl' and text()=$label]/following-sibling::text()[1]", smart_strings=False)
+_genre = etree.XPath(".//span[@property='v:genre']/text()", smart_strings=False)
+_length = etree.XPath("span[@property='v:runtime']/text()", smart_strings=False)
+_director = etree.XPath("span[1]/span[@class='attrs']//a/text()", smart_strings=False)
+_actors = etree.XPath("span[@class='actor']/span[@class='attrs']/a/text()", smart_strings=False)
+# 与_director/_actors相同的<a>节点的href('/celebrity/<id>/')，顺序一一对应
+_director_links = etree.XPath("span[1]/span[@class='attrs']//a/@href", smart_strings=False)
+_actor_links = etree.XPath("span[@class='actor']/span[@class='attrs']/a/@href", smart_strings=False)
+_score = etree.XPath(".//strong[@property='v:average']/text()", smart_strings=False)
+_image_url = etree.XPath("a/img/@src", smart_strings=False)
+_recommendation_urls = etree.XPath("div[@class='recommendations-bd']/dl/dd/a/@href", smart_strings=False)
+
+
+def _find_id_nodes(root):
+    """遍历一次document，取得_ids中的节点；全部取得后提前结束"""
+    nodes = {}
+    for element in root.iter():
+        element_id = element.get('id')
+        if element_id in _ids and element_id not in nodes:
+            if element_id == 'content' and element.tag != 'div':        # 与原xpath "//div[@id='content']" 一致
+                continue
+            nodes[element_id] = element
+            if len(nodes) == len(_ids):
+                break
+    return nodes
+
+
+def _apply(xpath, node, **variables):
+    if node is None:
+        return []
+    return xpath(node, **variables)
+
+
+def extract_movie_page(root):
+    """
+    parse一个具体豆瓣电影的页面(root为lxml root element，e.g. response.selector.root)；
+    返回(fields, recommendation_urls)；fields为 {field: [values]}，与原先各add_xpath取得的list一致
+    """
+    nodes = _find_id_nodes(root)
+    content = nodes.get('content')
+    info = nodes.get('info')
+    fields = {
+        'title': _apply(_title, content),
+        'year': _apply(_year, content),
+        'country': _apply(_info_line, info, label=u'制片国家/地区:'),
+        'genre': _apply(_genre, info),
+        'language': _apply(_info_line, info, label=u'语言:'),
+        'length': _apply(_length, info),
+        'director': _apply(_director, info),
+        'actors': _apply(_actors, info),
+        'score': _apply(_score, nodes.get('interest_sectl')),
+        'image_url': _apply(_image_url, nodes.get('mainpic')),             # 电影海报图片链接
+        'director_ids': _apply(_director_links, info),
+        'actor_ids': _apply(_actor_links, info),
+    }
+    return fields, _apply(_recommendation_urls, nodes.get('recommendations'))
+
+
+def probe_missing_markers(body, markers):
+    """
+    在构造lxml tree之前的byte-level probe: 返回body(bytes)中没有出现的markers；
+    e.g. 影视剧、短片没有'v:runtime'，'页面不存在'没有'v:itemreviewed'，这些页面一定会被DropEmptyItemPipeline drop掉
+    """
+    return [marker for marker in markers if marker not in body]
+
+
+def extract_recommendation_urls(root):
+    """只取得电影页面中的recommendation links(页面未改变、不需要parse item时使用)"""
+    return _apply(_recommendation_urls, _find_id_nodes(root).get('recommendations'))
+
+
+def extract_movie_page_from_bytes(body, encoding='utf-8'):
+    """
+    由response body(bytes)构造lxml tree后extract；供ParsePool的worker process调用，
+    只传入bytes，返回的也只是plain list/dict(可pickle)
+    """
+    parser = html.HTMLParser(recover=True, encoding=encoding)
+    root = etree.fromstring(body, parser=parser)
+    if root is None:                                                     # 空白页面
+        return dict((field, []) for field in _fields), []
+    return extract_movie_page(root)
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+# 分布式crawl: 多个node共享同一个request queue(frontier) 和 同一个seen-set，均存于Redis
+#   <spider>:queue               待抓取的requests(list; LPUSH入队, RPOPLPUSH claim)
+#   <spider>:processing:<node>   node已claim、尚未ack的requests(list)
+#   <spider>:seen_subjects       已入队的subject id(bitmap; SETBIT)
+#   <spider>:seen_fingerprints   非subject页面的request fingerprint(set; SADD)
+#   <spider>:nodes               所有node id(set)
+#   <spider>:heartbeat:<node>    node的heartbeat(key with TTL)；过期的node视为已退出，其processing中的requests重新入队
+#   <spider>:stats:<node>        per-node stats(hash)
+# 每个node仍使用自己的DOWNLOAD_DELAY；各node应使用不同的出口IP
+# request在callback处理完response之后才ack(FrontierAckMiddleware)，node在parse途中退出时request会重新入队
+
+import logging
+import os
+import pickle
+import socket
+from collections import defaultdict, deque
+
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.utils.request import request_from_dict
+from twisted.internet import task
+from doubanmovie.utils import get_subject_id
+
+_fake_servers = {}                                                              # FRONTIER_REDIS_URL -> FakeRedis
+
+
+class FakeRedis(object):
+    """
+    测试用的in-process stand-in，只实现RedisScheduler用到的commands(单进程内有效)；
+    同一process中FRONTIER_REDIS_URL相同的crawlers(nodes)共用一个instance(from_url)
+    """
+    @classmethod
+    def from_url(cls, url):
+        if url not in _fake_servers:
+            _fake_servers[url] = cls()
+        return _fake_servers[url]
+
+    def __init__(self):
+        self.lists = defaultdict(deque)
+        self.sets = defaultdict(set)
+        self.hashes = defaultdict(lambda: defaultdict(int))
+        self.strings = {}
+
+    def lpush(self, key, value):
+        self.lists[key].appendleft(value)
+        return len(self.lists[key])
+
+    def rpoplpush(self, src, dst):
+        if not self.lists[src]:
+            return None
+        value = self.lists[src].pop()
+        self.lists[dst].appendleft(value)
+        return value
+
+    def lrem(self, key, count, value):
+        try:
+            self.lists[key].remove(value)
+            return 1
+        except ValueError:
+            return 0
+
+    def llen(self, key):
+        return len(self.lists[key])
+
+    def setbit(self, key, offset, value):
+        bits = self.sets[key]
+        old = 1 if offset in bits else 0
+        if value:
+            bits.add(offset)
+        else:
+            bits.discard(offset)
+        return old
+
+    def sadd(self, key, value):
+        if value in self.sets[key]:
+            return 0
+        self.sets[key].add(value)
+        return 1
+
+    def srem(self, key, value):
+        self.sets[key].discard(value)
+
+    def smembers(self, key):
+        return set(self.sets[key])
+
+    def set(self, key, value, ex=None):
+        self.strings[key] = value                                               # in-process: 不会过期
+
+    def exists(self, key):
+        return key in self.strings
+
+    def hincrby(self, key, field, amount=1):
+        self.hashes[key][field] += amount
+        return self.hashes[key][field]
+
+    def delete(self, *keys):
+        for key in keys:
+            for store in (self.lists, self.sets, self.hashes, self.strings):
+                store.pop(key, None)
+
+    def keys(self, pattern):
+        prefix = pattern.rstrip('*')
+        names = set(self.lists) | set(self.sets) | set(self.hashes) | set(self.strings)
+        return [name for name in names if name.startswith(prefix)]
+
+
+class RedisScheduler(object):
+    """
+    SCHEDULER: requests存于共享的Redis queue，claim(RPOPLPUSH)与ack(LREM)均为atomic操作；
+    FRONTIER_REDIS_URL = 'fake://...' 时使用FakeRedis(同一process中URL相同的nodes共用)；
+    本node的queue为空时，只要其他node仍有requests或processing中的requests，spider就不会关闭；
+    request由FrontierAckMiddleware在callback完成后(或下载失败时)ack
+    """
+    def __init__(self, server, node_id, heartbeat_interval, flush_on_start, stats, fingerprinter):
+        self.server = server
+        self.node_id = node_id
+        self.heartbeat_interval = heartbeat_interval
+        self.flush_on_start = flush_on_start
+        self.stats = stats
+        self.fingerprinter = fingerprinter
+        self.heartbeat_loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        url = settings.get('FRONTIER_REDIS_URL', 'redis://localhost:6379/0')
+        if url.startswith('fake://'):
+            server = FakeRedis.from_url(url)
+        else:
+            import redis
+            server = redis.StrictRedis.from_url(url)
+        node_id = settings.get('FRONTIER_NODE_ID') or '%s-%d' % (socket.gethostname(), os.getpid())
+        scheduler = cls(server, node_id, settings.getfloat('FRONTIER_HEARTBEAT_INTERVAL', 10),
+                        settings.getbool('FRONTIER_FLUSH_ON_START'), crawler.stats, crawler.request_fingerprinter)
+        crawler.signals.connect(scheduler.spider_idle, signal=signals.spider_idle)
+        return scheduler
+
+    def open(self, spider):
+        self.spider = spider
+        prefix = spider.name
+        self.queue_key = '%s:queue' % prefix
+        self.processing_key = '%s:processing:%s' % (prefix, self.node_id)
+        self.nodes_key = '%s:nodes' % prefix
+        self.node_stats_key = '%s:stats:%s' % (prefix, self.node_id)
+        if self.flush_on_start:
+            keys = self.server.keys('%s:*' % prefix)
+            if keys:
+                self.server.delete(*keys)
+        self.server.sadd(self.nodes_key, self.node_id)
+        self.heartbeat_loop = task.LoopingCall(self.heartbeat)
+        self.heartbeat_loop.start(self.heartbeat_interval)
+
+    def close(self, reason):
+        if self.heartbeat_loop is not None and self.heartbeat_loop.running:
+            self.heartbeat_loop.stop()
+        self._requeue(self.node_id)                                             # 未ack的requests交给其他node
+        self.server.srem(self.nodes_key, self.node_id)
+
+    def __len__(self):
+        return self.server.llen(self.queue_key)
+
+    def has_pending_requests(self):
+        return len(self) > 0
+
+    def enqueue_request(self, request):
+        # redirect/retry产生的request会带有原request的payload: 原request视为已完成
+        self.ack(request)
+        if not request.dont_filter and self._seen(request):
+            return False
+        self.server.lpush(self.queue_key, pickle.dumps(request.to_dict(spider=self.spider), protocol=2))
+        self._inc_stats('enqueued')
+        return True
+
+    def next_request(self):
+        payload = self.server.rpoplpush(self.queue_key, self.processing_key)  # atomic claim
+        if payload is None:
+            return None
+        request = request_from_dict(pickle.loads(payload), spider=self.spider)
+        request.meta['frontier_payload'] = payload
+        self._inc_stats('claimed')
+        return request
+
+    def ack(self, request):
+        """FrontierAckMiddleware调用: 从processing list中删除该request"""
+        payload = request.meta.pop('frontier_payload', None)
+        if payload is not None and self.server.lrem(self.processing_key, 1, payload):
+            self._inc_stats('acked')
+
+    def heartbeat(self):
+        """刷新本node的heartbeat，并将heartbeat已过期的node的requests重新入队"""
+        prefix = self.spider.name
+        self.server.set('%s:heartbeat:%s' % (prefix, self.node_id), 1, ex=int(self.heartbeat_interval * 3))
+        for node_id in self.server.smembers(self.nodes_key):
+            if not isinstance(node_id, str):
+                node_id = node_id.decode('utf-8')
+            if node_id != self.node_id and not self.server.exists('%s:heartbeat:%s' % (prefix, node_id)):
+                logging.info('*** Node %s is dead, requeueing its requests ***' % node_id)
+                self._requeue(node_id)
+                self.server.srem(self.nodes_key, node_id)
+
+    def spider_idle(self, spider):
+        """其他node仍有工作时不关闭spider(之后可能产生新的requests)"""
+        if len(self) > 0:
+            raise DontCloseSpider
+        for node_id in self.server.smembers(self.nodes_key):
+            if not isinstance(node_id, str):
+                node_id = node_id.decode('utf-8')
+            if self.server.llen('%s:processing:%s' % (spider.name, node_id)):
+                raise DontCloseSpider
+
+    def _seen(self, request):
+        """subject页面以SETBIT(返回旧值)、其他页面以SADD做atomic的check-and-set"""
+        subject_id = get_subject_id(request.url)
+        if subject_id is not None:
+            return bool(self.server.setbit('%s:seen_subjects' % self.spider.name, subject_id, 1))
+        return not self.server.sadd('%s:seen_fingerprints' % self.spider.name,
+                                    self.fingerprinter.fingerprint(request).hex())
+
+    def _requeue(self, node_id):
+        processing_key = '%s:processing:%s' % (self.spider.name, node_id)
+        while self.server.rpoplpush(processing_key, self.queue_key) is not None:
+            self._inc_stats('requeued')
+
+    def _inc_stats(self, name):
+        self.stats.inc_value('frontier/%s' % name)
+        self.server.hincrby(self.node_stats_key, name, 1)
+
+
+class FrontierAckMiddleware(object):
+    """
+    同时作为downloader middleware 和 spider middleware启用:
+    spider middleware: callback处理完response(产生的requests已入队，items已交给pipelines)或出错后ack；
+    downloader middleware: 下载失败(response不会到达spider)的request也要从processing list中删除
+    """
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def _ack(self, request):
+        scheduler = self.crawler.engine.scheduler
+        if isinstance(scheduler, RedisScheduler):
+            scheduler.ack(request)
+
+    def process_exception(self, request, exception, spider=None):
+        self._ack(request)
+
+    def process_spider_output(self, response, result, spider=None):
+        try:
+            for r in result:
+                yield r
+        finally:
+            self._ack(response.request)
+
+    async def process_spider_output_async(self, response, result, spider=None):
+        try:
+            async for r in result:
+                yield r
+        finally:
+            self._ack(response.request)
+
+    def process_spider_exception(self, response, exception, spider=None):
+        self._ack(response.request)
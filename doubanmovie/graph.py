@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# recommendation graph: 电影页面'喜欢这部电影的人也喜欢'(#recommendations)的 subject -> subject edges
+# GRAPH_DIR/edges: append-only的int32 pairs(native byte order)，离线分析可直接读取，
+#     e.g. numpy.fromfile('edges', dtype='i4').reshape(-1, 2)；python -m doubanmovie.graph export导出为TSV
+# GRAPH_DIR/sources: 已记录edges的subject ids(SubjectIdBitmap)，同一页面的recommendations只记录一次
+# GRAPH_DIR/scores: in-degree 和 PageRank scores(增量更新)；scores最高的subjects作为下一次crawl的seeds
+
+import argparse
+import array
+import logging
+import os
+import pickle
+import time
+import zlib
+
+from doubanmovie.bitmap import SubjectIdBitmap
+from doubanmovie.checkpoint import write_checkpoint
+
+EDGES_FILE = 'edges'
+SOURCES_FILE = 'sources'
+SCORES_FILE = 'scores'
+EDGE_BYTES = 8                                                              # 两个int32
+
+
+class RecommendationGraph(object):
+    """
+    edge store: add(source, targets)的edges先缓存在内存中(array)，满buffer_size条 及 close时append到edges文件；
+    edges写入之后才标记source(crash时未写入的source在下一次crawl中重新记录，不会遗漏也不会重复)
+    """
+    def __init__(self, graph_dir, buffer_size=10000):
+        if not os.path.exists(graph_dir):
+            os.makedirs(graph_dir)
+        self.edges_path = os.path.join(graph_dir, EDGES_FILE)
+        self.sources = SubjectIdBitmap(os.path.join(graph_dir, SOURCES_FILE))
+        self.buffer_size = buffer_size
+        self.buffer = array.array('i')                                       # src, dst, src, dst, ...
+        self.pending_sources = set()
+
+    def add(self, source, targets):
+        """记录source页面的recommendations(subject ids)；返回新记录的edges数(source已记录过时为0)"""
+        if source is None or source in self.sources or source in self.pending_sources:
+            return 0
+        self.pending_sources.add(source)
+        seen = set([source])                                                   # 去除self-loop和重复的link
+        for target in targets:
+            if target is not None and target not in seen:
+                seen.add(target)
+                self.buffer.append(source)
+                self.buffer.append(target)
+        if len(self.buffer) >= 2 * self.buffer_size:
+            self.flush()
+        return len(seen) - 1
+
+    def flush(self):
+        if self.buffer:
+            with open(self.edges_path, 'ab') as f:
+                self.buffer.tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+            self.buffer = array.array('i')
+        self.sources.update(self.pending_sources)
+        self.sources.flush()
+        self.pending_sources = set()
+
+    def close(self):
+        self.flush()
+        self.sources.close()
+
+
+def num_edges(graph_dir):
+    path = os.path.join(graph_dir, EDGES_FILE)
+    return os.path.getsize(path) // EDGE_BYTES if os.path.exists(path) else 0
+
+
+def read_edges(graph_dir, start=0):
+    """返回第start条之后的所有edges(array('i')，src, dst交替)"""
+    edges = array.array('i')
+    count = num_edges(graph_dir) - start
+    if count > 0:
+        with open(os.path.join(graph_dir, EDGES_FILE), 'rb') as f:
+            f.seek(start * EDGE_BYTES)
+            edges.fromfile(f, 2 * count)
+    return edges
+
+
+def pagerank(edges, damping=0.85, tol=1e-6, max_iterations=100, initial=None):
+    """
+    edges: array('i')(src, dst交替)；返回({subject_id: score}, iterations)，scores之和为1；
+    initial: 上一次的scores(warm start)，图中只增加了少量edges时几个iterations即可收敛；
+    没有out-edges的nodes(尚未抓取的subjects)的score平均分配给所有nodes
+    """
+    index, nodes = {}, []
+    src, dst = array.array('i'), array.array('i')
+    for i in range(0, len(edges), 2):
+        for node in (edges[i], edges[i + 1]):
+            if node not in index:
+                index[node] = len(nodes)
+                nodes.append(node)
+        src.append(index[edges[i]])
+        dst.append(index[edges[i + 1]])
+    n = len(nodes)
+    if not n:
+        return {}, 0
+
+    out_degree = array.array('i', [0]) * n
+    for s in src:
+        out_degree[s] += 1
+    if initial:
+        rank = [initial.get(node, 1.0 / n) for node in nodes]
+        total = sum(rank)
+        rank = [r / total for r in rank]
+    else:
+        rank = [1.0 / n] * n
+
+    iterations, delta = 0, 0.0
+    for iterations in range(1, max_iterations + 1):
+        dangling = sum(r for r, degree in zip(rank, out_degree) if not degree)
+        new_rank = [(1 - damping + damping * dangling) / n] * n
+        share = [damping * r / degree if degree else 0.0 for r, degree in zip(rank, out_degree)]
+        for s, t in zip(src, dst):
+            new_rank[t] += share[s]
+        delta = sum(abs(a - b) for a, b in zip(new_rank, rank))
+        rank = new_rank
+        if delta < tol:
+            break
+    if delta >= tol:
+        logging.warning('PageRank did not converge in %d iterations (delta %.3g > tol %.3g)' % (iterations, delta, tol))
+    return dict(zip(nodes, rank)), iterations
+
+
+def load_scores(graph_dir):
+    """上一次update_scores的结果: {'edges': 已计入的edges数, 'indegree': {...}, 'pagerank': {...}, 'updated': ...}"""
+    path = os.path.join(graph_dir, SCORES_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return pickle.loads(zlib.decompress(f.read()))
+
+
+def update_scores(graph_dir, damping=0.85, tol=1e-6, max_iterations=100):
+    """
+    增量更新scores: in-degree只累加上一次之后append的edges；PageRank以上一次的scores为初始值重新迭代；
+    结果原子写入GRAPH_DIR/scores
+    """
+    start = time.time()
+    state = load_scores(graph_dir) or {'edges': 0, 'indegree': {}, 'pagerank': {}}
+    new_edges = read_edges(graph_dir, state['edges'])
+    indegree = state['indegree']
+    for i in range(1, len(new_edges), 2):
+        indegree[new_edges[i]] = indegree.get(new_edges[i], 0) + 1
+    edges = read_edges(graph_dir)
+    ranks, iterations = pagerank(edges, damping, tol, max_iterations, state['pagerank'])
+    state = {'edges': len(edges) // 2, 'indegree': indegree, 'pagerank': ranks, 'updated': time.time()}
+    write_checkpoint(os.path.join(graph_dir, SCORES_FILE), pickle.dumps(state, 2))
+    logging.info('Graph scores updated: %d nodes, %d edges (%d new), %d PageRank iterations in %.2fs' % (
+        len(ranks), state['edges'], len(new_edges) // 2, iterations, time.time() - start))
+    return state
+
+
+def top_subjects(graph_dir, n, metric='pagerank'):
+    """scores(metric: 'pagerank' 或 'indegree')最高的n个subjects: [(subject_id, score)]，由高到低"""
+    state = load_scores(graph_dir)
+    if state is None:
+        return []
+    scores = state[metric]
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:n]
+
+
+def export_edges(graph_dir, path):
+    """以TSV(source_subject_id \t target_subject_id)导出所有edges；返回edges数"""
+    edges = read_edges(graph_dir)
+    with open(path, 'w') as f:
+        for i in range(0, len(edges), 2):
+            f.write('%d\t%d\n' % (edges[i], edges[i + 1]))
+    return len(edges) // 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description='recommendation graph: 更新scores、查看seeds、导出edges')
+    parser.add_argument('graph_dir', help='GRAPH_DIR')
+    subparsers = parser.add_subparsers(dest='command')
+    scores = subparsers.add_parser('scores', help='增量更新in-degree和PageRank scores')
+    scores.add_argument('--damping', type=float, default=0.85)
+    scores.add_argument('--tol', type=float, default=1e-6, help='收敛的阈值(两次iteration之差的L1 norm)')
+    scores.add_argument('--max-iterations', type=int, default=100)
+    top = subparsers.add_parser('top', help='scores最高的subjects')
+    top.add_argument('-n', type=int, default=20)
+    top.add_argument('--metric', choices=('pagerank', 'indegree'), default='pagerank')
+    export = subparsers.add_parser('export', help='以TSV导出edges')
+    export.add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'scores':
+        state = update_scores(args.graph_dir, args.damping, args.tol, args.max_iterations)
+        print('%d nodes, %d edges' % (len(state['pagerank']), state['edges']))
+    elif args.command == 'top':
+        for subject_id, score in top_subjects(args.graph_dir, args.n, args.metric):
+            print('%d\t%s' % (subject_id, score))
+    elif args.command == 'export':
+        print('%d edges exported to %s' % (export_edges(args.graph_dir, args.path), args.path))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
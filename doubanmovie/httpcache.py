@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# 以SQLite为storage的http cache；配合scrapy.extensions.httpcache.RFC2616Policy发送conditional requests
+# (If-None-Match / If-Modified-Since)，页面未改变时不再parse item、不再写入MySQL/MongoDB；
+# 电影页面的recommendation subject ids与cached response一起保存，页面未改变时spider不需要再parse页面
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+import zlib
+
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from doubanmovie.utils import get_subject_id
+
+# signal: spider parse电影页面后发送(request, subject_ids)，RevalidatingCacheMiddleware将ids写入cache
+recommendations_extracted = object()
+# signal: 页面未改变(不产生item)时spider发送(url, subject_id, crawled_at)，MysqlPipeline/MongodbPipeline更新抓取时间
+page_unchanged = object()
+
+
+def content_hash(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+class SqliteCacheStorage(object):
+    """
+    HTTPCACHE_STORAGE: 所有cached responses存于HTTPCACHE_DIR/<spider name>.sqlite的一个table中；
+    subject页面以subject id为key(同一部电影不同url参数只存一份)，其他页面以request fingerprint为key；
+    body以zlib压缩存储，并保存body的content hash；
+    recommendations: 该页面recommendation的subject ids(','分隔；NULL为未记录)，body的content hash改变时清除；
+    retrieve_response时放在request.meta['cached_recommendations']中
+    """
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+
+    def open_spider(self, spider):
+        self.db = sqlite3.connect(os.path.join(self.cachedir, '%s.sqlite' % spider.name))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS httpcache (key TEXT PRIMARY KEY, url TEXT, status INTEGER, "
+                        "headers BLOB, body BLOB, content_hash TEXT, timestamp REAL, recommendations TEXT)")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(httpcache)")]
+        if 'recommendations' not in columns:                                    # 旧版本创建的table
+            self.db.execute("ALTER TABLE httpcache ADD COLUMN recommendations TEXT")
+        self.db.commit()
+        self.fingerprinter = spider.crawler.request_fingerprinter
+
+    def close_spider(self, spider):
+        self.db.close()
+
+    def _key(self, request):
+        subject_id = get_subject_id(request.url)
+        if subject_id is None:
+            return self.fingerprinter.fingerprint(request).hex()
+        return 'subject:%d' % subject_id
+
+    def retrieve_response(self, spider, request):
+        row = self.db.execute("SELECT url, status, headers, body, timestamp, recommendations FROM httpcache "
+                              "WHERE key=?", (self._key(request),)).fetchone()
+        if row is None:
+            return None                                                         # not cached
+        url, status, headers, body, timestamp, recommendations = row
+        if 0 < self.expiration_secs < time.time() - timestamp:
+            return None                                                         # expired
+        if recommendations is not None:
+            request.meta['cached_recommendations'] = [int(x) for x in recommendations.split(',') if x]
+        headers = Headers(pickle.loads(bytes(headers)))
+        body = zlib.decompress(bytes(body))
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)   # 没有Content-Type时由body判断
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider, request, response):
+        # body未改变(304 revalidate、content hash相同)时保留已记录的recommendations
+        self.db.execute("INSERT INTO httpcache VALUES (?, ?, ?, ?, ?, ?, ?, NULL) ON CONFLICT(key) DO UPDATE SET "
+                        "url=excluded.url, status=excluded.status, headers=excluded.headers, body=excluded.body, "
+                        "timestamp=excluded.timestamp, recommendations=CASE WHEN "
+                        "content_hash=excluded.content_hash THEN recommendations END, "
+                        "content_hash=excluded.content_hash",
+                        (self._key(request), response.url, response.status,
+                         sqlite3.Binary(pickle.dumps(dict(response.headers), protocol=2)),
+                         sqlite3.Binary(zlib.compress(response.body)), content_hash(response.body), time.time()))
+        self.db.commit()
+
+    def store_recommendations(self, request, subject_ids):
+        """记录已cache页面的recommendation subject ids(页面未cache时不做任何事)"""
+        self.db.execute("UPDATE httpcache SET recommendations=? WHERE key=?",
+                        (','.join(str(subject_id) for subject_id in subject_ids), self._key(request)))
+        self.db.commit()
+
+
+class RevalidatingCacheMiddleware(HttpCacheMiddleware):
+    """
+    在HttpCacheMiddleware的基础上，判断页面内容是否未改变:
+    (1) cached response仍fresh 或 revalidate得到304; (2) 重新下载的body与cached body的content hash相同；
+    未改变时设置response.meta['page_unchanged'] = True，spider只取recommendation links，不再产生item
+    (有response.meta['cached_recommendations']时不需要parse页面)；
+    spider发送的recommendations_extracted signal由storage记录；
+    stats: httpcache/bytes_saved(未重新下载的bytes)、httpcache/unchanged
+    """
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = super(RevalidatingCacheMiddleware, cls).from_crawler(crawler)
+        crawler.signals.connect(middleware.recommendations_extracted, signal=recommendations_extracted)
+        return middleware
+
+    def recommendations_extracted(self, request, subject_ids):
+        if request.meta.get('dont_cache', False) or not hasattr(self.storage, 'store_recommendations'):
+            return
+        self.storage.store_recommendations(request, subject_ids)
+
+    def process_response(self, request, response, spider=None):
+        cachedresponse = request.meta.get('cached_response')
+        result = super(RevalidatingCacheMiddleware, self).process_response(request, response)
+        if request.meta.get('dont_cache', False) or result.status != 200:
+            return result
+        if 'cached' in result.flags:
+            self.stats.inc_value('httpcache/bytes_saved', len(result.body))
+            request.meta['page_unchanged'] = True
+        elif cachedresponse is not None and content_hash(cachedresponse.body) == content_hash(result.body):
+            request.meta['page_unchanged'] = True
+        if request.meta.get('page_unchanged'):
+            self.stats.inc_value('httpcache/unchanged')
+        return result
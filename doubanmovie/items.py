@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 
+from collections.abc import MutableMapping
+
 import scrapy
+from itemadapter import ItemAdapter
+from itemadapter.adapter import DictAdapter
 from scrapy.loader.processors import MapCompose, TakeFirst
+from doubanmovie.utils import get_celebrity_id
 
 
 class DoubanmovieItem(scrapy.Item):
@@ -43,10 +48,19 @@ class DoubanmovieItem(scrapy.Item):
     score = scrapy.Field(
         output_processor=TakeFirst()
     )
+    # 与director/actors一一对应的person ids(由'/celebrity/<id>/' links取得；没有link的为None)
+    director_ids = scrapy.Field(
+        output_processor=lambda x: [get_celebrity_id(url) for url in x]
+    )
+    actor_ids = scrapy.Field(
+        input_processor=lambda x: x[:5] if len(x) > 5 else x,        # 与actors相同，取前5位
+        output_processor=lambda x: [get_celebrity_id(url) for url in x]
+    )
 
     image_url = scrapy.Field(
         output_processor=TakeFirst()
     )
+    image_path = scrapy.Field()                                      # 由PosterImagePipeline设置(poster的本地路径)
 
     # Housekeeping fields
     url = scrapy.Field(
@@ -69,3 +83,110 @@ class DoubanmovieItem(scrapy.Item):
     )
 
 
+def _take_first(values):
+    """与TakeFirst()相同: 返回第一个非None、非空string的value"""
+    for value in values:
+        if value is not None and value != '':
+            return value
+    return None
+
+
+def _join(values):
+    """与lambda x: ','.join(x)相同；list为空时field不设置(与ItemLoader一致)"""
+    return ','.join(values) if values else None
+
+
+def normalize_url(url):
+    """将url的格式标准化，统一形式为'https://movie.douban.com/subject/2129039/'"""
+    return '/'.join(url.split('/')[:-1]) + '/' if not url.endswith('/') else url
+
+
+class MovieRecord(MutableMapping):
+    """
+    DoubanmovieItem的轻量替代(__slots__，不经过ItemLoader和processors)，由build_movie_record构造；
+    不继承scrapy.item.BaseItem(其没有__slots__，instances会有__dict__)；MutableMapping的__slots__为()，
+    scraper将所有非Request的output交给pipelines，ItemAdapter由MovieRecordAdapter支持(feed exports等)；
+    提供pipelines所用的dict接口(item['url'], 'title' in item, dict(item), item.get(...))；
+    值为None的field视为未设置(与DoubanmovieItem中未取得的field相同)
+    """
+    __slots__ = ('title', 'year', 'country', 'genre', 'language', 'length', 'director', 'actors', 'score',
+                 'image_url', 'image_path', 'director_ids', 'actor_ids', 'url', 'project', 'spider', 'server', 'datetime')
+
+    def __init__(self, **kwargs):
+        for field in self.__slots__:
+            setattr(self, field, kwargs.get(field))
+
+    def __getitem__(self, field):
+        value = getattr(self, field, None) if field in self.__slots__ else None
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def __setitem__(self, field, value):
+        if field not in self.__slots__:
+            raise KeyError("MovieRecord does not support field: %s" % field)
+        setattr(self, field, value)
+
+    def __delitem__(self, field):
+        if field not in self:
+            raise KeyError(field)
+        setattr(self, field, None)
+
+    def __contains__(self, field):
+        return field in self.__slots__ and getattr(self, field) is not None
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None) if field in self.__slots__ else None
+        return default if value is None else value
+
+    def keys(self):
+        return [field for field in self.__slots__ if getattr(self, field) is not None]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return 'MovieRecord(%r)' % dict(self)
+
+
+class MovieRecordAdapter(DictAdapter):
+    """itemadapter对MovieRecord的支持(与dict相同的mapping接口)"""
+    @classmethod
+    def is_item(cls, item):
+        return isinstance(item, MovieRecord)
+
+    @classmethod
+    def is_item_class(cls, item_class):
+        return issubclass(item_class, MovieRecord)
+
+
+ItemAdapter.ADAPTER_CLASSES.appendleft(MovieRecordAdapter)
+
+
+def build_movie_record(fields, url, project=None, spider=None, server=None, datetime=None):
+    """
+    由extract_movie_page取得的fields({field: [values]})直接构造MovieRecord；
+    normalisations与DoubanmovieItem的processors相同
+    """
+    return MovieRecord(
+        title=_take_first(fields['title']),
+        year=_take_first([x[1:-1] for x in fields['year']]),              # 去除电影年份前后的括号
+        country=_join([x.replace('/', ',') for x in fields['country']]),
+        genre=_join(fields['genre']),
+        language=_join([x.replace('/', ',') for x in fields['language']]),
+        length=_take_first(fields['length']),
+        director=_join(fields['director']),
+        actors=_join(fields['actors'][:5]),                               # 取前5位actor
+        score=_take_first(fields['score']),
+        image_url=_take_first(fields['image_url']),
+        director_ids=[get_celebrity_id(url) for url in fields['director_ids']] or None,
+        actor_ids=[get_celebrity_id(url) for url in fields['actor_ids'][:5]] or None,
+        url=normalize_url(url),
+        project=project,
+        spider=spider,
+        server=server,
+        datetime=datetime,
+    )
@@ -2,18 +2,35 @@
 
 import logging
 import random
+import time
+from collections import defaultdict
+try:
+    from Queue import Queue                                                         # Python 2
+except ImportError:
+    from queue import Queue
+from scrapy import signals
 from scrapy.downloadermiddlewares.useragent import UserAgentMiddleware
-from scrapy.utils.project import get_project_settings                               # To get settings from settings.py
+from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse, Request
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+from doubanmovie.bitmap import SubjectIdBitmap
+from doubanmovie.utils import get_subject_id, is_banned_response, load_stored_subject_ids
 
 
 class RandomUserAgentMiddleware(UserAgentMiddleware):
     """
     从user_agent_list中随机抽取一个 作为request的user_agent
     """
-    def __init__(self, user_agent=''):
+    def __init__(self, user_agent='', user_agent_list=None):
         self.user_agent = user_agent
-        settings = get_project_settings()
-        self.user_agent_list = settings.get('USER_AGENT_LIST')
+        self.user_agent_list = user_agent_list
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls(crawler.settings.get('USER_AGENT'), crawler.settings.get('USER_AGENT_LIST'))
+        crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
+        return middleware
 
     def process_request(self, request, spider):
         ua = random.choice(self.user_agent_list)
@@ -21,3 +38,291 @@ class RandomUserAgentMiddleware(UserAgentMiddleware):
             request.headers.setdefault('User-Agent', ua)
             #logging.info('***[User Agent] %s ***' % ua)
 
+
+class Identity(object):
+    """identity pool中的一个identity: proxy + User-Agent + headers，及其health统计"""
+    def __init__(self, identity_id, proxy, user_agent, headers):
+        self.identity_id = identity_id
+        self.proxy = proxy
+        self.user_agent = user_agent
+        self.headers = headers
+        self.successes = 0
+        self.failures = 0
+        self.bans = 0
+        self.consecutive_bans = 0                                               # 上次正常response后被ban的次数
+        self.latency = None                                                     # download latency的EWMA(秒)
+        self.quarantined_until = 0
+
+    @property
+    def score(self):
+        """success rate(Laplace平滑) / (1 + latency)"""
+        success_rate = (self.successes + 1.0) / (self.successes + self.failures + self.bans + 2.0)
+        return success_rate / (1.0 + (self.latency or 0))
+
+
+class IdentityPoolMiddleware(object):
+    """
+    每个request使用identity pool中的一个identity(proxy + User-Agent + headers)；
+    每个identity使用自己的downloader slot(request.meta['download_slot'])，各自的delay(由DOWNLOAD_DELAY 或
+    AdaptiveThrottle决定)，总速率随pool大小增长；
+    按score(success rate、latency)加权随机选择identity；被ban(403/429/验证码)的identity被quarantine
+    IDENTITY_QUARANTINE_SECS秒(连续被ban时加倍)；
+    IDENTITY_PROXIES为proxy的list(None表示直连)；IDENTITY_HEADER_SETS为额外headers的list；User-Agent取自USER_AGENT_LIST
+    """
+    def __init__(self, settings, stats):
+        proxies = settings.getlist('IDENTITY_PROXIES')
+        if not proxies:
+            raise NotConfigured
+        user_agents = settings.getlist('USER_AGENT_LIST')
+        header_sets = settings.get('IDENTITY_HEADER_SETS') or [{}]
+        self.identities = [Identity('identity%d' % i, proxy, user_agents[i % len(user_agents)],
+                                    header_sets[i % len(header_sets)])
+                           for i, proxy in enumerate(proxies)]
+        self.quarantine_secs = settings.getfloat('IDENTITY_QUARANTINE_SECS', 300)
+        self.ban_codes = set(settings.getlist('ADAPTIVE_THROTTLE_BAN_CODES') or [403, 429])
+        self.captcha_markers = settings.getlist('ADAPTIVE_THROTTLE_CAPTCHA_MARKERS') or \
+            ['sec.douban.com', 'captcha', '/misc/sorry']
+        self.stats = stats
+        self.by_id = dict((identity.identity_id, identity) for identity in self.identities)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings, crawler.stats)
+
+    def process_request(self, request, spider):
+        identity = self.by_id.get(request.meta.get('identity_id'))
+        if identity is None or identity.quarantined_until > time.time():       # retry时换一个identity
+            identity = self.choose()
+        request.meta['identity_id'] = identity.identity_id
+        request.meta['download_slot'] = identity.identity_id
+        if identity.proxy:
+            request.meta['proxy'] = identity.proxy
+        else:
+            request.meta.pop('proxy', None)
+        request.headers['User-Agent'] = identity.user_agent                     # 直接覆盖(不是setdefault)
+        for key, value in identity.headers.items():
+            request.headers[key] = value
+
+    def choose(self):
+        """在未被quarantine的identities中按score加权随机选择；全部被quarantine时选最早解除的"""
+        now = time.time()
+        available = [identity for identity in self.identities if identity.quarantined_until <= now]
+        if not available:
+            return min(self.identities, key=lambda identity: identity.quarantined_until)
+        total = sum(identity.score for identity in available)
+        r = random.uniform(0, total)
+        for identity in available:
+            r -= identity.score
+            if r <= 0:
+                return identity
+        return available[-1]
+
+    def process_response(self, request, response, spider):
+        identity = self.by_id.get(request.meta.get('identity_id'))
+        if identity is None:
+            return response
+        if is_banned_response(response, self.ban_codes, self.captcha_markers):
+            identity.bans += 1
+            identity.consecutive_bans += 1
+            # 连续被ban时quarantine时间加倍
+            quarantine = self.quarantine_secs * (2 ** min(identity.consecutive_bans - 1, 5))
+            identity.quarantined_until = time.time() + quarantine
+            self.stats.inc_value('identity/%s/bans' % identity.identity_id)
+            self.stats.inc_value('identity/quarantined')
+            logging.info('*** Identity %s quarantined for %ds ***' % (identity.identity_id, quarantine))
+        elif response.status < 400:
+            identity.successes += 1
+            identity.consecutive_bans = 0
+            latency = request.meta.get('download_latency')
+            if latency is not None:
+                identity.latency = latency if identity.latency is None else 0.8 * identity.latency + 0.2 * latency
+            self.stats.inc_value('identity/%s/successes' % identity.identity_id)
+        else:
+            identity.failures += 1
+        self.stats.set_value('identity/%s/score' % identity.identity_id, round(identity.score, 3))
+        return response
+
+    def process_exception(self, request, exception, spider):
+        identity = self.by_id.get(request.meta.get('identity_id'))
+        if identity is not None:
+            identity.failures += 1
+            self.stats.inc_value('identity/%s/failures' % identity.identity_id)
+
+
+class StubBrowser(object):
+    """
+    测试用的headless browser stand-in: 不执行Javascript，page_source为本地HTML文件的内容
+    """
+    def __init__(self, html_file):
+        self.html_file = html_file
+        self.current_url = None
+        self.page_source = None
+
+    def get(self, url):
+        self.current_url = url
+        with open(self.html_file, 'rb') as f:
+            self.page_source = f.read().decode('utf-8')
+
+    def quit(self):
+        pass
+
+
+class BrowserPoolMiddleware(object):
+    """
+    request.meta['render_js'] = True 的request由pool中常驻的headless browser(PhantomJS)渲染，返回HtmlResponse；
+    request.meta['render_wait_for']: 等待该class name的元素出现(最多BROWSER_WAIT_TIMEOUT秒)；
+    BROWSER_POOL_SIZE个browser各由一个worker thread使用，不阻塞reactor；
+    每个browser渲染BROWSER_MAX_PAGES个页面后重建，使用前做health check(无响应则重建)；
+    BROWSER_STUB_FILE不为None时以StubBrowser(本地HTML文件)代替PhantomJS
+    """
+    def __init__(self, settings, stats):
+        self.pool_size = settings.getint('BROWSER_POOL_SIZE', 2)
+        self.max_pages = settings.getint('BROWSER_MAX_PAGES', 100)
+        self.wait_timeout = settings.getfloat('BROWSER_WAIT_TIMEOUT', 4)
+        self.phantomjs_path = settings.get('BROWSER_PHANTOMJS_PATH')
+        self.stub_file = settings.get('BROWSER_STUB_FILE')
+        self.headers = dict(settings.get('DEFAULT_REQUEST_HEADERS') or {})
+        self.headers['User-Agent'] = settings.get('USER_AGENT')
+        self.stats = stats
+        self.browsers = None                                                    # 第一个render_js request时才启动browsers
+        self.threadpool = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls(crawler.settings, crawler.stats)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def process_request(self, request, spider):
+        if not request.meta.get('render_js'):
+            return None
+        if self.browsers is None:
+            self._start()
+        return threads.deferToThreadPool(reactor, self.threadpool, self._render, request)
+
+    def spider_closed(self, spider):
+        if self.browsers is None:
+            return
+        self.threadpool.stop()
+        while not self.browsers.empty():
+            browser, pages = self.browsers.get()
+            self._quit(browser)
+
+    def _start(self):
+        self.browsers = Queue()                                                 # (browser, 已渲染的页面数)
+        for _ in range(self.pool_size):
+            self.browsers.put((self._new_browser(), 0))
+        self.threadpool = ThreadPool(minthreads=1, maxthreads=self.pool_size, name='BrowserPool')
+        self.threadpool.start()
+
+    def _new_browser(self):
+        self.stats.inc_value('browser_pool/started')
+        if self.stub_file:
+            return StubBrowser(self.stub_file)
+        from selenium import webdriver
+        # 复制一份DesiredCapabilities再设置custom headers，不修改全局的DesiredCapabilities
+        capabilities = dict(webdriver.DesiredCapabilities.PHANTOMJS)
+        for key, value in self.headers.items():
+            capabilities['phantomjs.page.customHeaders.{}'.format(key)] = value
+        return webdriver.PhantomJS(executable_path=self.phantomjs_path, desired_capabilities=capabilities)
+
+    def _quit(self, browser):
+        try:
+            browser.quit()
+        except Exception as e:
+            logging.warning('*** Failed to quit browser: %s ***' % e)
+
+    def _healthy(self, browser):
+        try:
+            browser.current_url
+            return True
+        except Exception:
+            return False
+
+    def _render(self, request):
+        """在worker thread中执行；无论成功与否browser都会放回pool"""
+        browser, pages = self.browsers.get()
+        try:
+            if pages >= self.max_pages or not self._healthy(browser):
+                self._quit(browser)
+                browser, pages = self._new_browser(), 0
+                self.stats.inc_value('browser_pool/recycled')
+            browser.get(request.url)
+            pages += 1
+            wait_for = request.meta.get('render_wait_for')
+            if wait_for and not self.stub_file:
+                self._wait(browser, wait_for)
+            body = browser.page_source.encode('utf-8')
+        except Exception:
+            pages = self.max_pages                                              # 出错的browser下次取出时重建
+            raise
+        finally:
+            self.browsers.put((browser, pages))
+        self.stats.inc_value('browser_pool/rendered')
+        return HtmlResponse(request.url, body=body, encoding='utf-8', request=request)
+
+    def _wait(self, browser, class_name):
+        from selenium.common.exceptions import TimeoutException
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions
+        from selenium.webdriver.support.ui import WebDriverWait
+        try:
+            WebDriverWait(browser, self.wait_timeout).until(
+                expected_conditions.visibility_of_element_located((By.CLASS_NAME, class_name)))
+        except TimeoutException:
+            # 超时仍返回当前已渲染的页面
+            self.stats.inc_value('browser_pool/wait_timeout')
+            logging.info('*** Timed out waiting for .%s: %s ***' % (class_name, browser.current_url))
+
+
+class FrontierPriorityMiddleware(object):
+    """
+    Spider middleware: 按request的expected value设置request.priority(scheduler优先处理priority高的request)；
+    score = 来源权重(request.meta['source']: front_page / top250 / recommendation)
+            - FRONTIER_DEPTH_WEIGHT * depth
+            + FRONTIER_INDEGREE_WEIGHT * min(in-degree, FRONTIER_INDEGREE_CAP)
+            - FRONTIER_STORED_PENALTY(subject id已存于数据库时)；
+    in-degree为该subject id至今被recommend的次数(request入队时的值)；
+    FRONTIER_STORED_BACKEND = 'mysql' 或 'mongodb' 时，启动时载入已保存的subject id
+    """
+    def __init__(self, settings):
+        self.source_weights = settings.getdict('FRONTIER_SOURCE_WEIGHTS') or \
+            {'front_page': 100, 'top250': 100, 'recommendation': 0}
+        self.depth_weight = settings.getint('FRONTIER_DEPTH_WEIGHT', 5)
+        self.indegree_weight = settings.getint('FRONTIER_INDEGREE_WEIGHT', 10)
+        self.indegree_cap = settings.getint('FRONTIER_INDEGREE_CAP', 5)
+        self.stored_penalty = settings.getint('FRONTIER_STORED_PENALTY', 50)
+        self.indegree = defaultdict(int)
+        self.stored = SubjectIdBitmap()
+        backend = settings.get('FRONTIER_STORED_BACKEND')
+        if backend:
+            self.stored.update(load_stored_subject_ids(settings, backend))
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings)
+
+    def process_spider_output(self, response, result, spider):
+        depth = response.meta.get('depth', 0) + 1
+        for r in result:
+            if isinstance(r, Request):
+                r.priority = self.score(r, depth)
+            yield r
+
+    async def process_spider_output_async(self, response, result, spider=None):
+        """与process_spider_output相同(callback为coroutine，如PARSE_POOL_SIZE > 0时)"""
+        depth = response.meta.get('depth', 0) + 1
+        async for r in result:
+            if isinstance(r, Request):
+                r.priority = self.score(r, depth)
+            yield r
+
+    def score(self, request, depth):
+        score = self.source_weights.get(request.meta.get('source'), 0) - self.depth_weight * depth
+        subject_id = get_subject_id(request.url)
+        if subject_id is not None:
+            self.indegree[subject_id] += 1
+            score += self.indegree_weight * min(self.indegree[subject_id], self.indegree_cap)
+            if subject_id in self.stored:
+                score -= self.stored_penalty
+        return score
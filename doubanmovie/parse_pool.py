@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# 将电影页面的parsing放到ProcessPoolExecutor中执行，reactor thread只负责I/O
+# worker只收到response body(bytes)，返回plain dict/list；item仍在reactor thread中由ItemLoader构造
+
+import time
+from concurrent.futures import ProcessPoolExecutor
+from twisted.internet import defer
+from doubanmovie.extractors import extract_movie_page_from_bytes
+
+
+class ParsePool(object):
+    """
+    submit(body, encoding)返回deferred，fire时的result为extract_movie_page的(fields, recommendation_urls)；
+    stats: parse_pool/queue_depth(当前等待+执行中的页面数)、parse_pool/latency_ms_*(提交到取得结果的时间)
+    """
+    def __init__(self, max_workers, stats):
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.stats = stats
+        self.queue_depth = 0
+
+    def submit(self, body, encoding):
+        from twisted.internet import reactor                                   # 在method中import，不在import时install reactor
+        d = defer.Deferred()
+        start = time.time()
+        future = self.executor.submit(extract_movie_page_from_bytes, body, encoding)
+        self.queue_depth += 1
+        self.stats.max_value('parse_pool/queue_depth_max', self.queue_depth)
+        # future的callback在executor的管理thread中执行，需回到reactor thread再fire deferred
+        future.add_done_callback(lambda f: reactor.callFromThread(self._done, f, d, start))
+        return d
+
+    def _done(self, future, d, start):
+        self.queue_depth -= 1
+        self.stats.set_value('parse_pool/queue_depth', self.queue_depth)
+        latency_ms = int((time.time() - start) * 1000)
+        self.stats.inc_value('parse_pool/pages')
+        self.stats.inc_value('parse_pool/latency_ms_total', latency_ms)
+        self.stats.max_value('parse_pool/latency_ms_max', latency_ms)
+        error = future.exception()
+        if error is not None:
+            d.errback(error)
+        else:
+            d.callback(future.result())
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -3,11 +3,32 @@
 # Item pipelines range: 0-1000. Items go through from lower valued to higher valued classes.
 # 如果scrapy需要运行多个间断的session，则需要自定义CustomRequestFilter和FilterDuplicatePipeline从数据库中获得已保存的item(url)
 
+import datetime
+import hashlib
+import io
 import logging
-import pymongo
-from scrapy.utils.project import get_project_settings     # To get settings from settings.py
+import os
+import tempfile
+import time
+from scrapy.http import Request
 from scrapy.exceptions import DropItem                    # 通过抛出DropItem exception来扔掉item,后续pipeline将不会收到被扔掉的item
-from twisted.enterprise import adbapi
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.defer import deferred_from_coro
+from twisted.internet import defer, task, threads
+from doubanmovie.bloomfilter import ScalableBloomFilter
+from doubanmovie.checkpoint import load_checkpoint
+from doubanmovie.httpcache import page_unchanged
+from doubanmovie.refresh import changed_fields
+from doubanmovie.schema import MONGODB_INDEXES, MYSQL_SCHEMA, create_mysql_schema, join_values, load_join_values, \
+    normalize_item, upsert_normalized
+from doubanmovie.utils import get_subject_id
+
+
+def record_refresh_stats(stats, changed):
+    """refresh模式下每个item写入后的stats: 有变化/无变化的items数，及各field的变化次数"""
+    stats.inc_value('refresh/updated' if changed else 'refresh/unchanged')
+    for field in changed:
+        stats.inc_value('refresh/changed_fields/%s' % field)
 
 
 class DropEmptyItemPipeline(object):
@@ -16,19 +37,20 @@ class DropEmptyItemPipeline(object):
     response.xpath("somexpath").extract() 若是xpath路径取不到，则返回为[]，不会有exception
     影视剧(非电影)、短片、极冷僻影片等 取到的length会为空(抓取的item没有length属性)；
     极冷僻的影片actors、genre或language也可能为空(抓取的item没有actors/genre/language属性)
+    所有pipelines均同时接受DoubanmovieItem 和 items.MovieRecord
     """
     # 若是只写入MongoDB，可放宽 或 不用DropEmptyItemPipeline；MongoDB collection没有固定structure
     def process_item(self, item, spider):
-        # scrapy.Item._values是一个底层的dict，用来实现item[key]=value
-        if not 'title' in item._values:
+        # 'field' in item: DoubanmovieItem(scrapy.Item)和MovieRecord中未设置的field均返回False
+        if 'title' not in item:
             raise DropItem("Item with empty field [Title] from url: %s\n" % item['url'])
-        elif not 'actors' in item._values:
+        elif 'actors' not in item:
             raise DropItem("Item with empty field [Actors] from url: %s\n" % item['url'])
-        elif not 'length' in item._values:
+        elif 'length' not in item:
             raise DropItem("Item with empty field [Length] from url: %s\n" % item['url'])
-        elif not 'genre' in item._values:
+        elif 'genre' not in item:
             raise DropItem("Item with empty field [Genre] from url: %s\n" % item['url'])
-        elif not 'language' in item._values:
+        elif 'language' not in item:
             raise DropItem("Item with empty field [Language] from url: %s\n" % item['url'])
         else:
             return item
@@ -36,12 +58,59 @@ class DropEmptyItemPipeline(object):
 
 class FilterDuplicatePipeline(object):
     """
-    通过标准化的url(当作id)来filer duplicate items
+    通过标准化的url(当作id)来filer duplicate items；
+    FILTER_DUPLICATE_BACKEND = 'bloom' 时以subject id为key存入ScalableBloomFilter，内存不随crawl规模线性增长
+    (误判率FILTER_DUPLICATE_ERROR_RATE)；FILTER_DUPLICATE_SNAPSHOT_PATH不为None时在close_spider保存，open_spider载入；
+    有checkpoint时restore items_seen，checkpoint时尚未持久化的items(replay)各放行一次
     """
-    def __init__(self):
-        self.items_seen = set()
+    def __init__(self, settings):
+        self.backend = settings.get('FILTER_DUPLICATE_BACKEND', 'set')
+        self.snapshot_path = settings.get('FILTER_DUPLICATE_SNAPSHOT_PATH')
+        state = load_checkpoint(settings)
+        checkpoint = state['pipelines'].get(type(self).__name__) if state else None
+        self.replay = set(state['replay']) if state else set()                 # checkpoint时尚未持久化的item urls
+        if checkpoint and checkpoint['backend'] == self.backend:
+            if self.backend == 'bloom':
+                self.items_seen = ScalableBloomFilter.from_bytes(checkpoint['items_seen'])
+            else:
+                self.items_seen = set(checkpoint['items_seen'])
+        elif self.backend == 'bloom':
+            if self.snapshot_path and os.path.exists(self.snapshot_path):
+                self.items_seen = ScalableBloomFilter.load(self.snapshot_path)
+            else:
+                self.items_seen = ScalableBloomFilter(settings.getint('FILTER_DUPLICATE_CAPACITY', 100000),
+                                                      settings.getfloat('FILTER_DUPLICATE_ERROR_RATE', 0.001))
+        else:
+            self.items_seen = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings)
+
+    def open_spider(self, spider):
+        self.stats = spider.crawler.stats
+
+    def close_spider(self, spider):
+        if self.backend == 'bloom':
+            self.stats.set_value('filter_duplicate/fill_ratio', self.items_seen.fill_ratio)
+            self.stats.set_value('filter_duplicate/bytes', self.items_seen.num_bytes)
+            self.stats.set_value('filter_duplicate/items', len(self.items_seen))
+            if self.snapshot_path:
+                self.items_seen.snapshot(self.snapshot_path)
+
+    def checkpoint_state(self):
+        items_seen = self.items_seen.to_bytes() if self.backend == 'bloom' else list(self.items_seen)
+        return {'backend': self.backend, 'items_seen': items_seen}
 
     def process_item(self, item, spider):
+        if item['url'] in self.replay:
+            self.replay.discard(item['url'])
+            return item
+        if self.backend == 'bloom':
+            key = get_subject_id(item['url']) or item['url']
+            if self.items_seen.add(key):
+                raise DropItem("Duplicate item with url: %s\n" % item['url'])
+            return item
         if item['url'] in self.items_seen:
             raise DropItem("Duplicate item with url: %s\n" % item['url'])
         else:
@@ -49,34 +118,328 @@ class FilterDuplicatePipeline(object):
             return item
 
 
+class PosterImagePipeline(object):
+    """
+    下载item['image_url']的poster，本地路径写入item['image_path'](相对于POSTER_STORE)，再交给MysqlPipeline/MongodbPipeline；
+    poster request经crawler的downloader(engine.download_async)下载，与页面共用downloader middlewares、download slots及其delay；
+    同时下载的posters不超过POSTER_CONCURRENCY个；item在poster完成(或失败)之前停在本pipeline；
+    以content hash(sha1)为文件名: full/<hash[:2]>/<hash>.jpg，内容相同的poster只保存一次(跨session有效)；
+    同一image_url只下载一次；hash、写入文件及生成缩略图(POSTER_THUMBS，需要Pillow)在thread pool中执行，不阻塞reactor；
+    下载失败的item不drop，只是没有image_path；POSTER_STORE为None时不启用
+    """
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.store = settings.get('POSTER_STORE')
+        if not self.store:
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.thumbs = settings.getdict('POSTER_THUMBS')                        # {name: (width, height)}
+        self.semaphore = defer.DeferredSemaphore(settings.getint('POSTER_CONCURRENCY', 4))
+        self.paths = {}                                                         # image_url -> (path, bytes)
+        self.fetching = {}                                                      # image_url -> 等待中的deferreds
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def open_spider(self, spider):
+        if self.thumbs:
+            from PIL import Image                                              # optional dependency
+            self.Image = Image
+        for directory in ['full'] + ['thumbs/%s' % name for name in self.thumbs]:
+            path = os.path.join(self.store, directory)
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+    def process_item(self, item, spider):
+        url = item.get('image_url')
+        if not url:
+            return item
+        if url in self.paths:
+            path, size = self.paths[url]
+            self.stats.inc_value('poster/url_dedup')
+            self.stats.inc_value('poster/dedup_bytes', size)                    # 不需要重新下载
+            item['image_path'] = path
+            return item
+
+        d = defer.Deferred()
+        d.addCallback(self._set_path, item)
+        if url in self.fetching:                                                # 同一poster正在下载
+            self.fetching[url].append(d)
+        else:
+            self.fetching[url] = [d]
+            fetch = self.semaphore.run(self._fetch, url)
+            fetch.addErrback(self._handle_error, url)
+            fetch.addBoth(self._fetch_done, url)
+        return d
+
+    def _fetch(self, url):
+        request = Request(url, headers={'Referer': 'https://movie.douban.com/'}, meta={'dont_cache': True})
+        d = deferred_from_coro(self.crawler.engine.download_async(request))
+        d.addCallback(self._store, url)
+        return d
+
+    def _store(self, response, url):
+        if response.status != 200:
+            raise ValueError('Poster download failed with status %d' % response.status)
+        self.stats.inc_value('poster/downloaded')
+        self.stats.inc_value('poster/bytes', len(response.body))
+        d = threads.deferToThread(self._persist, response.body)
+        d.addCallback(self._stored, len(response.body))
+        return d
+
+    def _persist(self, body):
+        """在worker thread中执行: 以content hash保存poster及其缩略图；返回(path, 是否为新的poster)"""
+        checksum = hashlib.sha1(body).hexdigest()
+        path = 'full/%s/%s.jpg' % (checksum[:2], checksum)
+        if os.path.exists(os.path.join(self.store, path)):
+            return path, False
+        if self.thumbs:
+            image = self.Image.open(io.BytesIO(body))
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            for name, size in self.thumbs.items():
+                thumb = image.copy()
+                thumb.thumbnail(tuple(size), self.Image.LANCZOS)
+                buf = io.BytesIO()
+                thumb.save(buf, 'JPEG')
+                self._write('thumbs/%s/%s/%s.jpg' % (name, checksum[:2], checksum), buf.getvalue())
+        self._write(path, body)                                                 # 最后写入: full poster存在即缩略图已完成
+        return path, True
+
+    def _write(self, path, data):
+        """
+        先写入同一directory中的临时文件再rename，其他consumers不会看到不完整的文件；
+        临时文件名唯一(mkstemp)，多个threads同时写入同一path时不会互相覆盖
+        """
+        full_path = os.path.join(self.store, path)
+        directory = os.path.dirname(full_path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:                                                     # 其他thread已创建
+                pass
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, full_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def _stored(self, result, size):
+        path, new = result
+        if new:
+            self.stats.inc_value('poster/stored')
+        else:
+            self.stats.inc_value('poster/content_dedup')
+            self.stats.inc_value('poster/dedup_bytes', size)                    # 不需要重复保存
+        return path, size
+
+    def _handle_error(self, error, url):
+        """do nothing, just log; item继续交给后续pipelines(没有image_path)"""
+        logging.warning('*** Poster download failed: %s: %s ***' % (url, error.getErrorMessage()))
+        self.stats.inc_value('poster/failed')
+        return None
+
+    def _fetch_done(self, result, url):
+        waiting = self.fetching.pop(url, [])
+        if result is not None:
+            self.paths[url] = result
+            self.stats.inc_value('poster/url_dedup', len(waiting) - 1)         # 等待同一下载的其他items
+            self.stats.inc_value('poster/dedup_bytes', result[1] * (len(waiting) - 1))
+        for d in waiting:
+            d.callback(result[0] if result is not None else None)
+
+    def _set_path(self, path, item):
+        if path is not None:
+            item['image_path'] = path
+        return item
+
+
+class BatchBuffer(object):
+    """
+    MysqlPipeline/MongodbPipeline batch模式共用的buffer: rows先缓存在内存中，满batch_size条、每隔interval秒、
+    以及close时交给write(rows)写入(write返回deferred，且自行处理errors)；
+    正在执行的writes数达到max_pending时，add返回deferred，直到有write完成engine才会继续处理该item(backpressure)；
+    max_pending为0时不形成backpressure(add总是返回item)
+    """
+    def __init__(self, write, batch_size, interval, max_pending, stats, stats_prefix):
+        self.write = write
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.stats = stats
+        self.stats_prefix = stats_prefix
+        self.buffer = []                                                        # 待写入的rows
+        self.flushes = {}                                                       # 正在执行的write deferred -> rows
+        self.waiters = []                                                       # 因backpressure等待中的process_item deferreds
+        self.loop = None
+
+    def start(self):
+        self.loop = task.LoopingCall(self.flush)                                # 按时间间隔flush
+        self.loop.start(self.interval, now=False)
+
+    def add(self, row, item):
+        """缓存row；返回item，或backpressure时返回fire为item的deferred"""
+        self.buffer.append(row)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        if 0 < self.max_pending <= len(self.flushes):
+            self.stats.inc_value('%s/backpressure_waits' % self.stats_prefix)
+            d = defer.Deferred()
+            d.addCallback(lambda _: item)
+            self.waiters.append(d)
+            return d
+        return item
+
+    def flush(self):
+        if not self.buffer:
+            return defer.succeed(None)
+        rows, self.buffer = self.buffer, []
+        d = self.write(rows)
+        self.flushes[d] = rows
+        d.addBoth(self._flush_done, d)
+        return d
+
+    def _flush_done(self, result, d):
+        self.flushes.pop(d, None)
+        # 释放因backpressure等待的items
+        while self.waiters and len(self.flushes) < self.max_pending:
+            self.waiters.pop(0).callback(None)
+
+    def close(self):
+        """停止LoopingCall并flush；返回所有writes完成时fire的deferred"""
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.flush()
+        return defer.DeferredList(list(self.flushes))
+
+    def pending(self):
+        """仍在buffer中或正在写入的rows(checkpoint用)"""
+        return self.buffer + [row for rows in self.flushes.values() for row in rows]
+
+
 class MysqlPipeline(object):
     """
     用twisted.enterprise.adbapi 将items存入mysql数据库
     Use the adbapi.ConnectionPool class to manage connections;
     Allows adbapi to use multiple connections, one per thread
+
+    MYSQL_BATCH_SIZE > 0 时启用batch模式: items先缓存在BatchBuffer中，满MYSQL_BATCH_SIZE条、
+    每隔MYSQL_BATCH_INTERVAL秒、以及close_spider时，以一条多行 INSERT ... ON DUPLICATE KEY UPDATE 写入；
+    batch模式依赖url(标准化的subject url)上的unique key(schema.LEGACY_MYSQL_SCHEMA)；已有的table以
+        python -m doubanmovie.schema
+    添加(schema.LEGACY_MYSQL_MIGRATIONS)；
+    正在执行的flush数达到MYSQL_MAX_PENDING_FLUSHES时，process_item返回deferred，对engine形成backpressure
+
+    NORMALIZED_SCHEMA = True 时写入schema.MYSQL_SCHEMA中的normalized tables(open_spider时创建tables及indexes)，
+    不写入douban_movie_scrapy；douban_movie_scrapy需有crawled_at column，open_spider时只检查(不ALTER)；
+    已有的table以 python -m doubanmovie.schema，或设置MYSQL_MIGRATE = True在open_spider时执行
+    尚未完成的migrations(schema.LEGACY_MYSQL_MIGRATIONS)
+
+    refresh模式(spider.refresh)下逐条比较数据库中的row，只UPDATE有变化的columns(及crawled_at)；
+    normalized schema的genres/countries/languages/directors/actors有变化时由upsert_normalized重写join tables；
+    页面未改变时(page_unchanged signal)只更新crawled_at，与batch模式相同地批量写入
     """
-    def __init__(self):
-        settings = get_project_settings()
+    legacy_columns = ('title', 'myear', 'country', 'genre', 'mlanguage', 'length', 'director', 'actors', 'score',
+                      'image_url', 'crawled_at', 'url')                        # 与_item_to_row的顺序一致
+    normalized_columns = (('title', 'title'), ('myear', 'year'), ('score', 'score'), ('runtime', 'runtime'),
+                          ('image_url', 'image_url'))                          # (column, normalized doc的key)
+    upsert_query = ("INSERT INTO douban_movie_scrapy (title, myear, country, genre, mlanguage, length, "
+                    "director, actors, score, image_url, crawled_at, url) "
+                    "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) "
+                    "ON DUPLICATE KEY UPDATE title=VALUES(title), myear=VALUES(myear), country=VALUES(country), "
+                    "genre=VALUES(genre), mlanguage=VALUES(mlanguage), length=VALUES(length), "
+                    "director=VALUES(director), actors=VALUES(actors), score=VALUES(score), "
+                    "image_url=VALUES(image_url), crawled_at=VALUES(crawled_at)")
+
+    def __init__(self, settings):
         self.mysql_host = settings.get('MYSQL_HOST')
         self.mysql_user = settings.get('MYSQL_USER')
         self.mysql_pass = settings.get('MYSQL_PASS')
         self.mysql_db = settings.get('MYSQL_DB')
+        self.batch_size = settings.getint('MYSQL_BATCH_SIZE', 0)              # 0: 逐条SELECT-then-INSERT(原有模式)
+        self.batch_interval = settings.getfloat('MYSQL_BATCH_INTERVAL', 5.0)
+        self.max_pending_flushes = settings.getint('MYSQL_MAX_PENDING_FLUSHES', 2)
+        self.normalized = settings.getbool('NORMALIZED_SCHEMA', False)
+        self.migrate = settings.getbool('MYSQL_MIGRATE', False)
+        self.batch = None                                                       # batch模式的BatchBuffer(rows为tuple或normalized docs)
+        self.touches = None                                                     # 未改变页面的(crawled_at, url或subject_id)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls(crawler.settings)
+        crawler.signals.connect(pipeline.page_unchanged, signal=page_unchanged)
+        return pipeline
 
     def open_spider(self, spider):
         """This method is called when the spider is opened"""
+        self.dbpool = self._connect()
+        self.stats = spider.crawler.stats
+        if self.batch_size > 0:
+            self.batch = BatchBuffer(self._write_batch, self.batch_size, self.batch_interval,
+                                     self.max_pending_flushes, self.stats, 'mysql')
+            self.batch.start()
+        self.touches = BatchBuffer(self._write_touches, max(self.batch_size, 1), self.batch_interval,
+                                   0, self.stats, 'mysql/touches')                # 没有等待的item，不需要backpressure
+        self.touches.start()
+        if self.normalized:
+            return self.dbpool.runInteraction(self._create_schema)              # engine等待tables创建完成
+        if self.migrate:
+            return self.dbpool.runInteraction(create_mysql_schema, False)
+        return self.dbpool.runInteraction(self._check_legacy_table)
+
+    def _connect(self):
+        """返回adbapi.ConnectionPool(benchmarks以本地stand-in代替)"""
+        from twisted.enterprise import adbapi                                  # 只在启用MysqlPipeline时import
         # twisted.enterprise.adbapi不需import相关mysql模组，只需列出 模组名称 和 该模组connect(...)中的args
-        self.dbpool = adbapi.ConnectionPool('pymysql', host=self.mysql_host, user=self.mysql_user,
-                                            password=self.mysql_pass, db=self.mysql_db, charset='utf8')
+        return adbapi.ConnectionPool('pymysql', host=self.mysql_host, user=self.mysql_user,
+                                     password=self.mysql_pass, db=self.mysql_db, charset='utf8')
+
+    def _create_schema(self, txn):
+        for statement in MYSQL_SCHEMA:
+            txn.execute(statement)
+
+    def _check_legacy_table(self, txn):
+        """douban_movie_scrapy尚没有crawled_at column(未migrate)时不开始crawl"""
+        try:
+            txn.execute("SELECT crawled_at FROM douban_movie_scrapy LIMIT 1")
+            txn.fetchall()
+        except self.dbpool.dbapi.OperationalError:
+            raise RuntimeError('douban_movie_scrapy has no crawled_at column: run "python -m doubanmovie.schema" '
+                               'or set MYSQL_MIGRATE = True')
 
     def close_spider(self, spider):
         """This method is called when the spider is closed"""
-        self.dbpool.close()
+        # 等待所有flush完成后再关闭connection pool
+        d = defer.DeferredList([self.batch.close() if self.batch is not None else defer.succeed(None),
+                                self.touches.close()])
+        d.addBoth(lambda _: self.dbpool.close())
+        return d
+
+    def page_unchanged(self, url, subject_id, crawled_at):
+        """页面未改变(不产生item): 只更新抓取时间，refresh模式不会再把它当作过期"""
+        self.touches.add((crawled_at, subject_id if self.normalized else url), None)
 
     def process_item(self, item, spider):
         """Run db query in thread pool"""
-        query = self.dbpool.runInteraction(self._conditional_insert, item)
-        query.addErrback(self._handle_error, item)                    # _handle_error called if any exception is raised
-        return item
+        if getattr(spider, 'refresh', False):
+            d = self.dbpool.runInteraction(self._update_changed, item)
+            d.addCallbacks(self._record_refresh, self._handle_error, errbackArgs=(item,))
+            d.addCallback(lambda _: item)
+            return d
+        if self.batch_size <= 0:
+            if self.normalized:
+                query = self.dbpool.runInteraction(upsert_normalized, [normalize_item(item)])
+            else:
+                query = self.dbpool.runInteraction(self._conditional_insert, item)
+            query.addErrback(self._handle_error, item)                # _handle_error called if any exception is raised
+            return item
+
+        return self.batch.add(normalize_item(item) if self.normalized else self._item_to_row(item), item)
 
     def _conditional_insert(self, txn, item):
         """Create record if doesn't exist"""
@@ -84,51 +447,513 @@ class MysqlPipeline(object):
         txn.execute("SELECT * FROM douban_movie_scrapy WHERE title=%s AND myear=%s", (item['title'], item['year']))
         if txn.rowcount == 0:
             txn.execute("INSERT INTO douban_movie_scrapy (title, myear, country, genre, mlanguage, length, "
-                        "director, actors, score, image_url, url) "
-                        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                        "director, actors, score, image_url, crawled_at, url) "
+                        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
                         (item['title'], item['year'], item['country'], item['genre'], item['language'], item['length'],
-                         item['director'], item['actors'], item['score'], item['image_url'], item['url']))
+                         item['director'], item['actors'], item['score'], item['image_url'], item.get('datetime'),
+                         item['url']))
             # txn对象执行INSERT语句之后 无需 普通数据库连接的conn.commit()语句
             logging.info('Item stored to MySQL with url %s.' % item['url'])
         else:
             logging.info('Item already in MySQL with url %s.' % item['url'])
 
+    def _update_changed(self, txn, item):
+        """refresh模式: 只UPDATE有变化的columns；数据库中没有该电影时insert；返回有变化的columns"""
+        if self.normalized:
+            doc = normalize_item(item)
+            new = dict((column, doc[key]) for column, key in self.normalized_columns)
+            txn.execute("SELECT %s FROM movie WHERE subject_id=%%s" % ', '.join(new), (doc['subject_id'],))
+            stored = txn.fetchone()
+            if stored is None:
+                upsert_normalized(txn, [doc])
+                return new
+            changed = changed_fields(dict(zip(new, stored)), new)
+            changed.update(changed_fields(load_join_values(txn, doc['subject_id']), join_values(doc)))
+            if len(changed) > len(set(changed) & set(new)):                     # join tables有变化: 整部电影重写
+                upsert_normalized(txn, [doc])
+                return changed
+            assignments = ['%s=%%s' % column for column in changed] + ['crawled_at=%s']
+            txn.execute("UPDATE movie SET %s WHERE subject_id=%%s" % ', '.join(assignments),
+                        list(changed.values()) + [doc['crawled_at'], doc['subject_id']])
+            return changed
+
+        new = dict(zip(self.legacy_columns, self._item_to_row(item)))
+        txn.execute("SELECT %s FROM douban_movie_scrapy WHERE url=%%s" % ', '.join(new), (item['url'],))
+        stored = txn.fetchone()
+        if stored is None:
+            self._conditional_insert(txn, item)
+            return new
+        changed = changed_fields(dict(zip(new, stored)), new)
+        assignments = ['%s=%%s' % column for column in changed] + ['crawled_at=%s']   # 抓取时间总是更新
+        txn.execute("UPDATE douban_movie_scrapy SET %s WHERE url=%%s" % ', '.join(assignments),
+                    list(changed.values()) + [new['crawled_at'], item['url']])
+        return changed
+
+    def _record_refresh(self, changed):
+        record_refresh_stats(self.stats, changed)
+
+    def checkpoint_pending_urls(self):
+        """仍在buffer中或正在写入的items的url(checkpoint用)"""
+        rows = self.batch.pending() if self.batch is not None else []
+        return [row['url'] if self.normalized else row[-1] for row in rows]
+
+    def _item_to_row(self, item):
+        """
+        item -> 与upsert_query中columns顺序一致的tuple；
+        optional fields(e.g. 尚未有评分的电影没有score)以None(NULL)写入，不在process_item中raise KeyError
+        """
+        return (item.get('title'), item.get('year'), item.get('country'), item.get('genre'), item.get('language'),
+                item.get('length'), item.get('director'), item.get('actors'), item.get('score'),
+                item.get('image_url'), item.get('datetime'), item['url'])
+
+    def _write_batch(self, rows):
+        """BatchBuffer的write: 将rows交给thread pool，以一条多行upsert写入"""
+        d = self.dbpool.runInteraction(upsert_normalized if self.normalized else self._upsert_batch, rows)
+        d.addCallbacks(self._batch_done, self._handle_batch_error, errbackArgs=(rows,))
+        return d
+
+    def _upsert_batch(self, txn, rows):
+        """pymysql的executemany会将 INSERT ... VALUES 合并为一条多行语句"""
+        txn.executemany(self.upsert_query, rows)
+        logging.info('%d items upserted to MySQL.' % len(rows))
+        return len(rows)
+
+    def _batch_done(self, result):
+        self.stats.inc_value('mysql/batches_flushed')
+        self.stats.inc_value('mysql/rows_flushed', result)
+
+    def _write_touches(self, rows):
+        """BatchBuffer的write: 更新未改变页面的crawled_at"""
+        d = self.dbpool.runInteraction(self._touch, rows)
+        d.addCallbacks(lambda count: self.stats.inc_value('mysql/touched', count), self._handle_batch_error,
+                       errbackArgs=(rows,))
+        return d
+
+    def _touch(self, txn, rows):
+        if self.normalized:
+            txn.executemany("UPDATE movie SET crawled_at=%s WHERE subject_id=%s", rows)
+        else:
+            txn.executemany("UPDATE douban_movie_scrapy SET crawled_at=%s WHERE url=%s", rows)
+        return len(rows)
+
     def _handle_error(self, error, item):
         """do nothing, just log"""
         logging.error(error)
         logging.info('*** Insert operation (MySQL) failed: %s ***\n' % item['url'])
 
+    def _handle_batch_error(self, error, rows):
+        """do nothing, just log; 返回None以免中断LoopingCall"""
+        logging.error(error)
+        logging.info('*** Batch upsert operation (MySQL) failed: %d items ***\n' % len(rows))
+        self.stats.inc_value('mysql/rows_failed', len(rows))
+
 
 class MongodbPipeline(object):
     """
     将抓取的数据存入MongoDB
+
+    MONGODB_BATCH_SIZE > 0 时启用bulk模式: items先缓存在BatchBuffer中，满MONGODB_BATCH_SIZE条、
+    每隔MONGODB_BATCH_INTERVAL秒、以及close_spider时，以unordered bulk_write(UpdateOne, upsert=True)写入；
+    以subject_id为key(unique index)；bulk_write在thread pool中执行，不阻塞reactor；
+    open_spider时为旧版本写入的、没有subject_id的documents补上subject_id(由url得到)，之后的upserts才能匹配到它们
+
+    NORMALIZED_SCHEMA = True 时写入schema.normalize_item的documents(数值year/score/runtime，genres等为array，
+    directors/actors为[{'id', 'name'}])，并创建schema.MONGODB_INDEXES中的indexes；按subject_id upsert
+
+    refresh模式(spider.refresh)下逐条比较已保存的document，只$set有变化的fields(及抓取时间)；
+    页面未改变时(page_unchanged signal)只$set抓取时间，与batch模式相同地批量写入
     """
-    def __init__(self):
-        settings = get_project_settings()
+    def __init__(self, settings):
         self.mongo_host = settings.get('MONGODB_HOST')
         self.mongo_port = settings.get('MONGODB_PORT')
         self.mongo_db_name = settings.get('MONGODB_DB')
         self.mongo_collection_name = settings.get('MONGODB_COLLECTION')
+        self.batch_size = settings.getint('MONGODB_BATCH_SIZE', 0)            # 0: 逐条insert(原有模式)
+        self.batch_interval = settings.getfloat('MONGODB_BATCH_INTERVAL', 5.0)
+        self.max_pending_flushes = settings.getint('MONGODB_MAX_PENDING_FLUSHES', 2)
+        self.normalized = settings.getbool('NORMALIZED_SCHEMA', False)
+        self.batch = None                                                       # batch模式的BatchBuffer(rows为documents)
+        self.touches = None                                                     # 未改变页面的(key, 抓取时间)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls(crawler.settings)
+        crawler.signals.connect(pipeline.page_unchanged, signal=page_unchanged)
+        return pipeline
 
     def open_spider(self, spider):
         """This method is called when the spider is opened"""
-        self.connection = pymongo.MongoClient(self.mongo_host, self.mongo_port)
+        self.connection = self._connect()
         self.db = self.connection[self.mongo_db_name]
+        self.stats = spider.crawler.stats
+        collection = self.db[self.mongo_collection_name]
+        if self.batch_size > 0 or self.normalized:
+            self._backfill_subject_ids(collection)
+            # partial index: 仍没有subject_id的documents(url无法解析)不参与unique约束
+            collection.create_index('subject_id', unique=True,
+                                    partialFilterExpression={'subject_id': {'$exists': True}})
+        if self.normalized:
+            for field in MONGODB_INDEXES:
+                collection.create_index(field)                                  # array fields为multikey index
+        if self.batch_size > 0:
+            self.batch = BatchBuffer(self._write_batch, self.batch_size, self.batch_interval,
+                                     self.max_pending_flushes, self.stats, 'mongodb')
+            self.batch.start()
+        self.touches = BatchBuffer(self._write_touches, max(self.batch_size, 1), self.batch_interval,
+                                   0, self.stats, 'mongodb/touches')              # 没有等待的item，不需要backpressure
+        self.touches.start()
+
+    def _connect(self):
+        """返回MongoClient(benchmarks以in-process stand-in代替)"""
+        import pymongo                                                         # 只在启用MongodbPipeline时import
+        return pymongo.MongoClient(self.mongo_host, self.mongo_port)
+
+    def _backfill_subject_ids(self, collection):
+        """
+        为没有subject_id的documents(逐条insert模式写入)设置subject_id；
+        同一subject已有document时(重复抓取)不再设置，以免违反unique index；返回设置的documents数
+        """
+        import pymongo
+        assigned = set(collection.distinct('subject_id', {'subject_id': {'$exists': True}}))
+        requests = []
+        for doc in collection.find({'subject_id': {'$exists': False}}, {'url': True}):
+            subject_id = get_subject_id(doc.get('url') or '')
+            if subject_id is None or subject_id in assigned:
+                continue
+            assigned.add(subject_id)
+            requests.append(pymongo.UpdateOne({'_id': doc['_id']}, {'$set': {'subject_id': subject_id}}))
+        if requests:
+            collection.bulk_write(requests, ordered=False)
+            logging.info('Backfilled subject_id for %d MongoDB documents.' % len(requests))
+        return len(requests)
 
     def close_spider(self, spider):
         """This method is called when the spider is closed"""
-        self.connection.close()
+        # 等待所有flush完成后再关闭connection
+        d = defer.DeferredList([self.batch.close() if self.batch is not None else defer.succeed(None),
+                                self.touches.close()])
+        d.addBoth(lambda _: self.connection.close())
+        return d
+
+    def page_unchanged(self, url, subject_id, crawled_at):
+        """页面未改变(不产生item): 只更新抓取时间，refresh模式不会再把它当作过期"""
+        # documents的key及抓取时间field与_update_changed相同
+        key = {'subject_id': subject_id} if self.batch_size > 0 or self.normalized else {'url': url}
+        if self.normalized:
+            timestamp = {'crawled_at': datetime.datetime.strptime(crawled_at, '%Y-%m-%d %H:%M:%S')}
+        else:
+            timestamp = {'datetime': crawled_at}
+        self.touches.add((key, timestamp), None)
 
     def process_item(self, item, spider):
         """Insert data into MongoDB collection"""
         # FYI.使用class attribute, 在__init__时 connection需为self.connection,
         # 若在__init__中没有加self，则在process_item()的scope中取不到connection
         # FilterDuplicatePipeline已经对duplicate items做排重处理
+        if getattr(spider, 'refresh', False):
+            d = threads.deferToThread(self._update_changed, item)
+            d.addCallbacks(lambda changed: record_refresh_stats(self.stats, changed), self._handle_refresh_error,
+                           errbackArgs=(item,))
+            d.addCallback(lambda _: item)
+            return d
+        if self.batch_size > 0:
+            return self.batch.add(self._item_to_doc(item), item)
         try:
-            self.db[self.mongo_collection_name].insert(dict(item))
+            if self.normalized:
+                doc = normalize_item(item)
+                self.db[self.mongo_collection_name].update_one({'subject_id': doc['subject_id']}, {'$set': doc},
+                                                               upsert=True)
+            else:
+                self.db[self.mongo_collection_name].insert_one(dict(item))
             logging.info('Item stored to MongoDB with url %s.' % item['url'])
             return item
-        except Exception:
-            logging.info('*** Insert operation (MongoDB) failed: %s ***\n' % item['url'])
+        except Exception as e:
+            logging.error('*** Insert operation (MongoDB) failed: %s: %s ***\n' % (item['url'], e))
+            self.stats.inc_value('mongodb/failed')
             return item
 
+    def _update_changed(self, item):
+        """在worker thread中执行; 返回有变化的fields"""
+        if self.normalized:
+            doc = normalize_item(item)
+            key, timestamp = {'subject_id': doc['subject_id']}, {'crawled_at': doc['crawled_at']}
+        else:
+            doc = dict(item)
+            key, timestamp = {'url': item['url']}, {'datetime': doc.get('datetime')}
+        collection = self.db[self.mongo_collection_name]
+        stored = collection.find_one(key)
+        if stored is None:
+            collection.update_one(key, {'$set': doc}, upsert=True)
+            return doc
+        changed = changed_fields(stored, doc)
+        update = dict(changed)
+        update.update(timestamp)                                                # 抓取时间总是更新(staleness重新计算)
+        collection.update_one(key, {'$set': update})
+        return changed
+
+    def _handle_refresh_error(self, error, item):
+        """do nothing, just log"""
+        logging.error(error)
+        logging.info('*** Refresh update operation (MongoDB) failed: %s ***\n' % item['url'])
+
+    def checkpoint_pending_urls(self):
+        """仍在buffer中或正在写入的documents的url(checkpoint用)"""
+        docs = self.batch.pending() if self.batch is not None else []
+        return [doc['url'] for doc in docs]
+
+    def _item_to_doc(self, item):
+        if self.normalized:
+            return normalize_item(item)
+        doc = dict(item)
+        doc['subject_id'] = get_subject_id(item['url'])
+        return doc
+
+    def _write_batch(self, docs):
+        """BatchBuffer的write: 将documents交给thread pool，以一次bulk_write写入"""
+        d = threads.deferToThread(self._bulk_upsert, docs)
+        d.addCallbacks(self._handle_batch_result, self._handle_batch_error, errbackArgs=(docs,))
+        return d
+
+    def _bulk_upsert(self, docs):
+        """在worker thread中执行; 返回(inserted, updated, failed)"""
+        import pymongo
+        requests = [pymongo.UpdateOne({'subject_id': doc['subject_id']}, {'$set': doc}, upsert=True)
+                    for doc in docs]
+        try:
+            result = self.db[self.mongo_collection_name].bulk_write(requests, ordered=False)
+            return result.upserted_count, result.modified_count, 0
+        except pymongo.errors.BulkWriteError as e:
+            # ordered=False: 出错的document不影响其余document的写入
+            details = e.details
+            return details['nUpserted'], details['nModified'], len(details['writeErrors'])
+
+    def _write_touches(self, rows):
+        """BatchBuffer的write: 在thread pool中更新未改变页面的抓取时间"""
+        d = threads.deferToThread(self._bulk_touch, rows)
+        d.addCallbacks(lambda count: self.stats.inc_value('mongodb/touched', count), self._handle_batch_error,
+                       errbackArgs=(rows,))
+        return d
+
+    def _bulk_touch(self, rows):
+        """在worker thread中执行; 返回更新的documents数"""
+        import pymongo
+        requests = [pymongo.UpdateMany(key, {'$set': timestamp}) for key, timestamp in rows]
+        return self.db[self.mongo_collection_name].bulk_write(requests, ordered=False).modified_count
+
+    def _handle_batch_result(self, result):
+        inserted, updated, failed = result
+        self.stats.inc_value('mongodb/batches_flushed')
+        self.stats.inc_value('mongodb/inserted', inserted)
+        self.stats.inc_value('mongodb/updated', updated)
+        self.stats.inc_value('mongodb/failed', failed)
+        logging.info('Batch stored to MongoDB: %d inserted, %d updated, %d failed.' % (inserted, updated, failed))
+
+    def _handle_batch_error(self, error, docs):
+        """do nothing, just log; 返回None以免中断LoopingCall"""
+        logging.error(error)
+        logging.info('*** Bulk write operation (MongoDB) failed: %d items ***\n' % len(docs))
+        self.stats.inc_value('mongodb/failed', len(docs))
+
+
+class ColumnarExportPipeline(object):
+    """
+    将items以row groups流式写入Parquet(EXPORT_FORMAT = 'parquet') 或 Arrow IPC('arrow')文件，
+    分析任务直接读取这些文件，不需要再从MySQL/MongoDB中导出；
+    columns有类型: year/runtime(int)、score(float)，genre/country/language为dictionary-encoded的list；
+    内存中最多缓存EXPORT_ROW_GROUP_SIZE行(加上正在写入的row groups)，row group在thread pool中编码、压缩、写入；
+    文件达到EXPORT_MAX_FILE_BYTES后rollover；LoopingCall定期检查，文件的第一行已超过EXPORT_MAX_FILE_SECS秒时
+    flush buffer并关闭文件(没有新的row group写入时也会rollover)；
+    写入中的文件带'.tmp'后缀，关闭后rename，consumers只会看到完整的文件；checkpoint时不rollover，
+    尚未写入已关闭文件的items(buffer中、正在写入 及 当前'.tmp'文件中的rows)作为checkpoint_pending_urls；
+    EXPORT_DIR为None时不启用；需要pyarrow(只在启用时import)
+    """
+    columns = ('subject_id', 'url', 'title', 'year', 'score', 'runtime', 'genre', 'country', 'language',
+               'director', 'actors', 'image_url', 'crawled_at')
+
+    def __init__(self, settings):
+        self.export_dir = settings.get('EXPORT_DIR')
+        if not self.export_dir:
+            raise NotConfigured
+        self.format = settings.get('EXPORT_FORMAT', 'parquet')
+        if self.format not in ('parquet', 'arrow'):
+            raise ValueError('Unsupported EXPORT_FORMAT: %s' % self.format)
+        self.compression = settings.get('EXPORT_COMPRESSION', 'zstd')
+        self.row_group_size = settings.getint('EXPORT_ROW_GROUP_SIZE', 5000)
+        self.max_file_bytes = settings.getint('EXPORT_MAX_FILE_BYTES', 128 * 1024 * 1024)
+        self.max_file_secs = settings.getfloat('EXPORT_MAX_FILE_SECS', 3600)
+        self.max_pending_writes = settings.getint('EXPORT_MAX_PENDING_WRITES', 2)
+        self.buffer = self._empty_buffer()
+        self.buffered = 0
+        self.writes = defer.succeed(None)                                      # 写入按顺序串行(writer不是thread-safe)
+        self.pending_writes = 0
+        self.waiters = []                                                       # 因backpressure等待中的process_item deferreds
+        self.writer = None
+        self.file_path = None
+        self.file_started_at = None                                             # 当前文件第一行的时间(reactor thread)
+        self.age_check = None
+        self.file_seq = 0
+        self.files_completed = 0
+        self.file_rows = 0                                                      # 当前文件中的rows(worker thread)
+        self.rows_closed = 0                                                    # 已关闭文件中的rows(worker thread)
+        self.rows_synced = 0                                                    # 已从unsynced_urls中移除的rows
+        self.unsynced_urls = []                                                 # 尚未写入已关闭文件的item urls
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings)
+
+    def open_spider(self, spider):
+        import pyarrow as pa                                                   # optional dependency
+        self.pa = pa
+        if self.format == 'parquet':
+            import pyarrow.parquet as pq
+            self.pq = pq
+        else:
+            import pyarrow.ipc
+        values = pa.dictionary(pa.int32(), pa.string())
+        self.schema = pa.schema([
+            ('subject_id', pa.int64()),
+            ('url', pa.string()),
+            ('title', pa.string()),
+            ('year', pa.int16()),
+            ('score', pa.float32()),
+            ('runtime', pa.int16()),                                           # 分钟
+            ('genre', pa.list_(values)),
+            ('country', pa.list_(values)),
+            ('language', pa.list_(values)),
+            ('director', pa.list_(pa.string())),
+            ('actors', pa.list_(pa.string())),
+            ('image_url', pa.string()),
+            ('crawled_at', pa.timestamp('s')),
+        ])
+        self.spider_name = spider.name
+        self.stats = spider.crawler.stats
+        if not os.path.exists(self.export_dir):
+            os.makedirs(self.export_dir)
+        self.age_check = task.LoopingCall(self._check_file_age)
+        self.age_check.start(min(self.max_file_secs, 60), now=False)
+
+    def close_spider(self, spider):
+        if self.age_check is not None and self.age_check.running:
+            self.age_check.stop()
+        self._flush()
+        self._enqueue_write(self._close_file)
+        return self.writes
+
+    def process_item(self, item, spider):
+        doc = normalize_item(item)
+        row = (doc['subject_id'], doc['url'], doc['title'], doc['year'], doc['score'], doc['runtime'],
+               doc['genres'], doc['countries'], doc['languages'],
+               [person['name'] for person in doc['directors']], [person['name'] for person in doc['actors']],
+               doc['image_url'], doc['crawled_at'])
+        for column, value in zip(self.columns, row):
+            self.buffer[column].append(value)
+        self.buffered += 1
+        self.unsynced_urls.append(doc['url'])
+        if self.file_started_at is None:
+            self.file_started_at = time.time()
+        if self.buffered >= self.row_group_size:
+            self._flush()
+        if self.pending_writes >= self.max_pending_writes:
+            # 写入跟不上: 返回deferred，直到有row group写完engine才会继续处理该item
+            self.stats.inc_value('export/backpressure_waits')
+            d = defer.Deferred()
+            d.addCallback(lambda _: item)
+            self.waiters.append(d)
+            return d
+        return item
+
+    def checkpoint_pending_urls(self):
+        """尚未写入已关闭文件的item urls(crash后'.tmp'文件不可用，resume时重新抓取)"""
+        return list(self.unsynced_urls)
+
+    def _check_file_age(self):
+        """LoopingCall: 文件的第一行已超过max_file_secs秒时flush buffer并关闭文件"""
+        if self.file_started_at is None or time.time() - self.file_started_at < self.max_file_secs:
+            return
+        self.stats.inc_value('export/age_rollovers')
+        self._flush()
+        self._enqueue_write(self._close_file)
+        self.file_started_at = None
+
+    def _empty_buffer(self):
+        return dict((column, []) for column in self.columns)
+
+    def _flush(self):
+        """将buffer中的rows作为一个row group交给thread pool写入"""
+        if not self.buffered:
+            return
+        columns, rows = self.buffer, self.buffered
+        self.buffer, self.buffered = self._empty_buffer(), 0
+        self._enqueue_write(self._write_row_group, columns, rows)
+
+    def _enqueue_write(self, f, *args):
+        self.pending_writes += 1
+        self.writes.addCallback(lambda _: threads.deferToThread(f, *args))
+        self.writes.addErrback(self._handle_write_error)
+        self.writes.addBoth(self._write_done)
+
+    def _write_row_group(self, columns, rows):
+        """在worker thread中执行: 编码、压缩并写入一个row group，必要时rollover"""
+        pa = self.pa
+        table = pa.Table.from_arrays([pa.array(columns[field.name], type=field.type) for field in self.schema],
+                                     schema=self.schema)
+        if self.writer is None:
+            self._open_file()
+        if self.format == 'parquet':
+            self.writer.write_table(table, row_group_size=rows)
+        else:
+            self.writer.write_table(table)
+        self.file_rows += rows
+        if self.sink.tell() >= self.max_file_bytes:
+            self._close_file()
+        return rows
+
+    def _open_file(self):
+        self.file_seq += 1
+        self.file_path = os.path.join(self.export_dir, '%s-%s-%04d.%s' % (
+            self.spider_name, time.strftime('%Y%m%d%H%M%S'), self.file_seq, self.format))
+        self.sink = open(self.file_path + '.tmp', 'wb')
+        if self.format == 'parquet':
+            self.writer = self.pq.ParquetWriter(self.sink, self.schema, compression=self.compression)
+        else:
+            options = self.pa.ipc.IpcWriteOptions(compression=self.compression)
+            self.writer = self.pa.ipc.new_file(self.sink, self.schema, options=options)
+
+    def _close_file(self):
+        if self.writer is None:
+            return None
+        self.writer.close()
+        self.sink.close()
+        os.rename(self.file_path + '.tmp', self.file_path)                      # rename之后consumers才可见
+        self.writer = None
+        self.files_completed += 1
+        self.rows_closed += self.file_rows
+        self.file_rows = 0
+        logging.info('Export file completed: %s' % self.file_path)
+        return None
+
+    def _handle_write_error(self, error):
+        """do nothing, just log; 返回None以免中断后续的写入"""
+        logging.error(error)
+        logging.info('*** Export write operation failed ***\n')
+        self.stats.inc_value('export/write_errors')
+
+    def _write_done(self, result):
+        """在reactor thread中更新stats(worker thread中只写文件)"""
+        self.pending_writes -= 1
+        if result:
+            self.stats.inc_value('export/rows', result)
+            self.stats.inc_value('export/row_groups')
+        self.stats.set_value('export/files', self.files_completed)
+        synced = self.rows_closed - self.rows_synced
+        if synced:
+            del self.unsynced_urls[:synced]
+            self.rows_synced = self.rows_closed
+            if not self.unsynced_urls:
+                self.file_started_at = None
+            elif self.file_started_at is not None:
+                self.file_started_at = time.time()                              # 按大小rollover: 其余rows属于下一个文件
+        # 释放因backpressure等待的items
+        while self.waiters and self.pending_writes < self.max_pending_writes:
+            self.waiters.pop(0).callback(None)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# refresh模式(scrapy crawl motion -a mode=refresh): 只重新抓取已保存的、已过期的电影页面
+# 每部电影的refresh interval取决于其volatility: 新上映的电影(评分变化快)间隔短，老电影间隔长；
+# staleness = 距上次抓取的时间 / refresh interval，>= 1 即为过期，按staleness从高到低安排requests
+
+import datetime
+import logging
+
+from doubanmovie.utils import get_subject_id, parse_year
+
+# 写入时不比较的housekeeping fields
+_housekeeping = ('_id', 'project', 'spider', 'server', 'datetime', 'crawled_at')
+
+
+def load_refresh_candidates(settings, backend):
+    """
+    从MySQL(backend='mysql') 或 MongoDB(backend='mongodb')取得已保存电影的 (subject_id, year, crawled_at)；
+    MySQL: 原有table douban_movie_scrapy的crawled_at column由MysqlPipeline添加及写入(尚未添加时crawled_at为None，
+    即每次都视为过期)，NORMALIZED_SCHEMA = True 时读取movie table的crawled_at
+    """
+    candidates = []
+    if backend == 'mysql':
+        import pymysql
+        conn = pymysql.connect(host=settings.get('MYSQL_HOST'), user=settings.get('MYSQL_USER'),
+                               password=settings.get('MYSQL_PASS'), db=settings.get('MYSQL_DB'), charset='utf8')
+        try:
+            cursor = conn.cursor()
+            if settings.getbool('NORMALIZED_SCHEMA'):
+                cursor.execute("SELECT subject_id, myear, crawled_at FROM movie")
+                candidates = list(cursor.fetchall())
+            else:
+                try:
+                    cursor.execute("SELECT url, myear, crawled_at FROM douban_movie_scrapy")
+                    rows = cursor.fetchall()
+                except pymysql.err.OperationalError:                          # 尚没有crawled_at column
+                    logging.warning('douban_movie_scrapy has no crawled_at column, all movies are due.')
+                    cursor.execute("SELECT url, myear, NULL FROM douban_movie_scrapy")
+                    rows = cursor.fetchall()
+                candidates = [(get_subject_id(url), parse_year(year), crawled_at) for url, year, crawled_at in rows]
+        finally:
+            conn.close()
+    elif backend == 'mongodb':
+        import pymongo
+        connection = pymongo.MongoClient(settings.get('MONGODB_HOST'), settings.get('MONGODB_PORT'))
+        try:
+            collection = connection[settings.get('MONGODB_DB')][settings.get('MONGODB_COLLECTION')]
+            for doc in collection.find({}, {'url': 1, 'year': 1, 'datetime': 1, 'crawled_at': 1}):
+                crawled_at = doc.get('crawled_at')
+                if crawled_at is None and doc.get('datetime'):
+                    crawled_at = datetime.datetime.strptime(doc['datetime'], '%Y-%m-%d %H:%M:%S')
+                year = doc.get('year')
+                candidates.append((get_subject_id(doc['url']), year if isinstance(year, int) else parse_year(year),
+                                   crawled_at))
+        finally:
+            connection.close()
+    else:
+        raise ValueError('Unknown backend for refresh candidates: %s' % backend)
+    candidates = [c for c in candidates if c[0] is not None]
+    logging.info('%d refresh candidates loaded from %s.' % (len(candidates), backend))
+    return candidates
+
+
+def refresh_interval(year, now, intervals, default_interval):
+    """
+    intervals: [(max_age_years, interval_days), ...]，按max_age_years从小到大；
+    电影的age(今年 - 上映年份)不大于max_age_years时使用对应的interval；年份未知或更老的电影使用default_interval
+    """
+    if year is not None:
+        age = now.year - year
+        for max_age, interval in intervals:
+            if age <= max_age:
+                return datetime.timedelta(days=interval)
+    return datetime.timedelta(days=default_interval)
+
+
+def schedule_refresh(candidates, now, intervals, default_interval, max_requests=0):
+    """
+    candidates: [(subject_id, year, crawled_at)]；
+    返回过期电影的 [(subject_id, staleness)]，按staleness从高到低，最多max_requests个(0为不限)；
+    没有crawled_at的电影staleness视为无穷大
+    """
+    due = []
+    for subject_id, year, crawled_at in candidates:
+        if crawled_at is None:
+            staleness = float('inf')
+        else:
+            interval = refresh_interval(year, now, intervals, default_interval)
+            staleness = (now - crawled_at).total_seconds() / interval.total_seconds()
+        if staleness >= 1:
+            due.append((subject_id, staleness))
+    due.sort(key=lambda x: x[1], reverse=True)
+    return due[:max_requests] if max_requests > 0 else due
+
+
+def _same(stored, new):
+    """数据库中的值与新抓取的值是否相同(DECIMAL/float的score按数值比较，其余按string比较)"""
+    if stored is None or new is None:
+        return stored is None and new is None
+    if isinstance(new, float):
+        try:
+            return abs(float(stored) - new) < 0.05
+        except (TypeError, ValueError):
+            return False
+    if isinstance(new, (list, dict)):
+        return stored == new
+    return u'%s' % stored == u'%s' % new
+
+
+def changed_fields(stored, new):
+    """stored, new: {field: value}；返回new中与stored不同的fields(不比较housekeeping fields)"""
+    return dict((field, value) for field, value in new.items()
+                if field not in _housekeeping and not _same(stored.get(field), value))
@@ -4,17 +4,53 @@
 # 如果scrapy需要运行多个间断的session，则需要自定义CustomRequestFilter和FilterDuplicatePipeline从数据库中获得已保存的item(url)
 
 from scrapy.dupefilters import RFPDupeFilter
+from scrapy.utils.job import job_dir
+from doubanmovie.bitmap import SubjectIdBitmap
+from doubanmovie.checkpoint import load_checkpoint
+from doubanmovie.utils import get_subject_id, load_stored_subject_ids
 
 
 class CustomRequestFilter(RFPDupeFilter):
     """
-    通过url中 https://movie.douban.com/subject/...(id).../ 来去重的custom request filter
+    通过url中 https://movie.douban.com/subject/...(id).../ 来去重的custom request filter；
+    subject id存于SubjectIdBitmap中(DUPEFILTER_BITMAP_PATH不为None时持久化到磁盘，跨session有效)；
+    非subject页面(首页、top250 index页面等)仍使用RFPDupeFilter默认的fingerprint；
+    DUPEFILTER_PRELOAD = 'mysql' 或 'mongodb' 时，启动时从数据库载入已保存的subject id；
+    有checkpoint(CHECKPOINT_DIR)时先restore checkpoint中的seen subject ids和fingerprints；
+    非subject页面的fingerprint由crawler.request_fingerprinter(REQUEST_FINGERPRINTER_CLASS)计算
     """
-    def request_fingerprint(self, request):
-        """取得request_fingerprint (subject id)"""
-        subject_id_index = request.url.split('/').index('subject') + 1
-        request_fingerprint = request.url.split('/')[subject_id_index]
-        return request_fingerprint
+    def __init__(self, path=None, debug=False, bitmap_path=None, preload=None, settings=None, checkpoint=None,
+                 fingerprinter=None):
+        super(CustomRequestFilter, self).__init__(path, debug, fingerprinter=fingerprinter)
+        self.subject_ids = SubjectIdBitmap(bitmap_path)
+        self.closed_state = None
+        if checkpoint:
+            self.subject_ids.load_bytes(checkpoint['bitmap'])
+            self._fingerprints.update(checkpoint['fingerprints'])
+        if preload:
+            self.subject_ids.update(load_stored_subject_ids(settings, preload))
 
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        state = load_checkpoint(settings)
+        return cls(job_dir(settings), settings.getbool('DUPEFILTER_DEBUG'), settings.get('DUPEFILTER_BITMAP_PATH'),
+                   settings.get('DUPEFILTER_PRELOAD'), settings, state.get('dupefilter') if state else None,
+                   fingerprinter=crawler.request_fingerprinter)
 
+    def request_seen(self, request):
+        subject_id = get_subject_id(request.url)
+        if subject_id is None:
+            return super(CustomRequestFilter, self).request_seen(request)
+        return self.subject_ids.add(subject_id)
 
+    def checkpoint_state(self):
+        if self.closed_state is not None:
+            return self.closed_state
+        return {'bitmap': self.subject_ids.to_bytes(), 'fingerprints': list(self._fingerprints)}
+
+    def close(self, reason):
+        # scheduler在spider_closed signal之前关闭；保留最后的state供CrawlCheckpoint写入最后一个checkpoint
+        self.closed_state = self.checkpoint_state()
+        self.subject_ids.close()
+        super(CustomRequestFilter, self).close(reason)
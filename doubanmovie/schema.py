@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+# normalized schema(NORMALIZED_SCHEMA = True 时由MysqlPipeline/MongodbPipeline使用):
+# year/score/runtime为数值，genre/country/language为list，director/actors为带person id的list；
+# 可以直接建index，查询genre或actor时不需要再 LIKE '%...%' 扫描整个table；
+# 另有原有table douban_movie_scrapy的DDL及migrations；python -m doubanmovie.schema 创建tables或migrate已有的table
+
+import datetime
+import logging
+
+from doubanmovie.utils import get_subject_id, parse_runtime, parse_score, parse_year, split_values
+
+# MySQL: movie一张table，多值fields各一张join table(均以subject_id关联)
+MYSQL_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS movie ("
+    "  subject_id INT UNSIGNED NOT NULL PRIMARY KEY,"
+    "  title VARCHAR(255) NOT NULL,"
+    "  myear SMALLINT NULL,"
+    "  score DECIMAL(3,1) NULL,"
+    "  runtime SMALLINT NULL,"
+    "  image_url VARCHAR(255) NULL,"
+    "  image_path VARCHAR(255) NULL,"                               # PosterImagePipeline保存的poster(相对于POSTER_STORE)
+    "  url VARCHAR(255) NOT NULL,"
+    "  crawled_at DATETIME NULL,"
+    "  UNIQUE KEY uk_url (url),"
+    "  KEY idx_year (myear),"
+    "  KEY idx_score (score)"
+    ") DEFAULT CHARSET=utf8mb4",
+    "CREATE TABLE IF NOT EXISTS movie_genre ("
+    "  subject_id INT UNSIGNED NOT NULL,"
+    "  genre VARCHAR(32) NOT NULL,"
+    "  PRIMARY KEY (subject_id, genre),"
+    "  KEY idx_genre (genre)"
+    ") DEFAULT CHARSET=utf8mb4",
+    "CREATE TABLE IF NOT EXISTS movie_country ("
+    "  subject_id INT UNSIGNED NOT NULL,"
+    "  country VARCHAR(64) NOT NULL,"
+    "  PRIMARY KEY (subject_id, country),"
+    "  KEY idx_country (country)"
+    ") DEFAULT CHARSET=utf8mb4",
+    "CREATE TABLE IF NOT EXISTS movie_language ("
+    "  subject_id INT UNSIGNED NOT NULL,"
+    "  mlanguage VARCHAR(64) NOT NULL,"
+    "  PRIMARY KEY (subject_id, mlanguage),"
+    "  KEY idx_language (mlanguage)"
+    ") DEFAULT CHARSET=utf8mb4",
+    "CREATE TABLE IF NOT EXISTS person ("
+    "  person_id INT UNSIGNED NOT NULL PRIMARY KEY,"
+    "  name VARCHAR(255) NOT NULL,"
+    "  KEY idx_name (name)"
+    ") DEFAULT CHARSET=utf8mb4",
+    "CREATE TABLE IF NOT EXISTS movie_person ("
+    "  subject_id INT UNSIGNED NOT NULL,"
+    "  person_id INT UNSIGNED NOT NULL,"
+    "  role ENUM('director', 'actor') NOT NULL,"
+    "  position TINYINT UNSIGNED NOT NULL,"                         # 在演职员表中的顺序
+    "  PRIMARY KEY (subject_id, role, person_id),"
+    "  KEY idx_person (person_id, role)"
+    ") DEFAULT CHARSET=utf8mb4",
+)
+
+# MySQL: 原有的table(NORMALIZED_SCHEMA = False)；MysqlPipeline batch模式的ON DUPLICATE KEY UPDATE依赖uk_url
+LEGACY_MYSQL_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS douban_movie_scrapy ("
+    "  id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,"
+    "  title VARCHAR(255) NULL,"
+    "  myear VARCHAR(16) NULL,"
+    "  country VARCHAR(255) NULL,"
+    "  genre VARCHAR(255) NULL,"
+    "  mlanguage VARCHAR(255) NULL,"
+    "  length VARCHAR(64) NULL,"
+    "  director VARCHAR(255) NULL,"
+    "  actors TEXT NULL,"
+    "  score VARCHAR(8) NULL,"
+    "  image_url VARCHAR(255) NULL,"
+    "  url VARCHAR(255) NOT NULL,"
+    "  crawled_at DATETIME NULL,"
+    "  UNIQUE KEY uk_url (url)"
+    ") DEFAULT CHARSET=utf8mb4",
+)
+
+# 已有的douban_movie_scrapy table: [(name, 检查是否已完成的query(有结果即已完成), statement)]
+LEGACY_MYSQL_MIGRATIONS = (
+    # url重复的rows需先删除，否则ADD UNIQUE KEY失败(Duplicate entry)
+    ('uk_url', "SHOW INDEX FROM douban_movie_scrapy WHERE Column_name='url' AND Non_unique=0",
+     "ALTER TABLE douban_movie_scrapy ADD UNIQUE KEY uk_url (url)"),
+    # 抓取时间(refresh模式据此计算staleness)
+    ('crawled_at', "SHOW COLUMNS FROM douban_movie_scrapy LIKE 'crawled_at'",
+     "ALTER TABLE douban_movie_scrapy ADD COLUMN crawled_at DATETIME NULL"),
+)
+
+# normalized doc中存于join tables的多值fields: (doc key, table, column)
+JOIN_FIELDS = (('genres', 'movie_genre', 'genre'), ('countries', 'movie_country', 'country'),
+               ('languages', 'movie_language', 'mlanguage'))
+
+# MongoDB: 一个document，多值fields为array(multikey index)
+MONGODB_INDEXES = ('year', 'score', 'genres', 'countries', 'languages', 'directors.id', 'actors.id')
+
+
+def _people(names, ids):
+    """','连接的names + 对应的person ids -> [{'id': ..., 'name': ...}]；ids缺失时id为None"""
+    names = split_values(names)
+    ids = list(ids or [])
+    ids += [None] * (len(names) - len(ids))
+    return [{'id': person_id, 'name': name} for name, person_id in zip(names, ids)]
+
+
+def normalize_item(item):
+    """DoubanmovieItem 或 MovieRecord -> normalized dict(MongoDB document，亦为MySQL rows的来源)"""
+    crawled_at = item.get('datetime')
+    return {
+        'subject_id': get_subject_id(item['url']),
+        'title': item.get('title'),
+        'year': parse_year(item.get('year')),
+        'score': parse_score(item.get('score')),
+        'runtime': parse_runtime(item.get('length')),
+        'genres': split_values(item.get('genre')),
+        'countries': split_values(item.get('country')),
+        'languages': split_values(item.get('language')),
+        'directors': _people(item.get('director'), item.get('director_ids')),
+        'actors': _people(item.get('actors'), item.get('actor_ids')),
+        'image_url': item.get('image_url'),
+        'image_path': item.get('image_path'),
+        'url': item['url'],
+        'crawled_at': datetime.datetime.strptime(crawled_at, '%Y-%m-%d %H:%M:%S') if crawled_at else None,
+    }
+
+
+def upsert_normalized(txn, docs):
+    """
+    在adbapi的transaction中写入normalized docs: movie upsert；join tables先删除该subject的旧rows再insert
+    (重新抓取时genre/演员表的变化也会反映出来)；没有person id的director/actor不写入movie_person
+    """
+    txn.executemany(
+        "INSERT INTO movie (subject_id, title, myear, score, runtime, image_url, image_path, url, crawled_at) "
+        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE title=VALUES(title), myear=VALUES(myear), score=VALUES(score), "
+        "runtime=VALUES(runtime), image_url=VALUES(image_url), image_path=IFNULL(VALUES(image_path), image_path), "
+        "url=VALUES(url), crawled_at=VALUES(crawled_at)",
+        [(doc['subject_id'], doc['title'], doc['year'], doc['score'], doc['runtime'], doc['image_url'],
+          doc['image_path'], doc['url'], doc['crawled_at']) for doc in docs])
+
+    subject_ids = [(doc['subject_id'],) for doc in docs]
+    for key, table, column in JOIN_FIELDS:
+        txn.executemany("DELETE FROM %s WHERE subject_id=%%s" % table, subject_ids)
+        rows = set((doc['subject_id'], value) for doc in docs for value in doc[key])
+        if rows:
+            txn.executemany("INSERT INTO %s (subject_id, %s) VALUES (%%s, %%s)" % (table, column), list(rows))
+
+    persons, links = {}, {}
+    for doc in docs:
+        for role, key in (('director', 'directors'), ('actor', 'actors')):
+            for position, person in enumerate(doc[key]):
+                if person['id'] is None:
+                    continue
+                persons[person['id']] = person['name']
+                links.setdefault((doc['subject_id'], person['id'], role), position)
+    if persons:
+        txn.executemany("INSERT INTO person (person_id, name) VALUES (%s, %s) "
+                        "ON DUPLICATE KEY UPDATE name=VALUES(name)", list(persons.items()))
+    txn.executemany("DELETE FROM movie_person WHERE subject_id=%s", subject_ids)
+    if links:
+        txn.executemany("INSERT INTO movie_person (subject_id, person_id, role, position) VALUES (%s, %s, %s, %s)",
+                        [key + (position,) for key, position in links.items()])
+    return len(docs)
+
+
+def join_values(doc):
+    """normalized doc中存于join tables的值(与load_join_values比较): 多值fields及directors/actors的person ids"""
+    values = dict((key, sorted(set(doc[key]))) for key, table, column in JOIN_FIELDS)
+    for key in ('directors', 'actors'):
+        values[key] = sorted(set(person['id'] for person in doc[key] if person['id'] is not None))
+    return values
+
+
+def load_join_values(txn, subject_id):
+    """已保存的一部电影在join tables中的值，格式同join_values"""
+    values = {}
+    for key, table, column in JOIN_FIELDS:
+        txn.execute("SELECT %s FROM %s WHERE subject_id=%%s" % (column, table), (subject_id,))
+        values[key] = sorted(row[0] for row in txn.fetchall())
+    values.update(directors=[], actors=[])
+    txn.execute("SELECT role, person_id FROM movie_person WHERE subject_id=%s ORDER BY person_id", (subject_id,))
+    for role, person_id in txn.fetchall():
+        values[role + 's'].append(person_id)
+    return values
+
+
+def create_mysql_schema(cursor, normalized):
+    """
+    normalized: 创建schema.MYSQL_SCHEMA中的tables；否则创建douban_movie_scrapy(若没有)，
+    再执行其尚未完成的LEGACY_MYSQL_MIGRATIONS；返回执行了的migrations的names
+    """
+    if normalized:
+        for statement in MYSQL_SCHEMA:
+            cursor.execute(statement)
+        return []
+    for statement in LEGACY_MYSQL_SCHEMA:
+        cursor.execute(statement)
+    applied = []
+    for name, check, statement in LEGACY_MYSQL_MIGRATIONS:
+        cursor.execute(check)
+        if cursor.fetchall():
+            continue
+        cursor.execute(statement)
+        applied.append(name)
+        logging.info('Applied migration %s to douban_movie_scrapy.' % name)
+    return applied
+
+
+def main():
+    """python -m doubanmovie.schema [--normalized]: 以project settings连接MySQL，创建tables或migrate已有的table"""
+    import argparse
+    import pymysql
+    from scrapy.utils.project import get_project_settings
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--normalized', action='store_true', default=None,
+                        help='创建normalized tables(默认取NORMALIZED_SCHEMA)')
+    args = parser.parse_args()
+    settings = get_project_settings()
+    normalized = settings.getbool('NORMALIZED_SCHEMA') if args.normalized is None else args.normalized
+    conn = pymysql.connect(host=settings.get('MYSQL_HOST'), user=settings.get('MYSQL_USER'),
+                           password=settings.get('MYSQL_PASS'), db=settings.get('MYSQL_DB'), charset='utf8')
+    try:
+        applied = create_mysql_schema(conn.cursor(), normalized)
+        conn.commit()
+    finally:
+        conn.close()
+    print('schema ok%s' % (': applied %s' % ', '.join(applied) if applied else ''))
+
+
+if __name__ == '__main__':
+    main()
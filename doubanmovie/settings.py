@@ -17,26 +17,101 @@ ROBOTSTXT_OBEY = False
 DOWNLOADER_MIDDLEWARES = {
     'scrapy.downloadermiddlewares.useragent.UserAgentMiddleware': None,
     'doubanmovie.middlewares.RandomUserAgentMiddleware': 501,
+    'doubanmovie.middlewares.IdentityPoolMiddleware': 502,                # IDENTITY_PROXIES为空时不启用
+    'doubanmovie.middlewares.BrowserPoolMiddleware': 950,
+    'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware': None,
+    'doubanmovie.httpcache.RevalidatingCacheMiddleware': 900,
 }
 
 ITEM_PIPELINES = {
     'doubanmovie.pipelines.DropEmptyItemPipeline': 300,
     'doubanmovie.pipelines.FilterDuplicatePipeline': 400,
+    'doubanmovie.pipelines.PosterImagePipeline': 450,        # POSTER_STORE为None时不启用
     'doubanmovie.pipelines.MysqlPipeline': 500,
     'doubanmovie.pipelines.MongodbPipeline': 501,
+    'doubanmovie.pipelines.ColumnarExportPipeline': 600,     # EXPORT_DIR为None时不启用
 }
 
+# FilterDuplicatePipeline: 'set'(全部url存于内存) 或 'bloom'(以subject id为key的scalable Bloom filter)
+FILTER_DUPLICATE_BACKEND = 'set'
+FILTER_DUPLICATE_CAPACITY = 100000          # 第一个Bloom filter的容量
+FILTER_DUPLICATE_ERROR_RATE = 0.001         # 误判率
+FILTER_DUPLICATE_SNAPSHOT_PATH = None       # Bloom filter snapshot文件路径(None则不保存)
+
 # mysql配置(aws-ec2: admin; admin123456)
 MYSQL_HOST = 'localhost'
 MYSQL_USER = 'python_conn'
 MYSQL_PASS = 'python123456'
 MYSQL_DB = 'scraping'
+# MysqlPipeline batch模式(需url上的unique key，python -m doubanmovie.schema创建); MYSQL_BATCH_SIZE = 0 则逐条SELECT-then-INSERT
+MYSQL_BATCH_SIZE = 0
+MYSQL_BATCH_INTERVAL = 5.0                  # 每隔n秒flush一次buffer
+MYSQL_MAX_PENDING_FLUSHES = 2               # 正在执行的flush数达到此值时对engine形成backpressure
+MYSQL_MIGRATE = False                       # True: open_spider时创建douban_movie_scrapy并执行尚未完成的migrations
+
+# NORMALIZED_SCHEMA = True: MysqlPipeline/MongodbPipeline写入normalized schema(见doubanmovie/schema.py)
+NORMALIZED_SCHEMA = False
+
+# early drop(默认不启用): 电影页面中缺少以下任一marker时不做extraction、不产生item；
+# 启用时设为 ['v:itemreviewed', 'v:runtime', 'v:genre', 'v:starring'](与DropEmptyItemPipeline检查的
+# title/length/genre/actors对应)，或 scrapy crawl motion -s EARLY_DROP_MARKERS=v:itemreviewed,v:runtime,v:genre,v:starring
+EARLY_DROP_MARKERS = []
+EARLY_DROP_LINKS = 'deprioritize'           # 这些页面的recommendation links: 'follow'、'deprioritize' 或 'skip'
+
+# refresh模式(scrapy crawl motion -a mode=refresh)
+REFRESH_BACKEND = 'mysql'                   # 从'mysql' 或 'mongodb'读取已保存电影的年份和抓取时间
+REFRESH_INTERVALS = [(0, 1), (1, 3), (3, 14), (10, 30)]     # [(上映后n年以内, 每n天refresh一次)]
+REFRESH_DEFAULT_INTERVAL = 90               # 更老的(或年份未知的)电影每n天refresh一次
+REFRESH_MAX_REQUESTS = 0                    # 每次refresh最多n个电影页面(0为不限)
 
 # mongdb配置
 MONGODB_HOST = 'localhost'
 MONGODB_PORT = 27017
 MONGODB_DB = 'scraping'
 MONGODB_COLLECTION = 'douban_movie_scrapy'
+# MongodbPipeline bulk模式(以subject_id为key upsert); MONGODB_BATCH_SIZE = 0 则逐条insert
+MONGODB_BATCH_SIZE = 0
+MONGODB_BATCH_INTERVAL = 5.0                # 每隔n秒flush一次buffer
+MONGODB_MAX_PENDING_FLUSHES = 2             # 正在执行的bulk_write数达到此值时对engine形成backpressure
+
+# ColumnarExportPipeline: 流式写入Parquet/Arrow IPC文件(需要pyarrow)
+EXPORT_DIR = None                           # e.g. 'export'
+EXPORT_FORMAT = 'parquet'                   # 'parquet' 或 'arrow'(Arrow IPC file)
+EXPORT_COMPRESSION = 'zstd'
+EXPORT_ROW_GROUP_SIZE = 5000                # 内存中最多缓存的rows(每个row group的大小)
+EXPORT_MAX_FILE_BYTES = 128 * 1024 * 1024   # 文件达到此大小后rollover
+EXPORT_MAX_FILE_SECS = 3600                 # 文件的第一行超过n秒后rollover(定期检查，不需要新的row group写入)
+EXPORT_MAX_PENDING_WRITES = 2               # 正在写入的row groups数达到此值时对engine形成backpressure
+
+# PosterImagePipeline: 经crawler的downloader下载posters，以content hash去重保存，本地路径写入item['image_path']
+POSTER_STORE = None                         # poster存储目录，e.g. 'posters'
+POSTER_THUMBS = {'small': (100, 140)}       # 缩略图 {name: (width, height)}，需要Pillow；{}则不生成
+POSTER_CONCURRENCY = 4                      # 同时下载的posters数
+
+# recommendation graph: subject -> subject edges(int32 pairs)存于GRAPH_DIR，spider关闭时增量更新in-degree/PageRank
+GRAPH_DIR = None                            # e.g. 'graph'；None则不记录
+GRAPH_SCORES_ON_CLOSE = True                # spider关闭时更新scores(否则python -m doubanmovie.graph GRAPH_DIR scores)
+GRAPH_DAMPING = 0.85                        # PageRank damping factor
+GRAPH_PAGERANK_TOL = 1e-6                   # 两次iteration的scores之差(L1)小于此值时视为收敛
+GRAPH_PAGERANK_MAX_ITERATIONS = 100         # 未收敛时最多迭代的次数
+GRAPH_SEEDS = 0                             # > 0: 以scores最高的n部电影代替top250 index页面作为start requests
+GRAPH_SEED_METRIC = 'pagerank'              # 'pagerank' 或 'indegree'
+
+# for BrowserPoolMiddleware(只处理meta['render_js']为True的request)
+BROWSER_POOL_SIZE = 2
+BROWSER_MAX_PAGES = 100                     # 每个browser渲染n个页面后重建
+BROWSER_WAIT_TIMEOUT = 4
+BROWSER_PHANTOMJS_PATH = r'C:\Users\m7catsue\Desktop\phantomjs-2.1.1-windows\bin\phantomjs.exe'
+BROWSER_STUB_FILE = None                    # 测试用: 以本地HTML文件代替PhantomJS
+
+# for IdentityPoolMiddleware(每个identity = proxy + User-Agent + headers，各自一个downloader slot)
+IDENTITY_PROXIES = []                       # e.g. ['http://10.0.0.1:3128', 'http://10.0.0.2:3128', None(直连)]
+IDENTITY_HEADER_SETS = [
+    {'Accept-Language': 'zh-CN,zh;q=0.8'},
+    {'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.6'},
+    {'Accept-Language': 'zh-CN,en-US;q=0.7,en;q=0.3'},
+]
+IDENTITY_QUARANTINE_SECS = 300              # 被ban的identity暂停使用的时间(连续被ban时加倍)
 
 # for RandomUserAgentMiddleware
 USER_AGENT_LIST = [
@@ -52,12 +127,30 @@ USER_AGENT_LIST = [
 ]
 
 # scrapy默认设置：DUPEFILTER_CLASS = 'scrapy.dupefilter.RFPDupeFilter'
-#DUPEFILTER_CLASS = 'doubanmovie.request_dupefilter.CustomRequestFilter'
+DUPEFILTER_CLASS = 'doubanmovie.request_dupefilter.CustomRequestFilter'
+# CustomRequestFilter: subject id bitmap文件路径(None则不持久化)；启动时从'mysql'或'mongodb'载入已保存的subject id
+DUPEFILTER_BITMAP_PATH = None
+DUPEFILTER_PRELOAD = None
+
+# 分布式crawl(多个node共享Redis中的frontier和seen-set)，启用时取消以下注释
+#SCHEDULER = 'doubanmovie.frontier.RedisScheduler'
+#DOWNLOADER_MIDDLEWARES['doubanmovie.frontier.FrontierAckMiddleware'] = 960
+FRONTIER_REDIS_URL = 'redis://localhost:6379/0'     # 'fake://'为in-process stand-in(测试用)
+FRONTIER_NODE_ID = None                     # 默认为 hostname-pid
+FRONTIER_HEARTBEAT_INTERVAL = 10            # heartbeat间隔(秒)；超过3个间隔没有heartbeat的node视为已退出
+FRONTIER_FLUSH_ON_START = False             # True: 启动时清空该spider在Redis中的所有keys
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
 #CONCURRENT_REQUESTS = 32
 
+# True: 电影页面直接构造items.MovieRecord(__slots__)，不经过ItemLoader
+ITEM_FAST_PATH = False
+
+# 电影页面parsing所用的process数(0: 在reactor thread中parse)
+PARSE_POOL_SIZE = 0
+
 # Configure a delay for requests for the same website (default: 0)
+# AdaptiveThrottle启用时由其调整每个slot的delay(ADAPTIVE_THROTTLE_START_DELAY)
 DOWNLOAD_DELAY = 3
 # The download delay setting will honor only one of:
 #CONCURRENT_REQUESTS_PER_DOMAIN = 16
@@ -67,14 +160,53 @@ DOWNLOAD_DELAY = 3
 #TELNETCONSOLE_ENABLED = False
 
 # Enable or disable spider middlewares
-#SPIDER_MIDDLEWARES = {
-#    'doubanmovie.middlewares.MyCustomSpiderMiddleware': 543,
-#}
+SPIDER_MIDDLEWARES = {
+    'doubanmovie.middlewares.FrontierPriorityMiddleware': 950,
+}
+# 分布式crawl(SCHEDULER = RedisScheduler)时与DOWNLOADER_MIDDLEWARES中的FrontierAckMiddleware一起启用:
+# callback完成后才ack(order最小，最后处理spider output)
+#SPIDER_MIDDLEWARES['doubanmovie.frontier.FrontierAckMiddleware'] = 10
+
+# for FrontierPriorityMiddleware(按来源、depth、in-degree、是否已存于数据库设置request.priority)
+FRONTIER_SOURCE_WEIGHTS = {'front_page': 100, 'top250': 100, 'recommendation': 0, 'incomplete': -100}
+FRONTIER_DEPTH_WEIGHT = 5
+FRONTIER_INDEGREE_WEIGHT = 10
+FRONTIER_INDEGREE_CAP = 5
+FRONTIER_STORED_PENALTY = 50
+FRONTIER_STORED_BACKEND = None              # 'mysql' 或 'mongodb'
 
 # Enable or disable extensions
-#EXTENSIONS = {
+EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+    'doubanmovie.extensions.AdaptiveThrottle': 500,
+    'doubanmovie.extensions.Instrumentation': 510,
+    'doubanmovie.checkpoint.CrawlCheckpoint': 520,
+}
+
+# for CrawlCheckpoint(定期保存frontier、seen subject ids、pipelines的状态；重启后从checkpoint继续)
+CHECKPOINT_DIR = None                       # e.g. 'crawls/motion'；None为不启用
+CHECKPOINT_INTERVAL = 60                    # 每隔n秒写入一次checkpoint
+CHECKPOINT_RESUME = True                    # 启动时若有checkpoint则从checkpoint继续
+
+# for Instrumentation(callback/pipeline latency histograms，queue depths，drop reasons)
+INSTRUMENTATION_ENABLED = False
+INSTRUMENTATION_CALLBACKS = ['parse', 'parse_front_page', 'parse_top250_index_page']
+INSTRUMENTATION_INTERVAL = 0.5              # queue depths的采样间隔(秒)；queue/*/max只反映采样到的峰值
+INSTRUMENTATION_HOST = '127.0.0.1'
+INSTRUMENTATION_PORT = 9410                 # http://127.0.0.1:9410/metrics (Prometheus text format)；0为不提供
+
+# for AdaptiveThrottle(按latency、403/429、验证码跳转调整每个slot的delay；与AutoThrottle二选一)
+ADAPTIVE_THROTTLE_ENABLED = True
+ADAPTIVE_THROTTLE_START_DELAY = 3.0
+ADAPTIVE_THROTTLE_MIN_DELAY = 1.0
+ADAPTIVE_THROTTLE_MAX_DELAY = 60.0
+ADAPTIVE_THROTTLE_TARGET_CONCURRENCY = 1.0
+ADAPTIVE_THROTTLE_BACKOFF = 2.0             # 被ban时delay的倍数
+ADAPTIVE_THROTTLE_DECAY = 0.9               # 连续PROBE_AFTER个正常response后delay的倍数
+ADAPTIVE_THROTTLE_PROBE_AFTER = 20
+ADAPTIVE_THROTTLE_BAN_CODES = [403, 429]
+ADAPTIVE_THROTTLE_CAPTCHA_MARKERS = ['sec.douban.com', 'captcha', '/misc/sorry']
+ADAPTIVE_THROTTLE_DEBUG = False
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See http://doc.scrapy.org/en/latest/topics/autothrottle.html
@@ -91,8 +223,11 @@ DOWNLOAD_DELAY = 3
 
 # Enable and configure HTTP caching (disabled by default)
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
+# RFC2616Policy: 对已cache的页面发送conditional requests(ETag/Last-Modified)；
+# RevalidatingCacheMiddleware: 页面未改变时spider不再产生item(不再写入数据库)
 #HTTPCACHE_ENABLED = True
-#HTTPCACHE_EXPIRATION_SECS = 0
-#HTTPCACHE_DIR = 'httpcache'
-#HTTPCACHE_IGNORE_HTTP_CODES = []
-#HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
+HTTPCACHE_EXPIRATION_SECS = 0
+HTTPCACHE_DIR = 'httpcache'
+HTTPCACHE_IGNORE_HTTP_CODES = []
+HTTPCACHE_POLICY = 'scrapy.extensions.httpcache.RFC2616Policy'
+HTTPCACHE_STORAGE = 'doubanmovie.httpcache.SqliteCacheStorage'
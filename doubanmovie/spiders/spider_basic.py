@@ -7,6 +7,7 @@
 
 from scrapy.loader import ItemLoader
 from doubanmovie.items import DoubanmovieItem
+from doubanmovie.extractors import extract_movie_page
 import scrapy
 import time
 import socket
@@ -32,25 +33,16 @@ class BasicSpider(scrapy.Spider):
         @scrapes title year country genre language length director actors score image_url
         @scrapes url project spider server datetime
         """
-        # 取得下一波需要跳转到的url的response(由request返回)
-        for next_page_url in response.xpath(
-                "//*[@id='recommendations']/div[@class='recommendations-bd']/dl/dd/a/@href").extract():
+        # 遍历一次页面，取得所有primary fields 和 下一波需要跳转到的url
+        fields, next_page_urls = extract_movie_page(response.selector.root)
+        for next_page_url in next_page_urls:
             yield scrapy.Request(next_page_url, callback=self.parse)                # yield response with callback
 
         l = ItemLoader(item=DoubanmovieItem(), response=response)
 
-        # Load primary fields using XPath expressions
-        l.add_xpath('title', "//div[@id='content']/h1/span[@property='v:itemreviewed']/text()")
-        l.add_xpath('year', "//div[@id='content']/h1/span[@class='year']/text()")
-        # '/following::text()[1]' 取得位于span之下的（同缩进的）单独一行string
-        l.add_xpath('country', u"//*[@id='info']/span[@class='pl' and text()='制片国家/地区:']/following::text()[1]")
-        l.add_xpath('genre', "//*[@id='info']//span[@property='v:genre']/text()")
-        l.add_xpath('language', u"//*[@id='info']/span[@class='pl' and text()='语言:']/following::text()[1]")
-        l.add_xpath('length', "//*[@id='info']/span[@property='v:runtime']/text()")
-        l.add_xpath('director', "//*[@id='info']/span[1]/span[@class='attrs']//a/text()")
-        l.add_xpath('actors', "//*[@id='info']/span[@class='actor']/span[@class='attrs']/a/text()")
-        l.add_xpath('score', "//*[@id='interest_sectl']//strong[@property='v:average']/text()")
-        l.add_xpath('image_url', "//*[@id='mainpic']/a/img/@src")               # 电影海报图片链接
+        # Load primary fields (processors与原先add_xpath相同)
+        for field, values in fields.items():
+            l.add_value(field, values)
 
         # Housekeeping fields
         l.add_value('url', response.url)                                            # 当前页面url(未标准化的)
@@ -1,33 +1,133 @@
 # -*- coding: utf-8 -*-
 
 import scrapy
+from scrapy import signals
 from scrapy.loader import ItemLoader
-from doubanmovie.items import DoubanmovieItem
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet import threads
+from doubanmovie.items import DoubanmovieItem, build_movie_record, normalize_url
+from doubanmovie.extractors import extract_movie_page, extract_recommendation_urls, probe_missing_markers
+from doubanmovie.refresh import load_refresh_candidates, schedule_refresh
+from doubanmovie.checkpoint import load_checkpoint, restore_requests
+from doubanmovie.graph import RecommendationGraph, top_subjects, update_scores
+from doubanmovie.httpcache import page_unchanged, recommendations_extracted
+from doubanmovie.utils import get_subject_id
+import datetime
 import time
 import socket
 
 
 class DoubanMovieSpider(scrapy.Spider):
     """
-    DoubanMovieSpider 抓取豆瓣电影页面信息
+    DoubanMovieSpider 抓取豆瓣电影页面信息；
+    scrapy crawl motion -a mode=refresh: refresh模式，只重新抓取数据库中已过期的电影页面(及首页'正在上映'的电影)，
+    不跟进recommendation links；pipelines只写入有变化的fields
     """
     name = "motion"                                                          # scrapy shell命令使用的是spider name 'basic'
-    allowed_domains = ["movie.douban.com"]                                   # allowed_domains加‘https://’和'/'等字符会被offsite filter过滤掉
+    allowed_domains = ["movie.douban.com", "doubanio.com"]                   # allowed_domains加‘https://’和'/'等字符会被offsite filter过滤掉
+    parse_pool = None
+    graph = None
+
+    def __init__(self, mode=None, *args, **kwargs):
+        super(DoubanMovieSpider, self).__init__(*args, **kwargs)
+        self.refresh = mode == 'refresh'
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        """
+        PARSE_POOL_SIZE > 0 时，电影页面的parsing在ParsePool(process pool)中执行(spider_opened时启动，
+        此时crawler.stats才可用)；
+        GRAPH_DIR不为None时，recommendation edges记录于RecommendationGraph
+        """
+        spider = super(DoubanMovieSpider, cls).from_crawler(crawler, *args, **kwargs)
+        spider.early_drop_markers = [marker.encode('ascii') for marker in crawler.settings.getlist('EARLY_DROP_MARKERS')]
+        spider.early_drop_links = crawler.settings.get('EARLY_DROP_LINKS', 'deprioritize')
+        spider.parse_pool_size = crawler.settings.getint('PARSE_POOL_SIZE', 0)
+        if spider.parse_pool_size > 0:
+            crawler.signals.connect(spider.open_parse_pool, signal=signals.spider_opened)
+        graph_dir = crawler.settings.get('GRAPH_DIR')
+        if graph_dir:
+            spider.graph = RecommendationGraph(graph_dir)
+        return spider
+
+    def open_parse_pool(self, spider):
+        from doubanmovie.parse_pool import ParsePool                           # 只在启用时import(process pool)
+        self.parse_pool = ParsePool(self.parse_pool_size, self.crawler.stats)
+
+    async def start(self):
+        """scrapy 2.13+的start(): 产生start_requests()的requests"""
+        for request in self.start_requests():
+            yield request
 
     def start_requests(self):
-        """从豆瓣电影首页 和 豆瓣电影top250 获取首批url"""
+        """
+        从豆瓣电影首页 和 豆瓣电影top250 获取首批url；有checkpoint(CHECKPOINT_DIR)时从checkpoint的frontier继续；
+        GRAPH_SEEDS > 0 且已有graph scores时，以scores最高的GRAPH_SEEDS部电影代替top250 index页面
+        """
+        state = load_checkpoint(self.settings)
+        if state is not None:
+            for request in restore_requests(self, state):
+                self.crawler.stats.inc_value('checkpoint/restored_requests')
+                yield request
+            return
+
+        if self.refresh:
+            for request in self.refresh_requests():
+                yield request
+            return
+
         yield scrapy.Request('https://movie.douban.com/', callback=self.parse_front_page)
 
-        for x in xrange(0, 250, 25):                                         # 豆瓣top250的10个index页面(0，25，50...225)
+        seeds = self.graph_seeds()
+        if seeds:
+            for request in seeds:
+                yield request
+            return
+
+        for x in range(0, 250, 25):                                          # 豆瓣top250的10个index页面(0，25，50...225)
             yield scrapy.Request(
                 ('https://movie.douban.com/top250?start=%s&filter=' % x), callback=self.parse_top250_index_page)
 
+    def refresh_requests(self):
+        """
+        refresh模式的requests: 已过期的电影按staleness排列(priority由高到低)，加上首页'正在上映'的电影；
+        dont_filter=True: 已保存的subject ids可能已预载入dupefilter(DUPEFILTER_PRELOAD)
+        """
+        settings = self.settings
+        candidates = load_refresh_candidates(settings, settings.get('REFRESH_BACKEND', 'mysql'))
+        due = schedule_refresh(candidates, datetime.datetime.now(), settings.get('REFRESH_INTERVALS'),
+                               settings.getfloat('REFRESH_DEFAULT_INTERVAL', 90),
+                               settings.getint('REFRESH_MAX_REQUESTS', 0))
+        self.crawler.stats.set_value('refresh/candidates', len(candidates))
+        self.crawler.stats.set_value('refresh/scheduled', len(due))
+        yield scrapy.Request('https://movie.douban.com/', callback=self.parse_front_page, priority=len(due) + 1)
+        for rank, (subject_id, staleness) in enumerate(due):
+            yield scrapy.Request('https://movie.douban.com/subject/%d/' % subject_id, callback=self.parse,
+                                 priority=len(due) - rank, dont_filter=True, meta={'source': 'refresh'})
+
+    def graph_seeds(self):
+        """
+        上一次crawl的recommendation graph中scores(GRAPH_SEED_METRIC)最高的电影，priority按score由高到低；
+        dont_filter=True: 这些subjects多半已在dupefilter中，seed的作用是由其recommendations展开frontier
+        """
+        settings = self.settings
+        num_seeds = settings.getint('GRAPH_SEEDS', 0)
+        if num_seeds <= 0 or not settings.get('GRAPH_DIR'):
+            return []
+        seeds = top_subjects(settings.get('GRAPH_DIR'), num_seeds, settings.get('GRAPH_SEED_METRIC', 'pagerank'))
+        self.crawler.stats.set_value('graph/seeds', len(seeds))
+        return [scrapy.Request('https://movie.douban.com/subject/%d/' % subject_id, callback=self.parse,
+                               priority=len(seeds) - rank, dont_filter=True, meta={'source': 'graph_seed'})
+                for rank, (subject_id, score) in enumerate(seeds)]
+
     def parse_front_page(self, response):
         """豆瓣电影首页'正在上映'影片的页面url"""
         page_urls = response.xpath(
             "//*[@id='screening']/div[@class='screening-bd']/ul/li/ul/li[@class='title']/a/@href").extract()
         for page_url in page_urls:
-            yield scrapy.Request(page_url, callback=self.parse)
+            # meta['source']: 供FrontierPriorityMiddleware计算request的priority
+            yield scrapy.Request(page_url, callback=self.parse, meta={'source': 'front_page'},
+                                 dont_filter=self.refresh)
 
     def parse_top250_index_page(self, response):
         """从豆瓣电影top250 index页面获取 top250电影页面url"""
@@ -35,12 +135,17 @@ class DoubanMovieSpider(scrapy.Spider):
             "//*[@id='content']/div[@class='grid-16-8 clearfix']/div[@class='article']/ol/li/div[@class='item']/div[@class='pic']/a/@href"
         ).extract()
         for page_url in page_urls:
-            yield scrapy.Request(page_url, callback=self.parse)
+            yield scrapy.Request(page_url, callback=self.parse, meta={'source': 'top250'})
 
     def parse(self, response):
         """
         parse一个具体豆瓣电影的页面;
         response.xpath("somexpath").extract()若是xpath路径取不到，则返回为[]，不会有exception;
+        PARSE_POOL_SIZE > 0 时在process pool中extract，返回coroutine(_parse_in_pool，结果为requests和item的list);
+        页面内容未改变时(RevalidatingCacheMiddleware)只跟进recommendation links，不再产生item
+        (links取自cache中记录的recommendation subject ids，不再parse页面)，由page_unchanged signal更新抓取时间;
+        页面中缺少EARLY_DROP_MARKERS时(影视剧、短片、'页面不存在'等，item一定会被DropEmptyItemPipeline drop掉)
+        不做extraction、不产生item，recommendation links按EARLY_DROP_LINKS处理;
         以下@开头的是scrapy的contract，在命令行输入scrapy check basic来检验spider的功能;
 
         @url https://movie.douban.com/subject/4811813/
@@ -48,25 +153,85 @@ class DoubanMovieSpider(scrapy.Spider):
         @scrapes title year country genre language length director actors score image_url
         @scrapes url project spider server datetime
         """
-        # 取得下一波需要跳转到的url的response(由request返回)
-        for next_page_url in response.xpath(
-                "//*[@id='recommendations']/div[@class='recommendations-bd']/dl/dd/a/@href").extract():
-            yield scrapy.Request(next_page_url, callback=self.parse)           # yield response with callback
+        if response.meta.get('page_unchanged'):
+            self.crawler.stats.inc_value('httpcache/writes_saved')
+            subject_id = get_subject_id(response.url)
+            if subject_id is not None:
+                self.crawler.signals.send_catch_log(page_unchanged, url=normalize_url(response.url),
+                                                    subject_id=subject_id,
+                                                    crawled_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+            subject_ids = response.meta.get('cached_recommendations')
+            if subject_ids is not None:
+                self.crawler.stats.inc_value('httpcache/parses_saved')
+                next_page_urls = ['https://movie.douban.com/subject/%d/' % subject_id for subject_id in subject_ids]
+            else:
+                next_page_urls = self._recommendation_urls(response, extract_recommendation_urls(response.selector.root))
+            return self._parse_result(response, None, next_page_urls)
+        if self.early_drop_markers:
+            missing = probe_missing_markers(response.body, self.early_drop_markers)
+            if missing:
+                return self._early_drop(response, missing)
+        if self.parse_pool is not None:
+            return self._parse_in_pool(response)
+        # 遍历一次页面，取得所有primary fields 和 下一波需要跳转到的url
+        fields, next_page_urls = extract_movie_page(response.selector.root)
+        return self._parse_result(response, fields, self._recommendation_urls(response, next_page_urls))
+
+    async def _parse_in_pool(self, response):
+        """等待process pool中的extraction(不阻塞reactor)，再在reactor thread中产生requests和item"""
+        fields, next_page_urls = await maybe_deferred_to_future(
+            self.parse_pool.submit(response.body, response.encoding))
+        return list(self._parse_result(response, fields, self._recommendation_urls(response, next_page_urls)))
+
+    def _recommendation_urls(self, response, urls):
+        """发送recommendations_extracted signal(RevalidatingCacheMiddleware将subject ids与cached response一起保存)"""
+        subject_ids = [subject_id for subject_id in (get_subject_id(url) for url in urls) if subject_id is not None]
+        self.crawler.signals.send_catch_log(recommendations_extracted, request=response.request,
+                                            subject_ids=subject_ids)
+        return urls
+
+    def _early_drop(self, response, missing):
+        """
+        不能产生有效item的页面: EARLY_DROP_LINKS为'skip'时不跟进recommendation links，'deprioritize'时
+        以最低的priority跟进(meta['source'] = 'incomplete')，'follow'时与正常页面相同
+        """
+        stats = self.crawler.stats
+        stats.inc_value('early_drop/pages')
+        stats.inc_value('early_drop/bytes', len(response.body))
+        for marker in missing:
+            stats.inc_value('early_drop/missing/%s' % marker.decode('ascii'))
+        next_page_urls = self._recommendation_urls(response, extract_recommendation_urls(response.selector.root))
+        if self.early_drop_links == 'skip':
+            stats.inc_value('early_drop/links_skipped', len(next_page_urls))
+            next_page_urls = []
+        if self.early_drop_links == 'deprioritize':
+            stats.inc_value('early_drop/links_deprioritized', len(next_page_urls))
+            return self._parse_result(response, None, next_page_urls, source='incomplete', priority=-100)
+        return self._parse_result(response, None, next_page_urls)
+
+    def _parse_result(self, response, fields, next_page_urls, source='recommendation', priority=0):
+        """由extract的结果产生下一波requests 和 item；refresh模式不跟进recommendation links(但仍记录edges)"""
+        if self.graph is not None:
+            edges = self.graph.add(get_subject_id(response.url), [get_subject_id(url) for url in next_page_urls])
+            self.crawler.stats.inc_value('graph/edges', edges)
+        for next_page_url in ([] if self.refresh else next_page_urls):
+            yield scrapy.Request(next_page_url, callback=self.parse,           # yield response with callback
+                                 priority=priority, meta={'source': source})
+
+        if fields is None:                                                      # 页面未改变或early drop，不产生item
+            return
+
+        if self.settings.getbool('ITEM_FAST_PATH'):
+            # 不经过ItemLoader，直接构造MovieRecord(normalisations相同)
+            yield build_movie_record(fields, response.url, project=self.settings.get('BOT_NAME'), spider=self.name,
+                                     server=socket.gethostname(), datetime=time.strftime("%Y-%m-%d %H:%M:%S"))
+            return
 
         l = ItemLoader(item=DoubanmovieItem(), response=response)
 
-        # Load primary fields using XPath expressions
-        l.add_xpath('title', "//div[@id='content']/h1/span[@property='v:itemreviewed']/text()")
-        l.add_xpath('year', "//div[@id='content']/h1/span[@class='year']/text()")
-        # '/following::text()[1]' 取得位于span之下的（同缩进的）单独一行string
-        l.add_xpath('country', u"//*[@id='info']/span[@class='pl' and text()='制片国家/地区:']/following::text()[1]")
-        l.add_xpath('genre', "//*[@id='info']//span[@property='v:genre']/text()")
-        l.add_xpath('language', u"//*[@id='info']/span[@class='pl' and text()='语言:']/following::text()[1]")
-        l.add_xpath('length', "//*[@id='info']/span[@property='v:runtime']/text()")
-        l.add_xpath('director', "//*[@id='info']/span[1]/span[@class='attrs']//a/text()")
-        l.add_xpath('actors', "//*[@id='info']/span[@class='actor']/span[@class='attrs']/a/text()")
-        l.add_xpath('score', "//*[@id='interest_sectl']//strong[@property='v:average']/text()")
-        l.add_xpath('image_url', "//*[@id='mainpic']/a/img/@src")               # 电影海报图片链接
+        # Load primary fields (processors与原先add_xpath相同)
+        for field, values in fields.items():
+            l.add_value(field, values)
 
         # Housekeeping fields
         l.add_value('url', response.url)                                        # 当前页面url(未标准化的)
@@ -77,3 +242,14 @@ class DoubanMovieSpider(scrapy.Spider):
 
         yield l.load_item()
 
+    def closed(self, reason):
+        if self.parse_pool is not None:
+            self.parse_pool.close()
+        if self.graph is not None:
+            self.graph.close()
+            if self.settings.getbool('GRAPH_SCORES_ON_CLOSE', True):
+                # PageRank在thread pool中迭代(不阻塞reactor)；engine等待deferred完成后才结束crawl
+                return threads.deferToThread(update_scores, self.settings.get('GRAPH_DIR'),
+                                             self.settings.getfloat('GRAPH_DAMPING', 0.85),
+                                             self.settings.getfloat('GRAPH_PAGERANK_TOL', 1e-6),
+                                             self.settings.getint('GRAPH_PAGERANK_MAX_ITERATIONS', 100))
@@ -3,10 +3,7 @@
 import scrapy
 from scrapy.loader import ItemLoader
 from doubanmovie.items import DoubanmovieItem
-from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions
+from doubanmovie.extractors import extract_movie_page
 import time
 import socket
 
@@ -17,11 +14,6 @@ class DoubanMovieSpider(scrapy.Spider):
     """
     name = "montion2"                                                        # scrapy shell命令使用的是spider name 'basic'
     allowed_domains = ["movie.douban.com"]                                  # allowed_domains加‘https://’和'/'等字符会被offsite filter过滤掉
-    phantomJS_executable_path = \
-        r'C:\Users\m7catsue\Desktop\phantomjs-2.1.1-windows\bin\phantomjs.exe'
-    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0.2704.63 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                'Accept-Language': 'zh-CN,zh;q=0.8'}
 
     def start_requests(self):
         """从豆瓣电影首页 和 豆瓣电影top250 获取首批url"""
@@ -39,22 +31,16 @@ class DoubanMovieSpider(scrapy.Spider):
         for page_url in page_urls:
             yield scrapy.Request(page_url, callback=self.parse)
 
-        # '热门推荐'影片(需执行Javascript)
-        for key in self.headers:                                            # set custom headers for selenium PhantomJS
-            webdriver.DesiredCapabilities.PHANTOMJS['phantomjs.page.customHeaders.{}'.format(key)] = self.headers[key]
+        # '热门推荐'影片(需执行Javascript)，由BrowserPoolMiddleware中的headless browser渲染
+        yield scrapy.Request(response.url, callback=self.parse_front_page_rendered, dont_filter=True,
+                             meta={'render_js': True, 'render_wait_for': 'list-wp'})
 
-        driver = webdriver.PhantomJS(executable_path=self.phantomJS_executable_path)
-        driver.get(response.url)
-        WebDriverWait(driver, 4).until(
-            expected_conditions.visibility_of_element_located((By.CLASS_NAME, 'list-wp')))
-
-        link_elements = driver.find_elements_by_xpath("//*[@id='gaia']/div[@class='list-wp']/div/a")
-        for link_element in link_elements:
-            page_url = link_element.get_attribute('href')
+    def parse_front_page_rendered(self, response):
+        """豆瓣电影首页(已执行Javascript)'热门推荐'影片的页面url"""
+        page_urls = response.xpath("//*[@id='gaia']/div[@class='list-wp']/div/a/@href").extract()
+        for page_url in page_urls:
             yield scrapy.Request(page_url, callback=self.parse)
 
-        driver.close()                                                       # 关闭web driver
-
     def parse_top250_index_page(self, response):
         """从豆瓣电影top250 index页面获取 top250电影页面url"""
         page_urls = response.xpath(
@@ -74,25 +60,16 @@ class DoubanMovieSpider(scrapy.Spider):
         @scrapes title year country genre language length director actors score image_url
         @scrapes url project spider server datetime
         """
-        # 取得下一波需要跳转到的url的response(由request返回)
-        for next_page_url in response.xpath(
-                "//*[@id='recommendations']/div[@class='recommendations-bd']/dl/dd/a/@href").extract():
-            yield scrapy.Request(next_page_url, callback=self.parse)                   # yield response with callback
+        # 遍历一次页面，取得所有primary fields 和 下一波需要跳转到的url
+        fields, next_page_urls = extract_movie_page(response.selector.root)
+        for next_page_url in next_page_urls:
+            yield scrapy.Request(next_page_url, callback=self.parse)                # yield response with callback
 
         l = ItemLoader(item=DoubanmovieItem(), response=response)
 
-        # Load primary fields using XPath expressions
-        l.add_xpath('title', "//div[@id='content']/h1/span[@property='v:itemreviewed']/text()")
-        l.add_xpath('year', "//div[@id='content']/h1/span[@class='year']/text()")
-        # '/following::text()[1]' 取得位于span之下的（同缩进的）单独一行string
-        l.add_xpath('country', u"//*[@id='info']/span[@class='pl' and text()='制片国家/地区:']/following::text()[1]")
-        l.add_xpath('genre', "//*[@id='info']//span[@property='v:genre']/text()")
-        l.add_xpath('language', u"//*[@id='info']/span[@class='pl' and text()='语言:']/following::text()[1]")
-        l.add_xpath('length', "//*[@id='info']/span[@property='v:runtime']/text()")
-        l.add_xpath('director', "//*[@id='info']/span[1]/span[@class='attrs']//a/text()")
-        l.add_xpath('actors', "//*[@id='info']/span[@class='actor']/span[@class='attrs']/a/text()")
-        l.add_xpath('score', "//*[@id='interest_sectl']//strong[@property='v:average']/text()")
-        l.add_xpath('image_url', "//*[@id='mainpic']/a/img/@src")               # 电影海报图片链接
+        # Load primary fields (processors与原先add_xpath相同)
+        for field, values in fields.items():
+            l.add_value(field, values)
 
         # Housekeeping fields
         l.add_value('url', response.url)                                            # 当前页面url(未标准化的)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# 各个pipeline/middleware/dupefilter共用的helper functions
+
+import logging
+import re
+
+_digits = re.compile(r'\d+')
+
+
+def get_subject_id(url):
+    """
+    取得url中 https://movie.douban.com/subject/...(id).../ 的subject id(int)；
+    非subject页面(首页、top250 index页面等)返回None
+    """
+    parts = url.split('/')
+    if 'subject' not in parts:
+        return None
+    subject_id_index = parts.index('subject') + 1
+    if subject_id_index >= len(parts) or not parts[subject_id_index].isdigit():
+        return None
+    return int(parts[subject_id_index])
+
+
+def get_celebrity_id(url):
+    """'/celebrity/1054524/' 或 'https://movie.douban.com/celebrity/1054524/' -> 1054524；其他link返回None"""
+    parts = (url or '').split('/')
+    if 'celebrity' not in parts:
+        return None
+    celebrity_id_index = parts.index('celebrity') + 1
+    if celebrity_id_index >= len(parts) or not parts[celebrity_id_index].isdigit():
+        return None
+    return int(parts[celebrity_id_index])
+
+
+def parse_year(value):
+    """'2010' 或 '(2010)' -> 2010；无法解析时返回None"""
+    match = _digits.search(value or '')
+    return int(match.group()) if match else None
+
+
+def parse_score(value):
+    """'9.3' -> 9.3；无评分('' 或 None)时返回None"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_runtime(value):
+    """'148分钟' 或 '148 分钟(导演剪辑版)' -> 148(分钟)；无法解析时返回None"""
+    match = _digits.search(value or '')
+    return int(match.group()) if match else None
+
+
+def split_values(value):
+    """item中以','连接的多值field('美国 , 英国') -> ['美国', '英国']"""
+    return [part.strip() for part in (value or '').split(',') if part.strip()]
+
+
+def is_banned_response(response, ban_codes, captcha_markers):
+    """response是否表示被ban: ban_codes中的status，或跳转至(或已位于)验证码页面"""
+    if response.status in ban_codes:
+        return True
+    if response.status in (301, 302, 303, 307):
+        location = response.headers.get('Location', b'')
+        if not isinstance(location, str):
+            location = location.decode('latin1')
+        return any(marker in location for marker in captcha_markers)
+    return any(marker in response.url for marker in captcha_markers)
+
+
+def load_stored_subject_ids(settings, backend):
+    """从MySQL(backend='mysql') 或 MongoDB(backend='mongodb')取得已保存的所有subject id"""
+    if backend == 'mysql':
+        import pymysql
+        conn = pymysql.connect(host=settings.get('MYSQL_HOST'), user=settings.get('MYSQL_USER'),
+                               password=settings.get('MYSQL_PASS'), db=settings.get('MYSQL_DB'), charset='utf8')
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT url FROM douban_movie_scrapy")
+            urls = [row[0] for row in cursor.fetchall()]
+        finally:
+            conn.close()
+    elif backend == 'mongodb':
+        import pymongo
+        connection = pymongo.MongoClient(settings.get('MONGODB_HOST'), settings.get('MONGODB_PORT'))
+        try:
+            collection = connection[settings.get('MONGODB_DB')][settings.get('MONGODB_COLLECTION')]
+            urls = [doc['url'] for doc in collection.find({}, {'url': 1})]
+        finally:
+            connection.close()
+    else:
+        raise ValueError('Unknown backend for stored subject ids: %s' % backend)
+    subject_ids = [x for x in (get_subject_id(url) for url in urls) if x is not None]
+    logging.info('%d stored subject ids loaded from %s.' % (len(subject_ids), backend))
+    return subject_ids